@@ -33,11 +33,7 @@ def extract_velocity_cells_sphere( vlsvReader, cellid, origin, radius ):
        :returns: Non backstream velocity cells and their avgs values as [vcellids, avgs]
    '''
    # Read the velocity cells:
-   velocity_cell_data = vlsvReader.read_velocity_cells(cellid)
-   # Get cells:
-   vcellids = list(velocity_cell_data.keys())
-   # Get avgs data:
-   avgs = list(velocity_cell_data.values())
+   vcellids, avgs = vlsvReader.read_velocity_cells_array(cellid)
    # Get a list of velocity coordinates shifted by the solar wind bulk velocity:
    origin = np.array(origin)
    v = vlsvReader.get_velocity_cell_coordinates(vcellids) - origin
@@ -62,11 +58,7 @@ def extract_velocity_cells_non_sphere( vlsvReader, cellid, origin, radius ):
        :returns: Non backstream velocity cells and their avgs values as [vcellids, avgs]
    '''
    # Read the velocity cells:
-   velocity_cell_data = vlsvReader.read_velocity_cells(cellid)
-   # Get cells:
-   vcellids = list(velocity_cell_data.keys())
-   # Get avgs data:
-   avgs = list(velocity_cell_data.values())
+   vcellids, avgs = vlsvReader.read_velocity_cells_array(cellid)
    # Get a list of velocity coordinates shifted by the solar wind bulk velocity:
    origin = np.array(origin)
    v = vlsvReader.get_velocity_cell_coordinates(vcellids) - origin
@@ -44,8 +44,15 @@ from cutthrough import cut_through, cut_through_step, cut_through_curve, cut_thr
 from fourier import fourier
 from spectra import get_spectrum_energy, get_spectrum_alongaxis_vel
 from variable import VariableInfo
-from timeevolution import cell_time_evolution
+from timeevolution import cell_time_evolution, cell_time_evolution_array
 from pitchangle import pitch_angles
+from velocitymoments import velocity_moments, velocity_moments_from_blocks
+from vdfhistogram import vdf_histograms, histogram1d, histogram2d
+from timeenergyspectrogram import time_energy_spectrogram, load_time_energy_spectrogram, energy_spectra
+from timeseriescube import TimeSeriesCube, time_series_cube
+from timeinterpolation import TimeInterpolator
+from geoelectric import geoelectric_field, geoelectric_field_windows, ground_horizontal_components, surface_impedance, interpolate_in_time
+from ulffilter import ulf_filter_stream, ulf_wave_power, ulf_bands
 #from backstream import extract_velocity_cells_sphere, extract_velocity_cells_non_sphere
 from gyrophaseangle import gyrophase_angles_from_file
 from themis_observation import themis_observation_from_file
@@ -57,6 +64,6 @@ from cut3d import cut3d
 from lineout import lineout
 import fit
 from fieldtracer import static_field_tracer, static_field_tracer_3d
-from fieldtracer import dynamic_field_tracer
-from non_maxwellianity import epsilon_M
+from fieldtracer import dynamic_field_tracer, time_dependent_field_tracer
+from non_maxwellianity import epsilon_M, epsilon_M_cells
 from interpolator_amr import AMRInterpolator, supported_amr_interpolators
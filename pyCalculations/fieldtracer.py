@@ -362,7 +362,8 @@ def static_field_tracer_3d( vlsvReader, seed_coords, max_iterations, dx, directi
          elif part.startswith("vg"):   
             vg = grid_var   
             # neighbors_vg = vlsvReader.read_variable_to_cache("vg_regular_interp_neighbors")
-            vg_cache = vlsvReader.read_variable_to_cache(vg)
+            if not (vg, "pass") in vlsvReader.variable_cache:
+               vlsvReader.read_variable_to_cache(vg)
             break
       else:
          raise ValueError("Please give a valid string (eg. 'vg_b_vol')")
@@ -370,16 +371,15 @@ def static_field_tracer_3d( vlsvReader, seed_coords, max_iterations, dx, directi
       #   fg is already an ndarray
       if not isinstance(grid_var, np.ndarray):
          raise TypeError("Keyword parameter grid_var does not seem to be a string nor a numpy ndarray.")
-      elif fg.ndim!=4 or fg.shape[-1]!=3:
-         raise ValueError("Checking array supplied in grid_var keyword: fg[-1]={} (expected: 3), fg.ndim={} (expected: 4)".format(fg[-1], fg.ndim))
-      else:
-         raise TypeError("Unrecognized grid_var keyword data (expect string or numpy.ndarray)")
+      elif grid_var.ndim!=4 or grid_var.shape[-1]!=3:
+         raise ValueError("Checking array supplied in grid_var keyword: fg.shape[-1]={} (expected: 3), fg.ndim={} (expected: 4)".format(grid_var.shape[-1], grid_var.ndim))
+      fg = grid_var
          
    # Recursion (trace in both directions and concatenate the results)
    if direction == '+-':
-      backward = static_field_tracer_3d(vlsvReader, seed_coords, max_iterations, dx, direction='-', grid_var = grid_var, stop_condition = default_stopping_condition, centering = centering)
+      backward = static_field_tracer_3d(vlsvReader, seed_coords, max_iterations, dx, direction='-', grid_var = grid_var, stop_condition = stop_condition, centering = centering)
       # backward.reverse()
-      forward = static_field_tracer_3d(vlsvReader, seed_coords, max_iterations, dx, direction='+', grid_var = grid_var, stop_condition = default_stopping_condition, centering = centering)
+      forward = static_field_tracer_3d(vlsvReader, seed_coords, max_iterations, dx, direction='+', grid_var = grid_var, stop_condition = stop_condition, centering = centering)
       return np.concatenate((backward[:,::-1,:],forward[:, 1:, :]), axis = 1)
 
    multiplier = -1 if direction == '-' else 1   
@@ -393,3 +393,87 @@ def static_field_tracer_3d( vlsvReader, seed_coords, max_iterations, dx, directi
 
    return points_traced       # list for fg; 3d numpy array(N,maxiterations,3) for vg
 
+
+def time_dependent_field_tracer( files, seed_coords, max_iterations, dx, direction='+-', grid_var='vg_b_vol', velocity='vg_v',
+                                 t_start=None, t_end=None, substeps=1, stop_condition=default_stopping_condition, centering=None,
+                                 window=4 ):
+   ''' Follows field lines through a series of files: the seed points are advected with the bulk velocity from one file
+       to the next, and the field lines are retraced from the moved seeds in every file.
+
+      :param files:           Directory of the run, a list of file names, a VlsvRun or a TimeInterpolator
+      :param seed_coords:     Seed points [N,3] at the first traced time (e.g. points on the flux tubes or X-lines to follow)
+      :param max_iterations:  The maximum number of iterations of each field line trace, see :func:`static_field_tracer_3d`
+      :param dx:              One iteration step length of the field line traces [m]
+      :param direction:       '+', '-' or '+-' Trace the field lines in the plus direction, minus direction or both
+      :param grid_var:        Variable to be traced, 'vg_b_vol', 'fg_b' or another vg_ or fg_ vector variable
+      :param velocity:        Vector variable advecting the seeds, e.g. 'vg_v' or 'proton/vg_v'
+      :param t_start:         Time of the seed points, the first file by default. Traces are done at the file times
+                              from t_start to t_end.
+      :param t_end:           Last traced time, the last file by default
+      :param substeps:        Number of midpoint (RK2) advection steps between consecutive files
+      :param stop_condition:  Stopping condition of the traces, see :func:`static_field_tracer_3d`
+      :param centering:       Centering of a fg_ variable other than fg_b and fg_e, 'face' or 'edge'
+      :param window:          Number of files (with their cached variables) kept in memory
+      :returns: dictionary with "times" [T], "seeds" [T,N,3] and "traces", a list of T arrays [N,L,3] as returned by
+                :func:`static_field_tracer_3d`. Seeds that leave the domain are NaN from then on, as are their traces.
+
+      .. code-block:: python
+
+         # Example usage:
+         result = time_dependent_field_tracer("/path/to/run/", np.array([[1e8,0,0],[1.2e8,0,1e7]]), 2000, 1e5,
+                                              t_start=1000, t_end=1100)
+         for t, traces in zip(result["times"], result["traces"]):
+            ...
+
+      .. seealso:: :func:`static_field_tracer_3d` :class:`TimeInterpolator`
+   '''
+   from timeinterpolation import TimeInterpolator
+   series = files if isinstance(files, TimeInterpolator) else TimeInterpolator(files, window=window)
+   file_times = series.get_times()
+   if t_start is None:
+      t_start = file_times[0]
+   if t_end is None:
+      t_end = file_times[-1]
+   traced = np.nonzero((file_times > t_start) & (file_times <= t_end))[0]
+   times = np.concatenate(([t_start], file_times[traced]))
+
+   seeds = np.array(np.reshape(seed_coords, (-1, 3)), dtype=float)
+   all_seeds = np.full((len(times), seeds.shape[0], 3), np.nan)
+   traces = []
+   for n, t in enumerate(times):
+      all_seeds[n] = seeds
+      # The field lines at t_start come from the file nearest to it, the others exactly at the file times
+      f = series.reader(int(np.argmin(np.abs(file_times - t))))
+      if isinstance(grid_var, str) and grid_var.startswith("fg"):
+         if not (grid_var, "pass") in f.variable_cache:
+            f.read_variable_to_cache(grid_var)
+         fg_centering = {"fg_b": "face", "fg_e": "edge"}.get(grid_var, centering)
+         fg_size = f.get_fsgrid_mesh_size()
+         field = np.reshape(f.variable_cache[(grid_var, "pass")], (fg_size[0], fg_size[1], fg_size[2], 3))
+      else:
+         field, fg_centering = grid_var, centering
+      inside = np.all(np.isfinite(seeds), axis=1)
+      length = max_iterations if direction != '+-' else 2*max_iterations - 1
+      trace = np.full((seeds.shape[0], length, 3), np.nan)
+      if np.any(inside):
+         trace[inside] = static_field_tracer_3d(f, seeds[inside], max_iterations, dx, direction=direction, grid_var=field,
+                                                stop_condition=stop_condition, centering=fg_centering)
+      traces.append(trace)
+
+      # Advect the seeds to the next traced time
+      if n == len(times) - 1:
+         break
+      h = (times[n+1] - t) / substeps
+      for step in range(substeps):
+         ts = t + step*h
+         inside = np.all(np.isfinite(seeds), axis=1)
+         if not np.any(inside):
+            break
+         v = np.reshape(series.read_interpolated_variable(velocity, ts, coords=seeds[inside]), (-1, 3))
+         midpoints = seeds[inside] + 0.5*h*v
+         v = np.reshape(series.read_interpolated_variable(velocity, ts + 0.5*h, coords=midpoints), (-1, 3))
+         seeds[inside] = seeds[inside] + h*v
+         seeds[stop_condition(f, seeds) | ~np.all(np.isfinite(seeds), axis=1)] = np.nan
+
+   return {"times": times, "seeds": all_seeds, "traces": traces}
+
@@ -0,0 +1,250 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+''' Horizontal geoelectric field at many ground stations from their magnetic field time series.
+
+   The ground is a plane-wave conductor: a uniform half-space or horizontal layers over a half-space. The field of a
+   time series with piecewise constant dB/dt is the exact superposition of ramp responses (Liu et al. 2009,
+   doi:10.1029/2008SW000439, generalised to layered ground), computed for all stations at once, as an FFT
+   convolution for uniform time steps and as a matrix product otherwise.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      # dB_dt [nstations, 3, ntimes] (T/s) at the ground positions pos [nstations, 3] (m)
+      dB_north, dB_east = pt.calculations.ground_horizontal_components(dB_dt, pos)
+      E_north, E_east = pt.calculations.geoelectric_field(dB_north, dB_east, time, sigma=1e-3)
+      # Three layers: 1e-2 S/m for 10 km, 1e-3 S/m for 90 km, then 1e-1 S/m
+      E_north, E_east = pt.calculations.geoelectric_field(dB_north, dB_east, time, sigma=([1e-2, 1e-3, 1e-1], [1e4, 9e4]))
+
+'''
+
+import numpy as np
+from math import factorial
+
+mu_0 = 1.25663706e-6    # permeability of free space
+
+def ground_horizontal_components(vectors, pos):
+   ''' Returns the northward and eastward components of cartesian vectors at ground positions
+
+   :param vectors:      Cartesian vectors [nstations, 3, ntimes] (or [nstations, 3])
+   :param pos:          Cartesian positions [nstations, 3]
+   :returns: north, east arrays [nstations, ntimes]
+   '''
+   vectors = np.asarray(vectors, dtype=float)
+   pos = np.asarray(pos, dtype=float)
+   r = np.linalg.norm(pos, axis=-1)
+   theta = np.arccos(pos[:,2] / r)
+   phi = np.arctan2(pos[:,1], pos[:,0])
+   extra = (np.newaxis,) * (vectors.ndim - 2)
+   theta = theta[(slice(None),) + extra]
+   phi = phi[(slice(None),) + extra]
+   vx, vy, vz = vectors[:,0], vectors[:,1], vectors[:,2]
+   v_theta = vx * np.cos(theta) * np.cos(phi) + vy * np.cos(theta) * np.sin(phi) - vz * np.sin(theta)
+   v_phi = -vx * np.sin(phi) + vy * np.cos(phi)
+   return -v_theta, v_phi
+
+def interpolate_in_time(times, data, new_times, valid=None):
+   ''' Linear interpolation of many time series at once
+
+   :param times:        Times of the samples [ntimes], monotonically increasing
+   :param data:         Samples with time along the last axis [..., ntimes]
+   :param new_times:    Times to interpolate to; values outside the samples are taken from the end samples
+   :param valid:        Boolean mask [ntimes] of the samples to use, e.g. to interpolate over missing files
+   :returns: array [..., len(new_times)]
+   '''
+   times = np.asarray(times, dtype=float)
+   data = np.asarray(data)
+   if valid is not None:
+      valid = np.asarray(valid, dtype=bool)
+      times = times[valid]
+      data = data[..., valid]
+   new_times = np.asarray(new_times, dtype=float)
+   if len(times) == 1:
+      return np.repeat(data, len(new_times), axis=-1)
+   upper = np.clip(np.searchsorted(times, new_times, side='right'), 1, len(times) - 1)
+   lower = upper - 1
+   w = np.clip((new_times - times[lower]) / (times[upper] - times[lower]), 0, 1)
+   return data[..., lower] * (1 - w) + data[..., upper] * w
+
+def surface_impedance(s, conductivities, thicknesses=()):
+   ''' Plane-wave surface impedance of layered ground
+
+   :param s:              Laplace variable (1/s), real or complex; 1j*omega gives the impedance at angular frequency omega
+   :param conductivities: Conductivities of the layers from the top (S/m), the last one is the underlying half-space
+   :param thicknesses:    Thicknesses of all but the last layer (m)
+   :returns: Z(s) (Ohm), with E_north = -Z B_east / mu_0 and E_east = Z B_north / mu_0
+   '''
+   s = np.asarray(s)
+   conductivities = np.atleast_1d(np.asarray(conductivities, dtype=float))
+   thicknesses = np.atleast_1d(np.asarray(thicknesses, dtype=float))
+   if len(thicknesses) != len(conductivities) - 1:
+      raise ValueError("Layered ground needs one thickness less than conductivities")
+   k = np.sqrt(s * mu_0 * conductivities[-1])
+   Z = s * mu_0 / k
+   for sigma, h in zip(conductivities[-2::-1], thicknesses[::-1]):
+      k = np.sqrt(s * mu_0 * sigma)
+      zeta = s * mu_0 / k
+      tanh = np.tanh(k * h)
+      Z = zeta * (Z + zeta * tanh) / (zeta + Z * tanh)
+   return Z
+
+def _stehfest_coefficients(N):
+   V = np.zeros(N)
+   for k in range(1, N + 1):
+      for j in range((k + 1) // 2, min(k, N // 2) + 1):
+         V[k-1] += j**(N // 2) * factorial(2*j) / (factorial(N // 2 - j) * factorial(j) * factorial(j - 1) *
+                                                  factorial(k - j) * factorial(2*j - k))
+      V[k-1] *= (-1)**(k + N // 2)
+   return V
+
+def ramp_response(t, sigma=1e-3):
+   ''' Horizontal electric field at time t after the horizontal magnetic field starts to change at a unit rate (1 T/s)
+
+   :param t:            Times since the start of the ramp (s)
+   :param sigma:        Ground conductivity (S/m), or a layered model (conductivities, thicknesses), see :func:`surface_impedance`
+   :returns: the field (V/m) along the direction of (B x up), i.e. E_north for a ramp in -B_east and E_east for a
+             ramp in B_north. Exact for a half-space (2 sqrt(t / (pi mu_0 sigma))), numerical inversion of the
+             Laplace transform Z(s) / (mu_0 s^2) for layered ground.
+   '''
+   t = np.asarray(t, dtype=float)
+   if np.isscalar(sigma):
+      return 2. * np.sqrt(np.maximum(t, 0) / (np.pi * mu_0 * sigma))
+   conductivities, thicknesses = sigma
+   # Gaver-Stehfest inversion, accurate to ~1e-7 for these smooth monotonic responses
+   N = 14
+   V = _stehfest_coefficients(N)
+   positive = t > 0
+   result = np.zeros(t.shape)
+   tp = t[positive]
+   s = np.arange(1, N + 1)[np.newaxis, :] * np.log(2.) / tp[:, np.newaxis]
+   result[positive] = np.log(2.) / tp * np.sum(V * surface_impedance(s, conductivities, thicknesses) / (mu_0 * s**2), axis=1)
+   return result
+
+def _convolve_causal(x, kernel):
+   ''' Causal convolution of many series [nstations, ntimes] with one kernel [ntimes] by FFT
+   '''
+   n = x.shape[-1] + len(kernel) - 1
+   nfft = 1 << int(np.ceil(np.log2(max(n, 1))))
+   result = np.fft.irfft(np.fft.rfft(x, nfft, axis=-1) * np.fft.rfft(kernel, nfft), nfft, axis=-1)
+   return result[..., :x.shape[-1]]
+
+def geoelectric_field(dB_north, dB_east, time, sigma=1e-3, method='liu', chunk_stations=4096):
+   ''' Horizontal geoelectric field of many stations, by Cagniard's plane-wave formula
+          References: Cagniard et al 1952 (eq. 12), Pulkinnen et al 2006 (eq. 19)
+
+   :param dB_north:     Northward dB/dt (T/s) [nstations, ntimes] (or [ntimes])
+   :param dB_east:      Eastward dB/dt (T/s), same shape
+   :param time:         1D array of times (s), monotonically increasing
+   :param sigma:        Ground conductivity (S/m), or a layered model (conductivities, thicknesses), see :func:`surface_impedance`
+   :param method:       'liu': Liu et al. (2009), exact for piecewise constant dB/dt, with sample k of dB/dt
+                               giving the rate between time[k] and time[k+1]
+                        'RH-riemann': right-handed Riemann sum (half-space only)
+   :param chunk_stations: Number of stations processed at once, bounds the memory use
+   :returns: E_north, E_east (V/m), same shape as dB_north
+
+   .. seealso:: :func:`ground_horizontal_components` :func:`geoelectric_field_windows`
+   '''
+   dB_north = np.asarray(dB_north, dtype=float)
+   dB_east = np.asarray(dB_east, dtype=float)
+   shape = dB_north.shape
+   dB_north = np.reshape(dB_north, (-1, shape[-1]))
+   dB_east = np.reshape(dB_east, (-1, shape[-1]))
+   time = np.asarray(time, dtype=float)
+   T = len(time)
+
+   steps = np.diff(time)
+   uniform = T > 1 and np.allclose(steps, steps[0], rtol=1e-9, atol=0)
+   if method == 'liu':
+      if uniform:
+         # E[i] = sum_k dB_dt[k] (R(t_i - t_k) - R(t_i - t_k+1)), a function of i-k only
+         m = np.arange(T)
+         kernel = np.zeros(T)
+         R = ramp_response(m * steps[0], sigma)
+         kernel[1:] = R[1:] - R[:-1]
+      else:
+         lag = time[:, np.newaxis] - time[np.newaxis, :]
+         lag_next = np.zeros_like(lag)
+         lag_next[:, :-1] = time[:, np.newaxis] - time[np.newaxis, 1:]
+         matrix = np.where(lag > 0, ramp_response(lag, sigma) - ramp_response(lag_next, sigma), 0.)
+   elif method == 'RH-riemann':
+      if not np.isscalar(sigma):
+         raise ValueError("The RH-riemann method supports only a uniform half-space")
+      t0 = time[1] - time[0]
+      lag = time[:, np.newaxis] - time[np.newaxis, :]
+      dt = np.concatenate(([0.], steps))[np.newaxis, :]
+      with np.errstate(invalid='ignore', divide='ignore'):
+         matrix = np.where(lag >= 0, dt / np.sqrt(np.maximum(lag, 0) + t0), 0.) / np.sqrt(np.pi * mu_0 * sigma)
+      matrix[0, :] = 0
+      uniform = False
+   else:
+      raise ValueError("Unknown method " + str(method))
+
+   E_north = np.empty(dB_north.shape)
+   E_east = np.empty(dB_east.shape)
+   for start in range(0, dB_north.shape[0], chunk_stations):
+      chunk = slice(start, start + chunk_stations)
+      if uniform:
+         E_north[chunk] = -_convolve_causal(dB_east[chunk], kernel)
+         E_east[chunk] = _convolve_causal(dB_north[chunk], kernel)
+      else:
+         E_north[chunk] = -np.dot(dB_east[chunk], matrix.T)
+         E_east[chunk] = np.dot(dB_north[chunk], matrix.T)
+   return E_north.reshape(shape), E_east.reshape(shape)
+
+def geoelectric_field_windows(blocks, dt, sigma=1e-3, memory=None):
+   ''' Streams the geoelectric field of long, uniformly sampled series window by window (overlap-save)
+
+   :param blocks:       Iterable of (dB_north, dB_east) blocks [nstations, nblocktimes] of consecutive time windows (T/s)
+   :param dt:           Time step (s)
+   :param sigma:        Ground conductivity (S/m), or a layered model (conductivities, thicknesses)
+   :param memory:       Number of past samples kept for the convolution. None keeps the whole history (exact, but the
+                        work grows with the series); a finite memory truncates the slowly (~1/sqrt(t)) decaying
+                        response and bounds the memory and work per window.
+   :returns: generator of (E_north, E_east) blocks matching the input blocks (method 'liu')
+
+   .. seealso:: :func:`geoelectric_field`
+   '''
+   history_north = None
+   history_east = None
+   for dB_north, dB_east in blocks:
+      dB_north = np.atleast_2d(np.asarray(dB_north, dtype=float))
+      dB_east = np.atleast_2d(np.asarray(dB_east, dtype=float))
+      n = dB_north.shape[-1]
+      if history_north is None:
+         history_north = np.zeros((dB_north.shape[0], 0))
+         history_east = np.zeros((dB_east.shape[0], 0))
+      x_north = np.concatenate((history_north, dB_north), axis=-1)
+      x_east = np.concatenate((history_east, dB_east), axis=-1)
+      m = np.arange(x_north.shape[-1])
+      R = ramp_response(m * dt, sigma)
+      kernel = np.zeros(len(m))
+      kernel[1:] = R[1:] - R[:-1]
+      yield -_convolve_causal(x_east, kernel)[:, -n:], _convolve_causal(x_north, kernel)[:, -n:]
+      if memory is None:
+         history_north, history_east = x_north, x_east
+      else:
+         keep = max(x_north.shape[-1] - memory, 0)
+         history_north, history_east = x_north[:, keep:], x_east[:, keep:]
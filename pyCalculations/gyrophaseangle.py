@@ -43,8 +43,8 @@ def gyrophase_angles_from_file( vlsvReader, cellid):
    pl.hist(result[0].data, weights=result[1].data, bins=100, log=False)
    '''
    # Read the velocity cells:
-   velocity_cell_data = vlsvReader.read_velocity_cells(cellid)
-   if velocity_cell_data == []:
+   vcellids, avgs = vlsvReader.read_velocity_cells_array(cellid)
+   if len(vcellids) == 0:
       from output import output_1d
       return output_1d([[0.0, 1.0], [1.0, 1.0]], ["Gyrophase_angle", "avgs"], ["", ""])
    # Read bulk velocity:
@@ -71,11 +71,9 @@ def gyrophase_angles_from_file( vlsvReader, cellid):
    else:
       from output import output_1d
       return output_1d([[0.0, 1.0], [1.0, 1.0]], ["Gyrophase_angle", "avgs"], ["", ""])
-   # Get cells:
-   vcellids = list(velocity_cell_data.keys())
    # Get a list of velocity coordinates:
    velocity_coordinates = vlsvReader.get_velocity_cell_coordinates(vcellids)
-   return gyrophase_angles(bulk_velocity, B_unit, velocity_cell_data, velocity_coordinates)
+   return gyrophase_angles(bulk_velocity, B_unit, avgs, velocity_coordinates)
 
 
 
@@ -84,6 +82,7 @@ def gyrophase_angles(bulk_velocity, B_unit, velocity_cell_data, velocity_coordin
    
    :param bulk_velocity: TODO
    :param B_unit: TODO
+   :param velocity_cell_data: Velocity cell values, as an array in the order of velocity_coordinates or as a dict (see read_velocity_cells)
    :param velocity_coordinates: TODO
    :param cosine:            True if returning the gyrophase angles as a cosine plot
    :param plasmaframe:       True if the user wants to get the gyrophase angle distribution in the plasma frame, default True
@@ -100,7 +99,10 @@ def gyrophase_angles(bulk_velocity, B_unit, velocity_cell_data, velocity_coordin
    '''
    
    # Get avgs data:
-   avgs = list(velocity_cell_data.values())
+   if isinstance(velocity_cell_data, dict):
+      avgs = list(velocity_cell_data.values())
+   else:
+      avgs = np.asarray(velocity_cell_data)
    # Shift to plasma frame
    if plasmaframe == True:
       velocity_coordinates = velocity_coordinates - bulk_velocity
@@ -98,56 +98,144 @@ def df(ksii, fii):
    res = np.stack((d0,d1,d2),axis = -1)
    return res
 
+# Closed-form solution of the batched 3x3 systems m x = b via the adjugate.
+# Singular systems return non-finite rows instead of raising like np.linalg.solve.
+def solve3(m, b):
+   adj = np.empty_like(m)
+   adj[:,0,0] = m[:,1,1]*m[:,2,2] - m[:,1,2]*m[:,2,1]
+   adj[:,0,1] = m[:,0,2]*m[:,2,1] - m[:,0,1]*m[:,2,2]
+   adj[:,0,2] = m[:,0,1]*m[:,1,2] - m[:,0,2]*m[:,1,1]
+   adj[:,1,0] = m[:,1,2]*m[:,2,0] - m[:,1,0]*m[:,2,2]
+   adj[:,1,1] = m[:,0,0]*m[:,2,2] - m[:,0,2]*m[:,2,0]
+   adj[:,1,2] = m[:,0,2]*m[:,1,0] - m[:,0,0]*m[:,1,2]
+   adj[:,2,0] = m[:,1,0]*m[:,2,1] - m[:,1,1]*m[:,2,0]
+   adj[:,2,1] = m[:,0,1]*m[:,2,0] - m[:,0,0]*m[:,2,1]
+   adj[:,2,2] = m[:,0,0]*m[:,1,1] - m[:,0,1]*m[:,1,0]
+   det = m[:,0,0]*adj[:,0,0] + m[:,0,1]*adj[:,1,0] + m[:,0,2]*adj[:,2,0]
+   with np.errstate(divide='ignore', invalid='ignore'):
+      return np.einsum('nij,nj->ni', adj, b) / det[:,np.newaxis]
+
+# Hexahedra whose trilinear map is affine (parallelepipeds, e.g. all duals away from
+# refinement interfaces) have a closed-form inverse. Returns a mask of such hexahedra
+# and the ksi of the corresponding points.
+def affine_ksi(p, v_coords, rtol = 1e-9):
+   v0 = v_coords[:,0,:]
+   a = v_coords[:,1,:] - v0
+   b = v_coords[:,2,:] - v0
+   c = v_coords[:,4,:] - v0
+   scale = np.maximum(np.maximum(np.linalg.norm(a,axis=1), np.linalg.norm(b,axis=1)), np.linalg.norm(c,axis=1))
+   dev = np.maximum.reduce([np.linalg.norm(v_coords[:,3,:] - (v0+a+b), axis=1),
+                            np.linalg.norm(v_coords[:,5,:] - (v0+a+c), axis=1),
+                            np.linalg.norm(v_coords[:,6,:] - (v0+b+c), axis=1),
+                            np.linalg.norm(v_coords[:,7,:] - (v0+a+b+c), axis=1)])
+   regular = dev <= rtol*scale
+   m = np.stack((a[regular], b[regular], c[regular]), axis=-1)
+   ksi = solve3(m, p[regular] - v0[regular])
+   ok = np.all(np.isfinite(ksi), axis=1)
+   regular[regular] = ok
+   return regular, ksi[ok]
+
+# Corner bits of the hexahedral vertices in the ordering used by f and df
+vertex_bits = np.array([[(i >> 0) & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)], dtype=np.int64)
+vertex_signs = 2.0*vertex_bits - 1.0
+
+# Trilinear weights (N,8) and their derivatives wrt. ksi (N,8,3), for evaluating f and df
+# of many coordinate vectors at once with a single contraction each.
+def trilinear_weights(ksi):
+   lin = np.stack((1-ksi, ksi), axis=1) # (N, 2, 3)
+   lx = lin[:, vertex_bits[:,0], 0]
+   ly = lin[:, vertex_bits[:,1], 1]
+   lz = lin[:, vertex_bits[:,2], 2]
+   w = lx*ly*lz
+   dw = np.stack((vertex_signs[:,0]*ly*lz, vertex_signs[:,1]*lx*lz, vertex_signs[:,2]*lx*ly), axis=-1)
+   return w, dw
+
+# Newton iteration for the trilinear coordinates, starting from ksi_n. Only the unresolved
+# points are kept (contiguously) in the active set, so the work per iteration shrinks
+# with convergence. Returns nans for points that did not converge or diverged.
+def newton_ksi(p, v_coords, ksi_n, tol = .1, maxiters = 200):
+   ksi_out = np.full(p.shape, np.nan)
+   active = np.arange(p.shape[0])
+   pa = p
+   va = v_coords
+   ka = np.array(ksi_n, dtype=float)
+
+   for i in range(maxiters+1):
+      w, dw = trilinear_weights(ka)
+      f_n = np.matmul(w[:,np.newaxis,:], va)[:,0,:] - pa
+      resolved = np.einsum('nc,nc->n', f_n, f_n) < tol*tol
+      ksi_out[active[resolved]] = ka[resolved]
+      if i == maxiters:
+         break
+      keep = ~resolved
+      if not np.any(keep):
+         break
+      if not np.all(keep):
+         active, pa, va, ka, f_n, dw = active[keep], pa[keep], va[keep], ka[keep], f_n[keep], dw[keep]
+
+      J = np.matmul(va.transpose(0,2,1), dw)
+      ka = ka + solve3(J, -f_n)
+
+      # Don't bother if the solution is diverging either
+      keep = np.all(np.isfinite(ka), axis=1) & (np.einsum('nc,nc->n', ka, ka) <= 1e4)
+      if not np.all(keep):
+         active, pa, va, ka = active[keep], pa[keep], va[keep], ka[keep]
+         if active.shape[0] == 0:
+            break
+
+   return ksi_out
+
 # For hexahedral vertices verts and point p, find the trilinear basis coordinates ksi
 # that interpolate the coordinates of verts to the tolerance tol.
-# This is an iterative procedure. Return nans in case of no convergence.
-def find_ksi(p, v_coords, tol= .1, maxiters = 200):
+# Affine hexahedra are solved directly, the rest with an iterative procedure. An explicit initial
+# guess can be given with ksi0. With warm_start, runs of consecutive points sharing the same
+# hexahedron are warm-started from the solution of the first point of the run; this only pays
+# off for strongly distorted hexahedra, as the iteration from the centre usually converges in
+# a few steps. Return nans in case of no convergence.
+def find_ksi(p, v_coords, tol= .1, maxiters = 200, ksi0 = None, warm_start = False):
    p = np.atleast_2d(p)
    v_coords = np.atleast_3d(v_coords)
-   ksi0 = np.full_like(p, 0.5)
-   J = df(ksi0, v_coords)
-   # logging.info("J", J)
-   ksi_n = ksi0
-   ksi_n1 = np.full_like(ksi0, np.nan)
-   f_n =  f(ksi_n,v_coords)
-   # logging.info(f_n.shape, p.shape)
-   # logging.info(f_n)
-   f_n = f_n - p
-
-   resolved = np.full((p.shape[0],),False, dtype=bool)
-   diverged = np.full((p.shape[0],),False, dtype=bool)
-   
-   for i in range(maxiters):
-      
-      J[~resolved,:,:] = df(ksi_n[~resolved,:], v_coords[~resolved,:,:])
-      f_n[~resolved,:] = f(ksi_n[~resolved,:],v_coords[~resolved,:,:])-p[~resolved,:]
-      step = np.linalg.solve(J[~resolved,:,:], -f_n[~resolved,:])
-      ksi_n1[~resolved,:] = step + ksi_n[~resolved,:] # r_(n+1) 
-      ksi_n[~resolved,:] = ksi_n1[~resolved,:]
-      
-      resolved[~resolved] = (np.linalg.norm(f(ksi_n1[~resolved,:],v_coords[~resolved,:,:]) - p[~resolved,:],axis=1) < tol)
-      resolved[~resolved] = np.linalg.norm(ksi_n1[~resolved,:],axis=1) > 1e2 # Don't bother if the solution is diverging either, set to nans later
-         # convergence = True
-      if np.all(resolved):
-         break
-         # diverged = np.linalg.norm(ksi_n1,axis=1) > 1e2
-         # ksi_n1[diverged,:] = np.nan
-         # # logging.info("All converged in ", i, "iterations")
-         # return ksi_n1
-      
+   ksi = np.full(p.shape, np.nan)
+   if p.shape[0] == 0:
+      return ksi
+
+   regular, ksi_regular = affine_ksi(p, v_coords)
+   ksi[regular] = ksi_regular
+
+   todo = np.nonzero(~regular)[0]
+   if todo.shape[0] > 0:
+      pt = p[todo]
+      vt = v_coords[todo]
+      if ksi0 is not None:
+         guess = np.array(np.broadcast_to(ksi0, p.shape)[todo], dtype=float)
+      else:
+         guess = np.full(pt.shape, 0.5)
+
+      followers = np.zeros((todo.shape[0],), dtype=bool)
+      if warm_start and ksi0 is None:
+         followers[1:] = np.all(vt[1:] == vt[:-1], axis=(1,2))
+
+      if np.any(followers):
+         leaders = ~followers
+         ksi_leaders = newton_ksi(pt[leaders], vt[leaders], guess[leaders], tol, maxiters)
+         ksi[todo[leaders]] = ksi_leaders
+
+         # Linearize around the solution of the leading point of each run of identical hexahedra
+         leader_rank = np.cumsum(leaders) - 1
+         kl = ksi_leaders[leader_rank[followers]]
+         w, dw = trilinear_weights(kl)
+         J = np.matmul(vt[followers].transpose(0,2,1), dw)
+         guess_f = kl + solve3(J, pt[followers] - np.matmul(w[:,np.newaxis,:], vt[followers])[:,0,:])
+         bad = ~np.all(np.isfinite(guess_f), axis=1)
+         guess_f[bad,:] = 0.5
+         ksi[todo[followers]] = newton_ksi(pt[followers], vt[followers], guess_f, tol, maxiters)
+      else:
+         ksi[todo] = newton_ksi(pt, vt, guess, tol, maxiters)
+
+   diverged = np.linalg.norm(ksi,axis=1) > 1e2
+   ksi[diverged,:] = np.nan
+   return ksi
 
-   if np.all(resolved):
-      # logging.info("Converged after ", i, "iterations")
-      diverged = np.linalg.norm(ksi_n1,axis=1) > 1e2
-      ksi_n1[diverged,:] = np.nan
-      return ksi_n1
-   else:
-      # warnings.warn("Generalized trilinear interpolation did not converge for " + str(np.sum(~convergence)) + " points. Nans inbound.")
-      diverged = np.linalg.norm(ksi_n1,axis=1) > 1e2
-      ksi_n1[diverged,:] = np.nan
-      ksi_n1[~resolved,:] = np.nan
-      return ksi_n1
-      
 class HexahedralTrilinearInterpolator(object):
    ''' Class for doing general hexahedral interpolation, including degenerate hexahedra (...eventually).
    '''
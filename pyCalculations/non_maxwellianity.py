@@ -3,6 +3,7 @@ from scipy.constants import k, m_e, m_p
 import pytools as pt
 import warnings
 import logging
+import os
 
 import random
 
@@ -49,9 +50,7 @@ def epsilon_M(f,cell,pop="proton",m=m_p, bulk=None, B=None,
     size = f.get_velocity_mesh_size(pop)
     distribution = np.zeros(4 * 4 * 4 * int(size[0]) * int(size[1]) * int(size[2]))
     try:
-        D = f.read_velocity_cells(cell, pop)
-        D_keys = list(D.keys())
-        D_vals = list(D.values())
+        D_keys, D_vals = f.read_velocity_cells_array(cell, pop)
         distribution[D_keys] = D_vals
         distribution[distribution<threshold] = 0
     except:
@@ -163,3 +162,256 @@ def epsilon_M(f,cell,pop="proton",m=m_p, bulk=None, B=None,
 
     return epsilon
 
+
+def _model_power_sum(n, v0, T, T_para, T_perp, bhat, m, model, normorder, mesh_size, vmin, dv, WID):
+    ''' Returns the sum of g_M^normorder over all cells of the velocity mesh, for each cell. The Maxwellian is
+    separable and summed exactly along each axis; the bi-Maxwellian is summed over the infinite lattice of cell
+    centres, assuming that the velocity mesh covers it.
+    '''
+    p = float(normorder)
+    if model == "maxwellian":
+        total = (n * (0.5 * m / (np.pi * k * T))**1.5)**p
+        for i in range(3):
+            centres = vmin[i] + (np.arange(mesh_size[i] * WID) + 0.5) * dv[i]
+            total = total * np.sum(np.exp(-0.5 * p * m * (centres[np.newaxis,:] - v0[:,i,np.newaxis])**2
+                                          / (k * T[:,np.newaxis])), axis=-1)
+        return total
+    elif model == "bimaxwellian":
+        # Poisson summation over the lattice of cell centres, with the Fourier terms of the lowest wave vectors
+        vT_para2 = 2 * k * T_para / m
+        vT_perp2 = vT_para2 * T_perp / T_para
+        total = n**p * (np.pi**1.5 * vT_para2**1.5 * (T_perp / T_para))**(1 - p) * p**-1.5 / np.prod(dv)
+        covariance = (vT_perp2[:,np.newaxis,np.newaxis] * np.identity(3)
+                      + (vT_para2 - vT_perp2)[:,np.newaxis,np.newaxis] * bhat[:,:,np.newaxis] * bhat[:,np.newaxis,:]) / (2 * p)
+        wavenumbers = np.stack(np.meshgrid(*[np.arange(-2, 3)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+        wavevectors = 2 * np.pi * wavenumbers / dv
+        phase = np.dot(vmin + 0.5 * dv - v0, wavevectors.T)
+        return total * np.sum(np.exp(-0.5 * np.einsum('ki,nij,kj->nk', wavevectors, covariance, wavevectors)) * np.cos(phase), axis=-1)
+    else:
+        raise NameError("Unknown VDF model '"+model+"', aborting")
+
+def epsilon_M_from_blocks(block_ids, avgs, offsets, mesh_size, vmin, dv, n, v0, T, T_para, T_perp, B=None, WID=4,
+                          m=m_p, model="bimaxwellian", normorder=1, norm=2, threshold=0):
+    ''' Calculates the non-Maxwellianity parameter of :func:`epsilon_M` for many cells from their velocity blocks.
+
+    :param block_ids:   Velocity block ids of all cells, array [nblocks]
+    :param avgs:        Values of the velocity cells of each block, array [nblocks, WID^3]
+    :param offsets:     Start of the blocks of each spatial cell in block_ids, array [ncells+1]
+    :param mesh_size:   Velocity mesh size in blocks [vxblocks, vyblocks, vzblocks]
+    :param vmin:        Lower corner of the velocity mesh [vxmin, vymin, vzmin]
+    :param dv:          Velocity cell size [dvx, dvy, dvz]
+    :param n, v0, T, T_para, T_perp:  Moments of each cell, arrays [ncells] ([ncells,3] for v0)
+    :param B:           Magnetic field of each cell [ncells,3], required for the bimaxwellian model
+
+    The other keywords are as in :func:`epsilon_M`.
+
+    :returns:           array [ncells], NaN for cells without a velocity distribution
+
+    The model distribution is evaluated only on the stored velocity cells; outside of them the data is zero, so their
+    contribution is the sum of g_M^normorder over the whole mesh minus the part on the stored cells. This is exact for
+    the Maxwellian; for the bi-Maxwellian the sum is taken over an unbounded mesh, which agrees with :func:`epsilon_M`
+    when the velocity mesh covers the model distribution.
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    ncells = len(offsets) - 1
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    block_ids = np.asarray(block_ids, dtype=np.int64)
+    mesh_size = np.asarray(mesh_size, dtype=np.int64)
+    dv = np.asarray(dv, dtype=float)
+    dV = np.prod(dv)
+    f = np.asarray(avgs, dtype=float).reshape(len(block_ids), WID**3)
+    f = np.where(f < threshold, 0, f)
+
+    # Velocities of all stored cells relative to the bulk velocity of their spatial cell
+    local = np.arange(WID**3)
+    cell_offsets = (np.stack((local % WID, (local // WID) % WID, local // WID**2), axis=-1) + 0.5) * dv
+    corners = vmin + np.stack((block_ids % mesh_size[0], (block_ids // mesh_size[0]) % mesh_size[1],
+                               block_ids // (mesh_size[0] * mesh_size[1])), axis=-1) * (WID * dv)
+    segments = np.repeat(np.arange(ncells), counts)
+    v0 = np.asarray(v0, dtype=float).reshape(ncells, 3)
+    dvel = corners[:,np.newaxis,:] + cell_offsets[np.newaxis,:,:] - v0[segments][:,np.newaxis,:]
+    n, T, T_para, T_perp = [np.asarray(x, dtype=float).reshape(ncells) for x in (n, T, T_para, T_perp)]
+
+    def per_block(values):
+        return values[segments][:,np.newaxis]
+
+    bhat = None
+    if model == "maxwellian":
+        model_f = per_block(n * (0.5 * m / (np.pi * k * T))**1.5) * np.exp(-0.5 * m * np.sum(dvel**2, axis=-1) / (k * per_block(T)))
+    elif model == "bimaxwellian":
+        bhat = np.asarray(B, dtype=float).reshape(ncells, 3)
+        bhat = bhat / np.linalg.norm(bhat, axis=-1)[:,np.newaxis]
+        v_para2 = np.einsum('bci,bi->bc', dvel, bhat[segments])**2
+        v_perp2 = np.sum(dvel**2, axis=-1) - v_para2
+        vT_para2 = 2 * k * T_para / m
+        model_f = per_block(n * T_para / (np.pi**1.5 * vT_para2**1.5 * T_perp)) * np.exp(
+            -v_para2 / per_block(vT_para2) - v_perp2 / per_block(vT_para2 * T_perp / T_para))
+    else:
+        raise NameError("Unknown VDF model '"+model+"', aborting")
+
+    def cell_sum(blockvalues):
+        out = np.zeros(ncells)
+        if np.any(nonempty):
+            out[nonempty] = np.add.reduceat(np.sum(blockvalues, axis=-1), offsets[:-1][nonempty])
+        return out
+
+    p = float(normorder)
+    stored = cell_sum(np.abs(f - model_f)**p)
+    outside = _model_power_sum(n, v0, T, T_para, T_perp, bhat, m, model, p, mesh_size, np.asarray(vmin, dtype=float), dv, WID)
+    outside -= cell_sum(model_f**p)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        epsilon = (stored + np.maximum(outside, 0))**(1 / p) * dV / (norm * n)
+    epsilon[~nonempty] = np.nan
+    return epsilon
+
+def _epsilon_M_chunk(f, cells, pop, m, moments, B, model, normorder, norm, threshold):
+    ''' Batched VDF read and non-Maxwellianity of one chunk of cells. Moments are taken from the VDFs if not given.
+    '''
+    from velocitymoments import velocity_moments_from_blocks
+    block_ids, avgs, offsets = f.read_velocity_cells_batch(cells, pop=pop)
+    mesh_size = f.get_velocity_mesh_size(pop)
+    vmin = f.get_velocity_mesh_extent(pop)[0:3]
+    dv = f.get_velocity_mesh_dv(pop)
+    if moments is None:
+        vdf_moments = velocity_moments_from_blocks(block_ids, avgs, offsets, mesh_size, vmin, dv, f.get_WID(), mass=m)
+        n = vdf_moments["rho"]
+        v0 = vdf_moments["v"]
+        P = vdf_moments["ptensor"]
+        trace = np.trace(P, axis1=1, axis2=2)
+        T = trace / (3.0 * n * k)
+        if B is not None:
+            bhat = B / np.linalg.norm(B, axis=-1)[:,np.newaxis]
+            P_para = np.einsum('ni,nij,nj->n', bhat, P, bhat)
+            T_para = P_para / (n * k)
+            T_perp = (trace - P_para) / (2.0 * n * k)
+        else:
+            T_para = T_perp = T
+    else:
+        n, v0, T, T_para, T_perp = moments
+    return epsilon_M_from_blocks(block_ids, avgs, offsets, mesh_size, vmin, dv, n, v0, T, T_para, T_perp, B, f.get_WID(),
+                                 m=m, model=model, normorder=normorder, norm=norm, threshold=threshold)
+
+def _epsilon_M_worker(args):
+    ''' Process pool worker, opens its own reader for the file
+    '''
+    return _epsilon_M_chunk(pt.vlsvfile.VlsvReader(args[0]), *args[1:])
+
+def _magnetic_field(readers, cells):
+    ''' Batched read of the magnetic field from the first reader that has it
+    '''
+    for reader in readers:
+        for name in ("B", "vg_b_vol"):
+            if reader is not None and reader.check_variable(name):
+                return np.asarray(reader.read_variable(name, cellids=cells), dtype=float).reshape(len(cells), 3)
+    return None
+
+def _epsilon_M_sidecar(f, pop, model, cache):
+    ''' Returns the name of the sidecar cache file
+    '''
+    if isinstance(cache, str):
+        return cache
+    return f.file_name + ".epsilon_M_" + pop.replace("/", "_") + "_" + model + ".npz"
+
+def epsilon_M_cells(f, cellids=None, pop="proton", m=None, bulk=None, B=None,
+                    model="bimaxwellian", normorder=1, norm=2, threshold=0,
+                    processes=1, chunk_size=256, cache=None):
+    ''' Calculates the non-Maxwellianity parameter of :func:`epsilon_M` for many cells at once, with batched VDF and
+    moment reads.
+
+    :param f:           VlsvReader containing VDF data
+    :param cellids:     List of CellIDs, by default all cells with VDFs of the population
+
+    :kword pop:         Population to calculate the parameter for
+    :kword m:           Species mass (default: from vlsvvariables.speciesamu)
+    :kword bulk:        Bulk file name or VlsvReader to read the moments from. By default the moments are calculated
+                        from the VDFs.
+    :kword B:           Optional, user-given magnetic field, a single vector or one per cell [N,3]
+    :kword model:       VDF model to be used. Available models "maxwellian", "bimaxwellian" (default)
+    :kword normorder:   Norm used for model-data distance measure (default: 1)
+    :kword norm:        Constant norm (default 2)
+    :kword threshold:   Disregard vspace cells under this threshold [0]
+    :kword processes:   Number of worker processes, each reading its own chunks of cells
+    :kword chunk_size:  Number of cells read and reduced at once
+    :kword cache:       Sidecar .npz file caching the results next to the VDF file. True reads and writes
+                        <file>.epsilon_M_<pop>_<model>.npz, a file name uses that file, None (default) only reads an
+                        existing sidecar and False disables the cache.
+
+    :returns:           array [N], NaN for cells without a VDF
+
+    .. seealso:: :func:`epsilon_M` :func:`epsilon_M_from_blocks`
+    '''
+    if cellids is None:
+        cellids = f.read(mesh="SpatialGrid", tag="CELLSWITHBLOCKS", name=pop)
+    cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+    if m is None:
+        import vlsvvariables
+        m = vlsvvariables.speciesamu[pop] * m_p
+
+    # The cache is valid for one version of the file and one set of parameters
+    sidecar = None
+    cached_cells = np.zeros(0, dtype=np.int64)
+    cached_values = np.zeros(0)
+    if cache is not False:
+        sidecar = _epsilon_M_sidecar(f, pop, model, cache)
+        stat = os.stat(f.file_name)
+        key = np.array([stat.st_size, stat.st_mtime, m, normorder, norm, threshold])
+        bulkname = "" if bulk is None else (bulk if isinstance(bulk, str) else bulk.file_name)
+        if B is None and os.path.isfile(sidecar):
+            try:
+                with np.load(sidecar) as data:
+                    if np.array_equal(data["key"], key) and str(data["bulk"]) == bulkname:
+                        cached_cells = data["cellids"]
+                        cached_values = data["epsilon_M"]
+            except Exception:
+                warnings.warn("Could not read the non-Maxwellianity cache "+sidecar)
+    epsilon = np.full(len(cellids), np.nan)
+    found = np.isin(cellids, cached_cells)
+    if np.any(found):
+        epsilon[found] = cached_values[np.searchsorted(cached_cells, cellids[found])]
+    cells, first = np.unique(cellids[~found], return_index=True)
+
+    if len(cells) > 0:
+        bulkReader = bulk
+        if isinstance(bulk, str):
+            bulkReader = pt.vlsvfile.VlsvReader(bulk)
+        if B is None:
+            B = _magnetic_field((f, bulkReader), cells)
+            if B is None and model == "bimaxwellian":
+                raise ValueError("No B found for the bimaxwellian model, give it explicitly")
+        else:
+            # A user-given field is not stored in the cache
+            sidecar = None
+            B = np.asarray(B, dtype=float)
+            B = np.tile(B, (len(cells), 1)) if B.ndim == 1 else B.reshape(len(cellids), 3)[first]
+        moments = None
+        if bulkReader is not None:
+            moments = [np.asarray(bulkReader.read_variable(pop+name, cellids=cells), dtype=float).reshape(len(cells), -1)
+                       for name in ("/vg_rho", "/vg_v", "/vg_temperature", "/vg_t_parallel", "/vg_t_perpendicular")]
+            moments = [x[:,0] if x.shape[1] == 1 else x for x in moments]
+
+        chunks = [np.arange(i, min(i+chunk_size, len(cells))) for i in range(0, len(cells), chunk_size)]
+        def chunk_args(c):
+            return (cells[c], pop, m, None if moments is None else [x[c] for x in moments], None if B is None else B[c],
+                    model, normorder, norm, threshold)
+        if processes <= 1 or len(chunks) <= 1:
+            results = [_epsilon_M_chunk(f, *chunk_args(c)) for c in chunks]
+        else:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            results = pool.map(_epsilon_M_worker, [(f.file_name,) + chunk_args(c) for c in chunks])
+            pool.close()
+            pool.join()
+        values = np.concatenate(results)
+        epsilon[~found] = values[np.searchsorted(cells, cellids[~found])]
+
+        if sidecar is not None and cache is not None:
+            all_cells = np.concatenate((cached_cells, cells))
+            all_values = np.concatenate((cached_values, values))
+            order = np.argsort(all_cells)
+            try:
+                with open(sidecar, 'wb') as handle:
+                    np.savez(handle, key=key, bulk=bulkname, cellids=all_cells[order], epsilon_M=all_values[order])
+            except Exception:
+                warnings.warn("Could not write the non-Maxwellianity cache "+sidecar)
+    return epsilon
@@ -25,6 +25,7 @@ import pytools as pt
 import numpy as np
 import sys, os
 from output import output_1d
+from vdfhistogram import histogram1d
 import logging
 
 def pitch_angles( vlsvReader,
@@ -161,9 +162,7 @@ def pitch_angles( vlsvReader,
       vcutoffmax = np.inf
 
    # Read the velocity cells:
-   velocity_cell_data = vlsvReader.read_velocity_cells(cellid, pop=pop)
-   vcellids = list(velocity_cell_data.keys())
-   avgs = list(velocity_cell_data.values())
+   vcellids, avgs = vlsvReader.read_velocity_cells_array(cellid, pop=pop)
 
    # Transform to a frame
    v = vlsvReader.get_velocity_cell_coordinates(vcellids, pop=pop) - frame
@@ -205,7 +204,8 @@ def pitch_angles( vlsvReader,
    pitch_nonsphere = np.extract(condition, pitch_angles)
 
    # Generate a histogram
-   weights, angles = np.histogram(pitch_nonsphere, nbins, range=pitchrange, weights=avgs_nonsphere )
+   angles = np.linspace(pitchrange[0], pitchrange[1], nbins+1)
+   weights = histogram1d(pitch_nonsphere, angles, weights=avgs_nonsphere)[0]
 
    # Wrap the data into a custon format
    result = output_1d([angles, weights], ["Pitch_angle", "sum_avgs"], [units, "1/m3"])
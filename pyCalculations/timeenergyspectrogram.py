@@ -0,0 +1,301 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Omnidirectional time-energy spectrograms of a set of spatial cells over a series of files.
+
+   Each file is processed independently (optionally in a process pool): the VDFs of all requested cells are read
+   in one batch and histogrammed with :func:`vdf_histograms`. Finished files can be stored in a checkpoint, so that
+   an interrupted run resumes where it stopped.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt, glob
+      files = sorted(glob.glob("/path/to/run/bulk/bulk.*.vlsv"))
+      result = pt.calculations.time_energy_spectrogram(files, coordinates=[[10e7,0,0],[12e7,0,0]], processes=8,
+                                                       checkpoint="spectrogram_checkpoint.npz", output="spectrogram.npz")
+      pl.pcolormesh(result["times"], result["edges"], result["spectra"][:,0,:].T)
+
+'''
+
+import numpy as np
+import logging
+import os
+import time
+from vdfhistogram import vdf_histograms
+
+def file_time(vlsvReader):
+   ''' Returns the simulation time of a file, from the parameter "t" or "time"
+
+   :param vlsvReader:   Some VlsvReader with a file open
+   :returns: simulation time, NaN if not found
+   '''
+   t = vlsvReader.read_parameter('t')
+   if t is None:
+      t = vlsvReader.read_parameter('time')
+   if t is None:
+      return np.nan
+   return float(t)
+
+def sparsity_threshold(vlsvReader, cellids, pop="proton", fMin=1e-15):
+   ''' Returns the sparsity threshold of the velocity distributions of some cells
+
+   :param vlsvReader:   Some VlsvReader with a file open
+   :param cellids:      List of cell IDs
+   :param pop:          Population name
+   :param fMin:         Threshold used if the file does not store one
+   :returns: array of thresholds [N], or fMin
+   '''
+   for name in ('MinValue', pop+'/effectivesparsitythreshold', pop+'/vg_effectivesparsitythreshold'):
+      if vlsvReader.check_variable(name):
+         return np.asarray(vlsvReader.read_variable(name, cellids), dtype=float).reshape(-1)
+   return fMin
+
+def energy_spectra(vlsvReader, cellids, edges, pop="proton", fMin=1e-15, mass=None):
+   ''' Returns the omnidirectional differential particle flux spectra of many cells of one file
+
+   :param vlsvReader:   Some VlsvReader with a file open
+   :param cellids:      List of cell IDs
+   :param edges:        Kinetic energy bin edges in eV. Energies outside the edges are counted in the first and last bins.
+   :param pop:          Population name
+   :param fMin:         Sparsity threshold used if the file does not store one
+   :param mass:         Particle mass, by default from vlsvvariables.speciesamu
+   :returns: spectra [N, len(edges)-1] in 1/(m^2 s sr eV), NaN for cells without a velocity distribution
+
+   .. seealso:: :func:`vdf_histograms` :func:`get_spectrum_energy`
+   '''
+   cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+   edges = np.asarray(edges, dtype=float)
+   with_vdf = np.isin(cellids, vlsvReader.read(mesh="SpatialGrid", tag="CELLSWITHBLOCKS", name=pop))
+   spectra = np.full((len(cellids), len(edges)-1), np.nan)
+   if np.any(with_vdf):
+      thresholds = sparsity_threshold(vlsvReader, cellids[with_vdf], pop, fMin)
+      histograms, edges = vdf_histograms(vlsvReader, cellids[with_vdf], "energy", edges, pop=pop, fMin=thresholds,
+                                         weight="flux", mass=mass, clip=True)
+      spectra[with_vdf] = histograms / np.diff(edges)[np.newaxis,:]
+   return spectra
+
+def bulk_parameters(vlsvReader, cellids, variables):
+   ''' Reads bulk parameters of some cells as a flat table
+
+   :param vlsvReader:   Some VlsvReader with a file open
+   :param cellids:      List of cell IDs
+   :param variables:    List of variable names, or (name, index) pairs selecting one element of the flattened
+                        variable, e.g. ("TTensorRotated", 4) for the second diagonal element
+   :returns: array [N, ncolumns] with all elements of each variable (or the selected element) as columns
+   '''
+   cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+   columns = []
+   for variable in variables:
+      if isinstance(variable, str):
+         name, index = variable, None
+      else:
+         name, index = variable
+      data = np.asarray(vlsvReader.read_variable(name, cellids), dtype=float).reshape(len(cellids), -1)
+      columns.append(data if index is None else data[:, [index]])
+   return np.concatenate(columns, axis=1)
+
+def write_spectra_text(file_name, cellids, t, edges, spectra):
+   ''' Writes the spectra of one file as text columns, one column per cell: cell id, time, number of bin edges,
+       bin edges, number of bins and the spectrum
+   '''
+   columns = []
+   for i in range(len(cellids)):
+      column = [str(cellids[i]).zfill(17), '%+.10e' % t, str(len(edges)).zfill(17)]
+      column += ['%+.10e' % e for e in edges]
+      column.append(str(spectra.shape[1]).zfill(17))
+      column += ['%+.10e' % s for s in spectra[i]]
+      columns.append(column)
+   logging.info('writing: ' + file_name)
+   with open(file_name, 'w') as f_handle:
+      np.savetxt(f_handle, np.column_stack(columns), fmt='%s')
+
+def write_bulk_text(file_name, cellids, t, bulk):
+   ''' Writes the bulk parameters of one file as text columns, one column per cell: cell id, time and the parameters
+   '''
+   columns = [[str(cellids[i]).zfill(17), '%+.10e' % t] + ['%+.10e' % p for p in bulk[i]] for i in range(len(cellids))]
+   logging.info('writing: ' + file_name)
+   with open(file_name, 'w') as f_handle:
+      np.savetxt(f_handle, np.column_stack(columns), fmt='%s')
+
+def _spectrogram_file(file_name, cellids, edges, pop, fMin, mass, bulkvariables):
+   ''' Spectra (and bulk parameters) of one file
+   '''
+   from vlsvreader import VlsvReader
+   start = time.time()
+   vlsvReader = VlsvReader(file_name)
+   t = file_time(vlsvReader)
+   spectra = energy_spectra(vlsvReader, cellids, edges, pop, fMin, mass)
+   bulk = None
+   if bulkvariables is not None:
+      bulk = bulk_parameters(vlsvReader, cellids, bulkvariables)
+   return t, spectra, bulk, time.time() - start
+
+def _spectrogram_worker(args):
+   ''' Process pool worker, opens its own reader for the file. Errors are returned instead of raised, so that one
+       unreadable file does not stop the others.
+   '''
+   try:
+      return (args[0],) + _spectrogram_file(*args[1:]) + (None,)
+   except Exception as e:
+      return (args[0], None, None, None, 0., repr(e))
+
+def _save_arrays(file_name, arrays):
+   ''' Saves arrays as an .npz file through a temporary file, so that an interrupted write keeps the previous one
+   '''
+   temporary = file_name + '.tmp'
+   with open(temporary, 'wb') as f_handle:
+      np.savez(f_handle, **arrays)
+   os.replace(temporary, file_name)
+
+def load_time_energy_spectrogram(file_name):
+   ''' Loads a spectrogram written by :func:`time_energy_spectrogram` (output or checkpoint)
+
+   :param file_name:    Name of the .npz file
+   :returns: dictionary with the same arrays as returned by :func:`time_energy_spectrogram`
+   '''
+   with np.load(file_name) as data:
+      result = {name: data[name] for name in data.files}
+   result["files"] = [str(f) for f in result["files"]]
+   return result
+
+def time_energy_spectrogram(vlsvFiles, cellids=None, coordinates=None, pop="proton", edges=np.logspace(2, np.log10(80e3), 66),
+                            fMin=1e-15, mass=None, bulkvariables=None, processes=1, checkpoint=None, checkpoint_interval=60.,
+                            output=None, textprefix=None, bulkprefix=None):
+   ''' Builds omnidirectional time-energy spectrograms of some spatial cells from a series of files
+
+   :param vlsvFiles:     List of file names, one per time
+   :param cellids:       List of cell IDs with velocity distributions
+   :param coordinates:   Alternatively, coordinates [N,3]; the nearest cells with velocity distributions in the first
+                         file are used
+   :param pop:           Population name
+   :param edges:         Kinetic energy bin edges in eV
+   :param fMin:          Sparsity threshold used if the files do not store one
+   :param mass:          Particle mass, by default from vlsvvariables.speciesamu
+   :param bulkvariables: Optional list of bulk parameters to read for the same cells, see :func:`bulk_parameters`
+   :param processes:     Number of worker processes, each processing its own files
+   :param checkpoint:    Name of an .npz file holding the finished files. If it exists, those files are not
+                         processed again. It is updated at most every checkpoint_interval seconds, and at the end.
+   :param checkpoint_interval: Minimum time in seconds between checkpoint writes
+   :param output:        Name of an .npz file to write the result into
+   :param textprefix:    If given, the spectra of each file are also written as text into
+                         <textprefix>_<file basename>.dat (the format of scripts/create_time_energy_spectrogram.py)
+   :param bulkprefix:    Like textprefix, for the bulk parameters
+   :returns: dictionary with "files", "cellids" [N], "edges" [nbins+1], "times" [T], "spectra" [T,N,nbins]
+             in 1/(m^2 s sr eV), "done" [T] (files processed successfully, files that fail are logged and left
+             undone), "seconds" [T] (processing time of each
+             file) and "bulk" [T,N,ncolumns] if bulkvariables are given
+
+   .. code-block:: python
+
+      # Example usage:
+      result = time_energy_spectrogram(files, cellids=[4502051,4951951], processes=4, output="spectrogram.npz")
+      result = load_time_energy_spectrogram("spectrogram.npz")
+
+   .. seealso:: :func:`energy_spectra` :func:`vdf_histograms`
+   '''
+   vlsvFiles = [str(f) for f in vlsvFiles]
+   edges = np.asarray(edges, dtype=float)
+   if cellids is None:
+      if coordinates is None:
+         raise ValueError("Either cellids or coordinates must be given")
+      from vlsvreader import VlsvReader
+      vlsvReader = VlsvReader(vlsvFiles[0])
+      coordinates = np.atleast_2d(np.asarray(coordinates, dtype=float))
+      nearest = np.atleast_1d(vlsvReader.get_cellid_with_vdf(coordinates, pop=pop))
+      for i in range(len(coordinates)):
+         logging.info('Point ' + str(i+1) + '/' + str(len(coordinates)) + ': ' + str(coordinates[i])
+                      + ', nearest vspace ' + str(nearest[i]) + ' at ' + str(vlsvReader.get_cell_coordinates(nearest[i])))
+      cellids = nearest
+   cellids = np.unique(np.asarray(cellids, dtype=np.int64))
+
+   ntimes = len(vlsvFiles)
+   result = {"files": vlsvFiles, "cellids": cellids, "edges": edges, "done": np.zeros(ntimes, dtype=bool),
+             "times": np.full(ntimes, np.nan), "spectra": np.full((ntimes, len(cellids), len(edges)-1), np.nan),
+             "seconds": np.zeros(ntimes)}
+   if checkpoint is not None and os.path.isfile(checkpoint):
+      previous = load_time_energy_spectrogram(checkpoint)
+      if (previous["files"] != vlsvFiles or not np.array_equal(previous["cellids"], cellids)
+          or not np.array_equal(previous["edges"], edges) or (("bulk" in previous) != (bulkvariables is not None))):
+         raise ValueError("Checkpoint " + checkpoint + " was written for different files, cells or settings")
+      result = previous
+      logging.info('Resuming from ' + checkpoint + ': ' + str(np.count_nonzero(result["done"])) + '/' + str(ntimes) + ' files done')
+
+   pending = []
+   for i in range(ntimes):
+      if result["done"][i]:
+         continue
+      if not os.path.isfile(vlsvFiles[i]):
+         logging.info('ERROR: file not found: ' + vlsvFiles[i])
+         continue
+      pending.append((i, vlsvFiles[i], cellids, edges, pop, fMin, mass, bulkvariables))
+
+   if processes <= 1 or len(pending) <= 1:
+      pool = None
+      results = (_spectrogram_worker(args) for args in pending)
+   else:
+      from multiprocessing import Pool
+      pool = Pool(processes)
+      results = pool.imap_unordered(_spectrogram_worker, pending)
+
+   start = time.time()
+   saved = start
+   unsaved = False
+   try:
+      for count, (i, t, spectra, bulk, seconds, error) in enumerate(results):
+         if error is not None:
+            logging.info('ERROR: could not process ' + vlsvFiles[i] + ': ' + error)
+            continue
+         result["times"][i] = t
+         result["spectra"][i] = spectra
+         if bulk is not None:
+            if "bulk" not in result:
+               result["bulk"] = np.full((ntimes,) + bulk.shape, np.nan)
+            result["bulk"][i] = bulk
+         result["seconds"][i] = seconds
+         result["done"][i] = True
+         logging.info('Spectra ' + str(count+1) + '/' + str(len(pending)) + ': ' + vlsvFiles[i] + ' in '
+                      + '%.2f' % seconds + ' s (total ' + '%.1f' % (time.time()-start) + ' s)')
+         name = os.path.basename(vlsvFiles[i])
+         if textprefix is not None:
+            write_spectra_text(textprefix + '_' + name + '.dat', cellids, t, edges, spectra)
+         if bulkprefix is not None and bulk is not None:
+            write_bulk_text(bulkprefix + '_' + name + '.dat', cellids, t, bulk)
+         unsaved = True
+         if checkpoint is not None and time.time() - saved >= checkpoint_interval:
+            _save_arrays(checkpoint, result)
+            saved = time.time()
+            unsaved = False
+   finally:
+      # Also keeps the finished files of an interrupted run
+      if checkpoint is not None and unsaved:
+         _save_arrays(checkpoint, result)
+   if pool is not None:
+      pool.close()
+      pool.join()
+
+   if output is not None:
+      compact = dict(result)
+      compact["spectra"] = result["spectra"].astype(np.float32)
+      _save_arrays(output, compact)
+   return result
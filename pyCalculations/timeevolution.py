@@ -97,3 +97,93 @@ def cell_time_evolution( vlsvReader_list, variables, cellids, units="" ):
                      parameter_units + [units[(int)(i)%(int)(len(units))] for i in range(len(data)-len(parameters))] )
 
 
+
+def _read_cells_of_file( file_name, variables, operators, cellids ):
+   ''' Reads the variables of some cells from one file, returns the time, the data [ncells, ncolumns] per variable
+       and the number of components of each variable. Returns None if the file can not be read.
+   '''
+   from vlsvreader import VlsvReader
+   try:
+      vlsvReader = VlsvReader(file_name)
+      vlsvReader.optimize_open_file()
+      t = vlsvReader.read_parameter("t")
+      if t is None:
+         t = vlsvReader.read_parameter("time")
+      columns = []
+      for variable, operator in zip(variables, operators):
+         data = vlsvReader.read_variable(variable, cellids=cellids, operator=operator)
+         columns.append(np.asarray(data, dtype=float).reshape(len(cellids), -1))
+      vlsvReader.optimize_close_file()
+   except Exception as e:
+      logging.info("Could not read " + str(file_name) + ": " + str(e))
+      return None
+   return (np.nan if t is None else float(t)), np.concatenate(columns, axis=1), [c.shape[1] for c in columns]
+
+def _read_cells_of_file_worker( args ):
+   ''' Process pool worker
+   '''
+   return _read_cells_of_file(*args)
+
+def cell_time_evolution_array( file_names, variables, cellids, operators=None, processes=1 ):
+   ''' Reads variable data of some cells from many files into one array, optionally in parallel
+
+       :param file_names:   List of vlsv file names, one per time
+       :param variables:    Name of the variables
+       :param cellids:      List of cell ids
+       :param operators:    List of operators for the variables, e.g. "x" or "magnitude" (OPTIONAL, default "pass")
+       :param processes:    Number of worker processes, each reading whole files
+       :returns: a dictionary with "times" [T] (file times), "data" [T, ncells, ncolumns], "columns" (names of the
+                 columns, a vector variable without an operator gives one column per component, e.g. "vg_v[0]") and "valid" [T].
+                 Files that can not be read are NaN with valid False.
+
+       .. code-block:: python
+
+          import pytools as pt; import glob
+          # Example of usage:
+          files = sorted(glob.glob("bulk.*.vlsv"))
+          evolution = pt.calculations.cell_time_evolution_array( files, ["vg_rho", "vg_b_vol"], [2,4], operators=["pass","magnitude"], processes=8 )
+          rho = evolution["data"][:,:,0]
+
+       .. seealso:: :func:`cell_time_evolution`
+   '''
+   variables = list(np.atleast_1d(variables))
+   cellids = np.atleast_1d(cellids)
+   if operators is None:
+      operators = ["pass" for i in range(len(variables))]
+   tasks = [(file_name, variables, operators, cellids) for file_name in file_names]
+
+   if processes <= 1 or len(tasks) <= 1:
+      results = map(_read_cells_of_file_worker, tasks)
+   else:
+      from multiprocessing import Pool
+      pool = Pool(processes)
+      results = pool.imap(_read_cells_of_file_worker, tasks)
+
+   times = np.full(len(tasks), np.nan)
+   valid = np.zeros(len(tasks), dtype=bool)
+   data = None
+   columns = None
+   for i, result in enumerate(results):
+      if result is None:
+         continue
+      if data is None:
+         data = np.full((len(tasks), len(cellids), result[1].shape[1]), np.nan)
+         columns = []
+         for j in range(len(variables)):
+            if result[2][j] > 1:
+               columns += [variables[j] + "[" + str(c) + "]" for c in range(result[2][j])]
+            else:
+               columns.append(variables[j] if operators[j] == "pass" else variables[j] + "." + operators[j])
+      times[i] = result[0]
+      data[i] = result[1]
+      valid[i] = True
+      if (i+1) % 100 == 0:
+         logging.info("Read " + str(i+1) + "/" + str(len(tasks)) + " files")
+   if processes > 1 and len(tasks) > 1:
+      pool.close()
+      pool.join()
+
+   if data is None:
+      data = np.full((len(tasks), len(cellids), len(variables)), np.nan)
+      columns = variables
+   return {"times": times, "data": data, "columns": columns, "valid": valid}
@@ -0,0 +1,210 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+''' Variables at arbitrary times between the files of a run.
+
+   A TimeInterpolator keeps a sliding window of readers around the requested times. The variables needed from each
+   file are read once into the reader's variable cache (see :func:`VlsvReader.read_variable_to_cache`), and
+   readers falling out of the window are dropped together with their caches, so the memory use stays bounded while
+   the time cursor moves through the run.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      series = pt.calculations.TimeInterpolator("/path/to/run/", window=4, method="cubic")
+      for t in np.arange(1000.0, 1100.0, 0.1):
+         B = series.read_interpolated_variable("vg_b_vol", t, coords=spacecraft_position(t))
+
+'''
+
+import numpy as np
+import logging
+from collections import OrderedDict
+
+def lagrange_weights(times, t):
+   ''' Returns the weights of the Lagrange polynomial through the given times, evaluated at t
+
+   :param times:        Distinct times of the samples
+   :param t:            Time to evaluate at
+   :returns: array of weights, one per sample
+   '''
+   times = np.asarray(times, dtype=float)
+   weights = np.ones(len(times))
+   for j in range(len(times)):
+      for k in range(len(times)):
+         if k != j:
+            weights[j] *= (t - times[k]) / (times[j] - times[k])
+   return weights
+
+class TimeInterpolator(object):
+   ''' Class for reading variables interpolated in time (and space) from a series of files
+   '''
+
+   def __init__(self, files, times=None, window=4, method="linear", pattern="bulk.*.vlsv"):
+      ''' Opens a series of files
+
+      :param files:        Directory of the run, a glob pattern, a list of file names or a VlsvRun
+      :param times:        Simulation times of the files, read from the files by default
+      :param window:       Maximum number of readers (with their cached variables) kept open
+      :param method:       Interpolation in time, "linear" (between the two nearest files) or "cubic" (Lagrange
+                           polynomial through the four nearest files)
+      :param pattern:      Pattern of the file names when files is a directory
+      '''
+      from vlsvrun import VlsvRun
+      if isinstance(files, VlsvRun):
+         self.run = files
+      else:
+         self.run = VlsvRun(files, pattern=pattern, max_open=window)
+      if method not in ("linear", "cubic"):
+         raise ValueError("Unknown time interpolation method " + str(method))
+      self.method = method
+      self.window = max(window, 4 if method == "cubic" else 2)
+
+      if times is None:
+         times = self.run.get_times()
+      self.times = np.array(times, dtype=float)
+      if len(self.times) != len(self.run):
+         raise ValueError("Got " + str(len(self.times)) + " times for " + str(len(self.run)) + " files")
+      if np.any(np.isnan(self.times)):
+         raise ValueError("Files without a time parameter: " + str(np.array(self.run.file_names)[np.isnan(self.times)]))
+      self.__order = np.argsort(self.times, kind="stable")
+      if np.any(np.diff(self.times[self.__order]) <= 0):
+         raise ValueError("The times of the files are not distinct")
+      self.__readers = OrderedDict()
+
+   def __len__(self):
+      return len(self.times)
+
+   def get_times(self):
+      ''' Returns the sorted times of the files
+      '''
+      return self.times[self.__order]
+
+   def reader(self, index):
+      ''' Returns the reader of a file in the window, opening it (and evicting the least recently used one) if needed
+
+      :param index:        Index of the file in time order
+      '''
+      if index in self.__readers:
+         self.__readers.move_to_end(index)
+         return self.__readers[index]
+      f = self.run.reader(int(self.__order[index]))
+      self.__readers[index] = f
+      while len(self.__readers) > self.window:
+         old_index, old = self.__readers.popitem(last=False)
+         old.variable_cache = {}
+         logging.info("Dropped " + old.file_name + " from the time window")
+      return f
+
+   def stencil(self, t, method=None):
+      ''' Returns the files and weights for interpolating to time t
+
+      :param t:            Time
+      :param method:       "linear" or "cubic", by default the method of the interpolator
+      :returns: indices of the files in time order and their weights
+      '''
+      times = self.get_times()
+      if t < times[0] or t > times[-1]:
+         raise ValueError("Time " + str(t) + " is outside the files, " + str(times[0]) + " - " + str(times[-1]))
+      if method is None:
+         method = self.method
+      i = min(np.searchsorted(times, t, side="right") - 1, len(times) - 2)
+      if len(times) == 1:
+         return np.array([0]), np.array([1.0])
+      if method == "cubic" and len(times) >= 4:
+         first = min(max(i - 1, 0), len(times) - 4)
+         indices = np.arange(first, first + 4)
+      else:
+         indices = np.array([i, i + 1])
+      weights = lagrange_weights(times[indices], t)
+      nonzero = weights != 0
+      return indices[nonzero], weights[nonzero]
+
+   def __cache(self, f, name, operator):
+      # fsgrid interpolation applies the operator after interpolating, so fsgrid data is cached as is
+      key = (name, "pass") if name[0:3] == "fg_" else (name, operator)
+      if not key in f.variable_cache:
+         f.read_variable_to_cache(key[0], operator=key[1])
+
+   def read_interpolated_variable(self, name, t, coords=None, cellids=-1, operator="pass", method=None, spatial_method="linear"):
+      ''' Reads a variable interpolated to time t
+
+      :param name:         Name of the variable (vg, fg_ or ig_)
+      :param t:            Time
+      :param coords:       Coordinates [N,3] to interpolate to in space, see :func:`VlsvReader.read_interpolated_variable`
+      :param cellids:      Cell ids to read when no coordinates are given, -1 for all cells (vg variables only with cell ids,
+                           which requires identical cell ids in the files)
+      :param operator:     Datareduction operator
+      :param method:       "linear" or "cubic" in time, by default the method of the interpolator
+      :param spatial_method: "linear" or "nearest" in space
+      :returns: numpy array with the data
+
+      .. seealso:: :func:`VlsvReader.read_interpolated_variable` :func:`VlsvReader.read_variable`
+      '''
+      indices, weights = self.stencil(t, method)
+      result = 0
+      for index, weight in zip(indices, weights):
+         f = self.reader(index)
+         self.__cache(f, name, operator)
+         if coords is not None:
+            values = f.read_interpolated_variable(name, coords, operator=operator, method=spatial_method)
+         else:
+            values = f.read_variable(name, cellids=cellids, operator=operator)
+         result = result + weight * np.asarray(values, dtype=float)
+      return result
+
+   def read_interpolated_points(self, name, times, coords, operator="pass", method=None, spatial_method="linear"):
+      ''' Reads a variable along a trajectory of (t, x) points, e.g. a virtual spacecraft
+
+      :param name:         Name of the variable
+      :param times:        Times of the points [N], processed in time order so that each file is loaded once
+      :param coords:       Coordinates of the points [N,3]
+      :param operator:     Datareduction operator
+      :param method:       "linear" or "cubic" in time, by default the method of the interpolator
+      :param spatial_method: "linear" or "nearest" in space
+      :returns: array [N] or [N, ncomponents]
+      '''
+      times = np.atleast_1d(np.asarray(times, dtype=float))
+      coords = np.reshape(np.asarray(coords, dtype=float), (-1, 3))
+      result = None
+      # Points sharing the same stencil are interpolated together
+      stencils = [tuple(self.stencil(t, method)[0]) for t in times]
+      order = np.argsort(times, kind="stable")
+      groups = OrderedDict()
+      for p in order:
+         groups.setdefault(stencils[p], []).append(p)
+      for stencil, points in groups.items():
+         points = np.array(points)
+         values = 0
+         for p_weights, index in zip(np.array([self.stencil(times[p], method)[1] for p in points]).T, stencil):
+            f = self.reader(index)
+            self.__cache(f, name, operator)
+            data = np.reshape(f.read_interpolated_variable(name, coords[points], operator=operator, method=spatial_method),
+                              (len(points), -1))
+            values = values + p_weights[:,np.newaxis] * data
+         if result is None:
+            result = np.full((len(times), values.shape[1]), np.nan)
+         result[points] = values
+      return result.squeeze(axis=1) if result.shape[1] == 1 else result
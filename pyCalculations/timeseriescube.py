@@ -0,0 +1,300 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+''' On-disk time-series cubes: variables of selected cells over a series of files, stored for fast access along time.
+
+   The cells are split into chunks, each stored in its own raw binary file as [time, cell, column] rows. A new time
+   step appends one row block to every chunk file, so the cube grows incrementally as new files appear, while the full
+   time series of a cell is read from its chunk file alone and a snapshot is one contiguous block per chunk file.
+   The index (cells, columns, files and times) is an .npz file next to the chunk files.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt, glob
+      cube = pt.calculations.time_series_cube("cube/", sorted(glob.glob("bulk.*.vlsv")), ["vg_rho", "vg_b_vol"],
+                                              cellids=cids, processes=8)
+      # ... later, after more files have been written, add only the new ones:
+      cube = pt.calculations.time_series_cube("cube/", sorted(glob.glob("bulk.*.vlsv")))
+      rho = cube.cell_series([1111, 1112], columns="vg_rho")   # [T, 2, 1]
+      snapshot = cube.snapshot(cube.time_index(650.0))         # [ncells, ncolumns]
+
+'''
+
+import numpy as np
+import logging
+import os
+
+def _save_index(file_name, arrays):
+   ''' Saves the index through a temporary file, so that an interrupted write keeps the previous one
+   '''
+   temporary = file_name + '.tmp'
+   with open(temporary, 'wb') as f_handle:
+      np.savez(f_handle, **arrays)
+   os.replace(temporary, file_name)
+
+class TimeSeriesCube(object):
+   ''' Class for reading and appending to a time-series cube directory
+
+   .. seealso:: :func:`time_series_cube`
+   '''
+
+   index_name = "index.npz"
+
+   def __init__(self, path):
+      ''' Opens an existing cube
+
+      :param path:         Directory of the cube
+      '''
+      self.path = os.path.abspath(path)
+      with np.load(os.path.join(self.path, self.index_name)) as index:
+         self.cellids = index["cellids"]
+         self.variables = [str(v) for v in index["variables"]]
+         self.operators = [str(o) for o in index["operators"]]
+         self.columns = [str(c) for c in index["columns"]]
+         self.chunk_cells = int(index["chunk_cells"])
+         self.dtype = np.dtype(str(index["dtype"]))
+         self.files = [str(f) for f in index["files"]]
+         self.times = np.array(index["times"], dtype=float)
+      self.__order = np.argsort(self.cellids)
+
+   @classmethod
+   def create(cls, path, cellids, variables, operators=None, columns=None, chunk_cells=4096, dtype=np.float32):
+      ''' Creates an empty cube
+
+      :param path:         Directory of the cube, created if it does not exist
+      :param cellids:      List of cell ids stored in the cube
+      :param variables:    Names of the variables
+      :param operators:    List of operators for the variables, e.g. "x" or "magnitude" (OPTIONAL, default "pass")
+      :param columns:      Names of the columns, by default determined when the first file is appended
+      :param chunk_cells:  Number of cells per chunk file
+      :param dtype:        Data type of the stored values
+      :returns: the new TimeSeriesCube
+      '''
+      variables = list(np.atleast_1d(variables))
+      if operators is None:
+         operators = ["pass" for i in range(len(variables))]
+      if not os.path.isdir(path):
+         os.makedirs(path)
+      _save_index(os.path.join(path, cls.index_name),
+                  {"cellids": np.atleast_1d(np.asarray(cellids, dtype=np.int64)), "variables": np.array(variables, dtype=str),
+                   "operators": np.array(operators, dtype=str), "columns": np.array([] if columns is None else columns, dtype=str),
+                   "chunk_cells": chunk_cells, "dtype": np.dtype(dtype).str, "files": np.array([], dtype=str),
+                   "times": np.array([], dtype=float)})
+      return cls(path)
+
+   def __len__(self):
+      return len(self.times)
+
+   def __save(self):
+      _save_index(os.path.join(self.path, self.index_name),
+                  {"cellids": self.cellids, "variables": np.array(self.variables, dtype=str),
+                   "operators": np.array(self.operators, dtype=str), "columns": np.array(self.columns, dtype=str),
+                   "chunk_cells": self.chunk_cells, "dtype": self.dtype.str, "files": np.array(self.files, dtype=str),
+                   "times": self.times})
+
+   def __chunk_file(self, chunk):
+      return os.path.join(self.path, "chunk%06d.bin" % chunk)
+
+   def __chunk_shape(self, chunk):
+      ''' Returns the number of cells in a chunk and the number of chunks
+      '''
+      nchunks = (len(self.cellids) + self.chunk_cells - 1) // self.chunk_cells
+      return min(self.chunk_cells, len(self.cellids) - chunk*self.chunk_cells), nchunks
+
+   def __chunk_array(self, chunk):
+      ''' Returns the complete chunk [T, chunk cells, ncolumns] as a read-only memory map
+      '''
+      ncells, nchunks = self.__chunk_shape(chunk)
+      return np.memmap(self.__chunk_file(chunk), dtype=self.dtype, mode='r',
+                       shape=(len(self.times), ncells, len(self.columns)))
+
+   def get_times(self):
+      ''' Returns the times of the stored files
+      '''
+      return self.times
+
+   def get_cellids(self):
+      ''' Returns the cell ids in the order of the snapshots
+      '''
+      return self.cellids
+
+   def time_index(self, t):
+      ''' Returns the index of the stored time nearest to t
+      '''
+      return int(np.argmin(np.abs(self.times - t)))
+
+   def __column_indices(self, columns):
+      if columns is None:
+         return np.arange(len(self.columns))
+      if isinstance(columns, str):
+         columns = [columns]
+      indices = []
+      for column in columns:
+         if column in self.columns:
+            indices.append(self.columns.index(column))
+         else:
+            # All columns of a vector variable, e.g. "vg_v" for "vg_v[0]", "vg_v[1]" and "vg_v[2]"
+            components = [i for i,c in enumerate(self.columns) if c.startswith(column + "[")]
+            if len(components) == 0:
+               raise ValueError("Column " + str(column) + " is not in the cube, available columns are " + str(self.columns))
+            indices += components
+      return np.array(indices)
+
+   def __cell_indices(self, cellids):
+      cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+      position = np.searchsorted(self.cellids[self.__order], cellids)
+      position[position == len(self.cellids)] = 0
+      indices = self.__order[position]
+      if np.any(self.cellids[indices] != cellids):
+         raise ValueError("Cells " + str(cellids[self.cellids[indices] != cellids]) + " are not in the cube")
+      return indices
+
+   def cell_series(self, cellids, columns=None, times=None):
+      ''' Reads the time series of some cells
+
+      :param cellids:      List of cell ids
+      :param columns:      Names of the columns (or vector variables), None for all of them
+      :param times:        Indices or a slice of the time steps, None for all of them
+      :returns: array [T, ncells, ncolumns]
+      '''
+      indices = self.__cell_indices(cellids)
+      cols = self.__column_indices(columns)
+      steps = np.arange(len(self.times))[slice(None) if times is None else times]
+      result = np.empty((len(steps), len(indices), len(cols)), dtype=self.dtype)
+      chunks = indices // self.chunk_cells
+      for chunk in np.unique(chunks):
+         mask = chunks == chunk
+         data = self.__chunk_array(chunk)
+         # Index all axes at once, so that only the rows of the requested cells are copied out of the chunk
+         result[:,mask,:] = data[np.ix_(steps, indices[mask] - chunk*self.chunk_cells, cols)]
+         del data
+      return result
+
+   def snapshot(self, index, columns=None):
+      ''' Reads all cells at one time step
+
+      :param index:        Index of the time step, see :func:`time_index`
+      :param columns:      Names of the columns (or vector variables), None for all of them
+      :returns: array [ncells, ncolumns] in the order of :func:`get_cellids`
+      '''
+      index = range(len(self.times))[index]
+      cols = self.__column_indices(columns)
+      ncolumns = len(self.columns)
+      nchunks = self.__chunk_shape(0)[1]
+      result = np.empty((len(self.cellids), len(cols)), dtype=self.dtype)
+      for chunk in range(nchunks):
+         ncells = self.__chunk_shape(chunk)[0]
+         with open(self.__chunk_file(chunk), 'rb') as fptr:
+            fptr.seek(index * ncells * ncolumns * self.dtype.itemsize)
+            data = np.fromfile(fptr, dtype=self.dtype, count=ncells*ncolumns).reshape(ncells, ncolumns)
+         result[chunk*self.chunk_cells:chunk*self.chunk_cells+ncells] = data[:,cols]
+      return result
+
+   def append(self, file_names, processes=1):
+      ''' Appends the files not yet in the cube
+
+      :param file_names:   List of vlsv file names in time order, files already in the cube are skipped
+      :param processes:    Number of worker processes reading the files
+      :returns: number of appended time steps. Files that can not be read are skipped (and retried by the next append).
+      '''
+      from timeevolution import _read_cells_of_file_worker
+      stored = set(self.files)
+      new_files = [os.path.abspath(f) for f in file_names if not os.path.abspath(f) in stored]
+      if len(new_files) == 0:
+         return 0
+      tasks = [(f, self.variables, self.operators, self.cellids) for f in new_files]
+      if processes <= 1 or len(tasks) <= 1:
+         results = map(_read_cells_of_file_worker, tasks)
+         pool = None
+      else:
+         from multiprocessing import Pool
+         pool = Pool(processes)
+         results = pool.imap(_read_cells_of_file_worker, tasks)
+
+      nchunks = self.__chunk_shape(0)[1]
+      appended = 0
+      for file_name, result in zip(new_files, results):
+         if result is None:
+            continue
+         t, data, ncomponents = result
+         if len(self.columns) == 0:
+            for variable, operator, n in zip(self.variables, self.operators, ncomponents):
+               if n > 1:
+                  self.columns += [variable + "[" + str(c) + "]" for c in range(n)]
+               else:
+                  self.columns.append(variable if operator == "pass" else variable + "." + operator)
+         if data.shape[1] != len(self.columns):
+            logging.info("File " + file_name + " has " + str(data.shape[1]) + " columns instead of " + str(len(self.columns)) + ", skipped")
+            continue
+         data = data.astype(self.dtype)
+         for chunk in range(nchunks):
+            ncells = self.__chunk_shape(chunk)[0]
+            with open(self.__chunk_file(chunk), 'ab') as fptr:
+               # Drop a partial row block left by an interrupted append
+               fptr.truncate(len(self.times) * ncells * len(self.columns) * self.dtype.itemsize)
+               data[chunk*self.chunk_cells:chunk*self.chunk_cells+ncells].tofile(fptr)
+         self.files.append(file_name)
+         self.times = np.append(self.times, t)
+         self.__save()
+         appended += 1
+         if appended % 100 == 0:
+            logging.info("Appended " + str(appended) + "/" + str(len(tasks)) + " files")
+      if pool is not None:
+         pool.close()
+         pool.join()
+      return appended
+
+def time_series_cube(path, file_names=None, variables=None, cellids=None, operators=None, chunk_cells=4096,
+                     dtype=np.float32, processes=1):
+   ''' Creates or updates a time-series cube of some variables of some cells over a series of files
+
+   :param path:         Directory of the cube
+   :param file_names:   List of vlsv file names in time order. Files already in the cube are skipped, so the same call
+                        with a longer list appends only the new files.
+   :param variables:    Names of the variables, required when creating the cube
+   :param cellids:      List of cell ids, by default all cells of the first file when creating the cube
+   :param operators:    List of operators for the variables, e.g. "x" or "magnitude" (OPTIONAL, default "pass")
+   :param chunk_cells:  Number of cells per chunk file
+   :param dtype:        Data type of the stored values
+   :param processes:    Number of worker processes reading the files
+   :returns: the TimeSeriesCube
+
+   .. seealso:: :class:`TimeSeriesCube` :func:`cell_time_evolution_array`
+   '''
+   if os.path.isfile(os.path.join(path, TimeSeriesCube.index_name)):
+      cube = TimeSeriesCube(path)
+      if variables is not None and list(np.atleast_1d(variables)) != cube.variables:
+         raise ValueError("The cube in " + str(path) + " has the variables " + str(cube.variables))
+   else:
+      if variables is None:
+         raise ValueError("Variables are required for a new cube")
+      if cellids is None:
+         from vlsvreader import VlsvReader
+         cellids = np.sort(VlsvReader(file_names[0]).read_variable("CellID"))
+      cube = TimeSeriesCube.create(path, cellids, variables, operators, chunk_cells=chunk_cells, dtype=dtype)
+   if file_names is not None:
+      n = cube.append(file_names, processes=processes)
+      logging.info("Appended " + str(n) + " files to the cube in " + str(path))
+   return cube
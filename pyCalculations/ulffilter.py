@@ -0,0 +1,207 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+''' Streaming band-pass filtering of ULF waves in the cell time series of a whole run.
+
+   The files are read one at a time and the filter runs over all selected cells at once, so only the filter memory
+   of each cell is kept: the state of a Butterworth filter for causal filtering, or the last (numtaps-1) samples of
+   a linear-phase FIR filter applied by overlap-save FFT convolution for zero-phase filtering.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      summary = pt.calculations.ulf_wave_power("/path/to/run/", "vg_b_vol", band="Pc3", output_directory="ulf/")
+      # or step by step:
+      for t, file_name, filtered, power in pt.calculations.ulf_filter_stream(files, "vg_b_vol", cellids=cids, band="Pc4"):
+         ...
+
+'''
+
+import numpy as np
+import logging
+import os
+
+# Frequency bands (Hz) of the ULF pulsations
+ulf_bands = {"Pc2": (0.1, 0.45), "Pc3": (0.02, 0.1), "Pc4": (0.006, 0.02), "Pc5": (0.0017, 0.0067)}
+
+def _read_cells(vlsvReader, variable, cellids, operator):
+   ''' Reads a variable in the order of cellids, or of the sorted cell ids of the file if cellids is None
+   '''
+   if cellids is None:
+      order = np.argsort(vlsvReader.read_variable("CellID"))
+      data = vlsvReader.read_variable(variable, operator=operator)[order]
+   else:
+      data = vlsvReader.read_variable(variable, cellids=cellids, operator=operator)
+   return np.reshape(data, (data.shape[0], -1))
+
+def _file_time(vlsvReader):
+   t = vlsvReader.read_parameter("time")
+   if t is None:
+      t = vlsvReader.read_parameter("t")
+   return t
+
+def ulf_filter_stream(files, variable="vg_b_vol", cellids=None, band="Pc3", fs=None, zero_phase=True, order=4,
+                      numtaps=None, chunk=32, operator="pass", pattern="bulk.*.vlsv"):
+   ''' Band-pass filters a variable in all selected cells while streaming through the files of a run
+
+   :param files:        Directory of the run, a glob pattern, a list of file names (in time order) or a VlsvRun
+   :param variable:     Name of the variable, e.g. "vg_b_vol"
+   :param cellids:      List of cell ids, None for all cells (sorted by cell id, the cell ids of the files must agree)
+   :param band:         Name of a band in ulf_bands ("Pc2", "Pc3", "Pc4", "Pc5") or (lowcut, highcut) in Hz
+   :param fs:           Sampling frequency (Hz), by default from the times of the first two files
+   :param zero_phase:   True for a linear-phase FIR filter, whose output is delayed by (numtaps-1)/2 files and
+                        compensated, False for a causal Butterworth filter
+   :param order:        Order of the Butterworth filter
+   :param numtaps:      Length of the FIR filter, by default about three periods of the lower cutoff (odd)
+   :param chunk:        Number of files filtered at once
+   :param operator:     Datareduction operator of the variable
+   :param pattern:      Pattern of the file names when files is a directory
+   :returns: generator of (time, file name, filtered [ncells, ncomponents], power [ncells]) per time step, where the
+             power is the sum of the squared filtered components. With zero_phase the first and last (numtaps-1)/2
+             files are not yielded, as their filter windows extend beyond the run.
+
+   .. seealso:: :func:`ulf_wave_power`
+   '''
+   from scipy import signal
+   from vlsvrun import VlsvRun
+   run = files if isinstance(files, VlsvRun) else VlsvRun(files, pattern=pattern, max_open=1)
+   if cellids is not None:
+      cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+   if fs is None:
+      if len(run) < 2:
+         raise ValueError("At least two files are needed to determine the sampling frequency")
+      fs = 1. / (_file_time(run.reader(1)) - _file_time(run.reader(0)))
+   lowcut, highcut = ulf_bands[band] if isinstance(band, str) else band
+   if highcut >= 0.5*fs:
+      highcut = 0.499*fs
+      logging.info("Upper cutoff above the Nyquist frequency, lowered to " + str(highcut) + " Hz")
+
+   if zero_phase:
+      if numtaps is None:
+         numtaps = int(3 * fs / lowcut) // 2 * 2 + 1
+      taps = signal.firwin(numtaps, [lowcut, highcut], pass_zero=False, fs=fs)
+      delay = (numtaps - 1) // 2
+   else:
+      sos = signal.butter(order, [lowcut, highcut], btype="band", output="sos", fs=fs)
+      delay = 0
+
+   history = None     # last numtaps-1 samples (FIR) or filter state (IIR)
+   history_start = 0  # index of the first file in the FIR history
+   files_read = []    # (time, file name) of the files
+   for start in range(0, len(run), chunk):
+      block = []
+      for i in range(start, min(start + chunk, len(run))):
+         f = run.reader(i)
+         block.append(_read_cells(f, variable, cellids, operator))
+         files_read.append((_file_time(f), f.file_name))
+      block = np.array(block)
+      if zero_phase:
+         if history is None:
+            history = np.zeros((0,) + block.shape[1:])
+         x = np.concatenate((history, block), axis=0)
+         if len(x) >= numtaps:
+            filtered = signal.oaconvolve(x, taps[:, np.newaxis, np.newaxis], mode="valid", axes=0)
+            for n in range(len(filtered)):
+               # Output n covers the files history_start+n ... history_start+n+numtaps-1, centred on the middle one
+               t, file_name = files_read[history_start + n + delay]
+               yield t, file_name, filtered[n], np.sum(filtered[n]**2, axis=-1)
+         keep = min(len(x), numtaps - 1)
+         history_start += len(x) - keep
+         history = x[len(x) - keep:]
+      else:
+         if history is None:
+            history = np.zeros((sos.shape[0], 2) + block.shape[1:])
+         filtered, history = signal.sosfilt(sos, block, axis=0, zi=history)
+         for n in range(len(filtered)):
+            t, file_name = files_read[start + n]
+            yield t, file_name, filtered[n], np.sum(filtered[n]**2, axis=-1)
+
+def ulf_wave_power(files, variable="vg_b_vol", cellids=None, band="Pc3", fs=None, zero_phase=True, order=4, numtaps=None,
+                   chunk=32, operator="pass", pattern="bulk.*.vlsv", output_directory=None, output_name="ulf"):
+   ''' Streams the band-pass filtered wave power of a variable through a run, writing power maps per time step and
+       a summary of the wave power per cell
+
+   :param files:        Directory of the run, a glob pattern, a list of file names (in time order) or a VlsvRun
+   :param variable:     Name of the variable, e.g. "vg_b_vol"
+   :param cellids:      List of cell ids, None for all cells
+   :param band:         Name of a band in ulf_bands ("Pc2", "Pc3", "Pc4", "Pc5") or (lowcut, highcut) in Hz
+   :param output_directory: Directory for the per-step maps and the summary, None writes nothing. The maps are .vlsv
+                        sidecars of the SpatialGrid with the filtered variable and its power when all cells are filtered,
+                        and .npz files otherwise.
+   :param output_name:  Prefix of the output file names
+   :returns: summary dictionary with "cellids", "mean_power", "max_power", "time_of_max", "rms" [ncells, ncomponents]
+             (of the filtered components), "steps", "times" and "band". It is also saved as
+             <output_name>_<band>_summary.npz in the output directory.
+
+   See :func:`ulf_filter_stream` for the other parameters.
+   '''
+   from vlsvrun import VlsvRun
+   from vlsvwriter import VlsvWriter
+   from variable import VariableInfo
+   run = files if isinstance(files, VlsvRun) else VlsvRun(files, pattern=pattern, max_open=1)
+   band_name = band if isinstance(band, str) else "{:g}-{:g}Hz".format(*band)
+   if output_directory is not None and not os.path.exists(output_directory):
+      os.makedirs(output_directory)
+   all_cellids = cellids is None
+   if all_cellids:
+      cellids = np.sort(run.reader(0).read_variable("CellID"))
+
+   power_sum = None
+   times = []
+   for t, file_name, filtered, power in ulf_filter_stream(run, variable, None if all_cellids else cellids, band, fs,
+                                                           zero_phase, order, numtaps, chunk, operator):
+      if power_sum is None:
+         power_sum = np.zeros(power.shape)
+         component_sum = np.zeros(filtered.shape)
+         max_power = np.full(power.shape, -np.inf)
+         time_of_max = np.full(power.shape, np.nan)
+      power_sum += power
+      component_sum += filtered**2
+      larger = power > max_power
+      max_power[larger] = power[larger]
+      time_of_max[larger] = t
+      times.append(t)
+
+      if output_directory is not None:
+         base = os.path.join(output_directory, "{:s}_{:s}_{:s}".format(output_name, band_name, os.path.basename(file_name)))
+         if all_cellids:
+            f = run.reader(file_name)
+            file_order = np.argsort(np.argsort(f.read_variable("CellID")))
+            writer = VlsvWriter(f, base, copy_meshes="SpatialGrid")
+            writer.write_variable_info(VariableInfo(np.squeeze(filtered[file_order]), "{:s}_{:s}".format(variable, band_name),
+                                                    units="", latex=r"$\delta{}$" + variable), "SpatialGrid", unitConversion=1)
+            writer.write_variable_info(VariableInfo(power[file_order], "{:s}_{:s}_power".format(variable, band_name),
+                                                    units="", latex=r"$|\delta{}$" + variable + r"$|^2$"), "SpatialGrid", unitConversion=1)
+         else:
+            np.savez(os.path.splitext(base)[0] + ".npz", time=t, cellids=cellids, filtered=filtered, power=power)
+
+   if power_sum is None:
+      raise ValueError("The run has too few files for the filter")
+   steps = len(times)
+   summary = {"cellids": cellids, "mean_power": power_sum / steps, "max_power": max_power, "time_of_max": time_of_max,
+              "rms": np.sqrt(component_sum / steps), "steps": steps, "times": np.array(times), "band": band_name}
+   if output_directory is not None:
+      np.savez(os.path.join(output_directory, "{:s}_{:s}_summary.npz".format(output_name, band_name)), **summary)
+   return summary
@@ -0,0 +1,215 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Histograms of velocity distribution functions of many spatial cells at once.
+
+   The velocity cells of all requested cells are binned in one pass: each velocity cell gets a flat bin index,
+   which is offset by the index of its spatial cell, and all weights are summed with a single np.bincount.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      f = pt.vlsvfile.VlsvReader("bulk.0001000.vlsv")
+      cids = f.read(mesh="SpatialGrid", tag="CELLSWITHBLOCKS", name="proton")
+      spectra, edges = pt.calculations.vdf_histograms(f, cids, "energy", np.logspace(2, 5, 61), weight="flux")
+      pitch, edges = pt.calculations.vdf_histograms(f, cids, "pitchangle", np.linspace(0, 180, 19),
+                                                    B=f.read_variable("vg_b_vol", cids), frame=f.read_variable("proton/vg_v", cids))
+
+'''
+
+import numpy as np
+import vlsvvariables
+
+mp = 1.672622e-27
+elementalcharge = 1.6021773e-19
+
+def histogram_bin_indices(values, edges):
+   ''' Returns the bin index of each value, with the bins following np.histogram: half-open [e_i, e_i+1)
+       except the last one, which includes its upper edge.
+
+   :param values:    Array of values
+   :param edges:     Monotonically increasing bin edges
+   :returns: integer array of bin indices, -1 for values outside the bins (or NaN)
+   '''
+   edges = np.asarray(edges, dtype=float)
+   nbins = len(edges) - 1
+   values = np.asarray(values)
+   indices = np.searchsorted(edges, values, side='right') - 1
+   indices[values == edges[-1]] = nbins - 1
+   indices[(indices < 0) | (indices >= nbins)] = -1
+   return indices
+
+def bincount_histogram(indices, weights=None, nbins=None, segments=None, nsegments=1):
+   ''' Sums weights into bins, separately for each segment (e.g. spatial cell), with a single np.bincount
+
+   :param indices:   Flat bin index of each sample, negative for samples that are not counted
+   :param weights:   Weight of each sample, None counts the samples
+   :param nbins:     Number of (flat) bins
+   :param segments:  Segment index of each sample, None for a single segment
+   :param nsegments: Number of segments
+   :returns: array [nsegments, nbins]
+   '''
+   indices = np.asarray(indices)
+   valid = indices >= 0
+   keys = indices[valid]
+   if segments is not None:
+      keys = keys + np.asarray(segments, dtype=np.int64)[valid] * nbins
+   if weights is not None:
+      weights = np.asarray(weights)[valid]
+   return np.bincount(keys, weights=weights, minlength=nsegments*nbins).reshape(nsegments, nbins)
+
+def histogram1d(values, edges, weights=None, segments=None, nsegments=1):
+   ''' One-dimensional histograms of many segments, see :func:`bincount_histogram`
+
+   :returns: array [nsegments, len(edges)-1]
+   '''
+   return bincount_histogram(histogram_bin_indices(values, edges), weights, len(edges)-1, segments, nsegments)
+
+def histogram2d(xvalues, yvalues, xedges, yedges, weights=None, segments=None, nsegments=1):
+   ''' Two-dimensional histograms of many segments, indexed as np.histogram2d (x along the first dimension)
+
+   :returns: array [nsegments, len(xedges)-1, len(yedges)-1]
+   '''
+   nx = len(xedges) - 1
+   ny = len(yedges) - 1
+   ix = histogram_bin_indices(xvalues, xedges)
+   iy = histogram_bin_indices(yvalues, yedges)
+   indices = np.where((ix >= 0) & (iy >= 0), ix*ny + iy, -1)
+   return bincount_histogram(indices, weights, nx*ny, segments, nsegments).reshape(nsegments, nx, ny)
+
+def _per_cell(vector, ncells):
+   ''' Broadcasts a single vector or a per-cell array of vectors to [ncells, 3]
+   '''
+   vector = np.asarray(vector, dtype=float)
+   if vector.ndim == 1:
+      return np.broadcast_to(vector, (ncells, 3))
+   return vector.reshape(ncells, 3)
+
+def _gyrophase_axes(B):
+   ''' Returns the first two rows of the rotation matrices which rotate each B onto the z axis, as used by
+       :func:`gyrophase_angles`. Cells with B along z keep the identity.
+   '''
+   from rotation import rotation_array_matrix
+   u = np.cross(B, np.array([0.,0.,1.])[np.newaxis,:])
+   ulen = np.linalg.norm(u, axis=-1)
+   aligned = ulen == 0
+   u[~aligned] = u[~aligned] / ulen[~aligned][:,np.newaxis]
+   angle = np.arccos(np.clip(B[:,2] / np.linalg.norm(B, axis=-1), -1, 1))
+   R = rotation_array_matrix(u, angle)
+   R[aligned] = np.identity(3)
+   return R[:,0,:], R[:,1,:]
+
+def vdf_histograms(vlsvReader, cellids, quantity, edges, pop="proton", frame=None, B=None, axes=None, slicethick=0,
+                   fMin=None, vmin=0, vmax=np.inf, weight="particles", mass=None, cosine=False, clip=False):
+   ''' Histograms the velocity distributions of many spatial cells in a single pass
+
+   :param vlsvReader:   Some VlsvReader with a file open
+   :param cellids:      List of cell IDs with velocity distributions
+   :param quantity:     "energy" (eV), "vparallel" (m/s along B), "pitchangle" (degrees, or cosine), "gyrophase" (degrees,
+                        or cosine) or "slice" (2D, m/s along the first two rows of axes)
+   :param edges:        Bin edges, or a pair of bin edges (x, y) for "slice"
+   :param pop:          Population name
+   :param frame:        Velocity frame to transform into, a single vector or one per cell [N,3]
+   :param B:            Magnetic field for the field-aligned quantities, a single vector or one per cell [N,3]
+   :param axes:         [3,3] rows giving the slice x axis, slice y axis and slice normal for "slice"
+   :param slicethick:   Thickness of the slice in m/s, 0 projects the whole distribution onto the plane
+   :param fMin:         Sparsity threshold, a single value or one per cell. Velocity cells below it are dropped.
+   :param vmin:         Drop velocity cells with speeds below this in the frame (e.g. the thermal core)
+   :param vmax:         Drop velocity cells with speeds above this in the frame
+   :param weight:       "particles" (f dv^3), "flux" (f |v| dv^3 / 4pi) or "psd" (f)
+   :param mass:         Particle mass for the energy, by default from vlsvvariables.speciesamu
+   :param cosine:       For "pitchangle" and "gyrophase", histogram the cosine of the angle
+   :param clip:         Move values outside the bins into the first and last bins instead of dropping them
+   :returns: histograms [N, nbins] ([N, nx, ny] for "slice") and the bin edges
+
+   .. seealso:: :func:`VlsvReader.read_velocity_cells_batch` :func:`histogram1d` :func:`histogram2d`
+   '''
+   cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+   ncells = len(cellids)
+   WID3 = vlsvReader.get_WID()**3
+   block_ids, avgs, offsets = vlsvReader.read_velocity_cells_batch(cellids, pop=pop)
+   f = avgs.reshape(-1)
+   segments = np.repeat(np.arange(ncells), np.diff(offsets) * WID3)
+   V = vlsvReader.construct_velocity_cell_coordinates(block_ids, pop=pop)
+   if frame is not None:
+      V = V - _per_cell(frame, ncells)[segments]
+
+   keep = np.ones(len(f), dtype=bool)
+   if fMin is not None:
+      fMin = np.asarray(fMin, dtype=float)
+      keep &= f >= (fMin[segments] if fMin.ndim > 0 else fMin)
+   speed = np.linalg.norm(V, axis=-1)
+   if vmin > 0:
+      keep &= speed > vmin
+   if vmax < np.inf:
+      keep &= speed < vmax
+
+   dV3 = np.prod(vlsvReader.get_velocity_mesh_dv(pop))
+   if weight == "particles":
+      w = f * dV3
+   elif weight == "flux":
+      w = f * speed * dV3 / (4*np.pi)
+   elif weight == "psd":
+      w = f
+   else:
+      raise ValueError("Unknown histogram weight "+str(weight))
+
+   if quantity in ("vparallel", "pitchangle", "gyrophase"):
+      if B is None:
+         raise ValueError("The magnetic field B is required for quantity "+quantity)
+      B = np.array(_per_cell(B, ncells), dtype=float)
+      b = B / np.linalg.norm(B, axis=-1)[:,np.newaxis]
+
+   if quantity == "energy":
+      if mass is None:
+         mass = vlsvvariables.speciesamu[pop]*mp
+      values = 0.5 * mass * speed**2 / elementalcharge
+   elif quantity == "vparallel":
+      values = np.einsum('ni,ni->n', V, b[segments])
+   elif quantity == "pitchangle":
+      with np.errstate(divide='ignore', invalid='ignore'):
+         values = np.einsum('ni,ni->n', V, b[segments]) / speed
+      if not cosine:
+         values = np.arccos(np.clip(values, -1, 1)) * (180./np.pi)
+   elif quantity == "gyrophase":
+      X, Y = _gyrophase_axes(B)
+      angle = np.arctan2(np.einsum('ni,ni->n', V, X[segments]), np.einsum('ni,ni->n', V, Y[segments]))
+      values = np.cos(angle) if cosine else angle * (180./np.pi)
+   elif quantity == "slice":
+      axes = np.asarray(axes, dtype=float)
+      VX = np.dot(V, axes[0])
+      VY = np.dot(V, axes[1])
+      if slicethick > 0:
+         keep &= np.abs(np.dot(V, axes[2])) <= 0.5*slicethick
+      xedges, yedges = edges
+      if clip:
+         VX = np.clip(VX, xedges[0], xedges[-1])
+         VY = np.clip(VY, yedges[0], yedges[-1])
+      return histogram2d(VX[keep], VY[keep], xedges, yedges, w[keep], segments[keep], ncells), edges
+   else:
+      raise ValueError("Unknown histogram quantity "+str(quantity))
+
+   if clip:
+      values = np.clip(values, edges[0], edges[-1])
+   return histogram1d(values[keep], edges, w[keep], segments[keep], ncells), np.asarray(edges)
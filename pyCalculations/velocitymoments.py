@@ -0,0 +1,212 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Velocity moments (density, bulk velocity, pressure tensor and heat flux) computed directly from the stored VDFs.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      f = pt.vlsvfile.VlsvReader("restart.0000100.vlsv")
+      moments = pt.calculations.velocity_moments(f, pop="proton", processes=4)
+      nonthermal = pt.calculations.velocity_moments(f, region="nonthermal", sphere=([-6e5,0,0], 4e5))
+
+'''
+
+import numpy as np
+import vlsvvariables
+
+mp = 1.672622e-27
+
+moment_names = ["rho", "v", "ptensor", "heatflux"]
+
+def velocity_cell_moment_table(WID, dv):
+   ''' Returns the per-block table of velocity cell offset products used for the moments
+
+   :param WID:    Velocity block width
+   :param dv:     Velocity cell size [dvx, dvy, dvz]
+   :returns: array [WID^3, 17] with the columns 1, o_i, o_i*o_j, |o|^2 and |o|^2*o_i, where o is the offset of each
+             velocity cell centre from the lower corner of its block
+   '''
+   local = np.arange(WID**3)
+   o = (np.stack((local % WID, (local // WID) % WID, local // WID**2), axis=-1) + 0.5) * np.asarray(dv, dtype=float)
+   o2 = np.sum(o**2, axis=-1)
+   return np.column_stack((np.ones(len(o)), o, (o[:,:,np.newaxis]*o[:,np.newaxis,:]).reshape(-1,9), o2, o2[:,np.newaxis]*o))
+
+def velocity_moments_from_blocks(block_ids, avgs, offsets, mesh_size, vmin, dv, WID=4, mass=mp, region="all", sphere=None):
+   ''' Computes velocity moments for many spatial cells from their velocity blocks
+
+   :param block_ids:  Velocity block ids of all cells, array [nblocks]
+   :param avgs:       Values of the velocity cells of each block, array [nblocks, WID^3]
+   :param offsets:    Start of the blocks of each spatial cell in block_ids, array [ncells+1]
+   :param mesh_size:  Velocity mesh size in blocks [vxblocks, vyblocks, vzblocks]
+   :param vmin:       Lower corner of the velocity mesh [vxmin, vymin, vzmin]
+   :param dv:         Velocity cell size [dvx, dvy, dvz]
+   :param WID:        Velocity block width
+   :param mass:       Particle mass for the pressure tensor and heat flux
+   :param region:     "all", "thermal" (inside the sphere) or "nonthermal" (outside the sphere)
+   :param sphere:     (origin [vx,vy,vz], radius) of the thermal sphere, required for the thermal and nonthermal regions
+   :returns: dictionary with "rho" [ncells] (1/m^3), "v" [ncells,3] (m/s), "ptensor" [ncells,3,3] (Pa) and
+             "heatflux" [ncells,3] (W/m^2). Cells without velocity cells in the region are NaN.
+
+   .. seealso:: :func:`velocity_moments` :func:`VlsvReader.read_velocity_cells_batch`
+   '''
+   mesh_size = np.asarray(mesh_size, dtype=np.int64)
+   dv = np.asarray(dv, dtype=float)
+   offsets = np.asarray(offsets, dtype=np.int64)
+   ncells = len(offsets) - 1
+   block_ids = np.asarray(block_ids, dtype=np.int64)
+   f = np.asarray(avgs, dtype=float).reshape(len(block_ids), WID**3)
+
+   # Lower corners of the blocks
+   corners = vmin + np.stack((block_ids % mesh_size[0], (block_ids // mesh_size[0]) % mesh_size[1],
+                              block_ids // (mesh_size[0] * mesh_size[1])), axis=-1) * (WID * dv)
+   table = velocity_cell_moment_table(WID, dv)
+
+   if region != "all":
+      if sphere is None:
+         raise ValueError("A thermal sphere (origin, radius) is required for region "+str(region))
+      a = corners - np.asarray(sphere[0], dtype=float)
+      distance2 = np.sum(a**2, axis=-1)[:,np.newaxis] + 2*np.dot(a, table[:,1:4].T) + table[:,13][np.newaxis,:]
+      if region == "thermal":
+         f = np.where(distance2 <= sphere[1]**2, f, 0)
+      elif region == "nonthermal":
+         f = np.where(distance2 > sphere[1]**2, f, 0)
+      else:
+         raise ValueError("Unknown velocity region "+str(region))
+
+   # Sums over the cells of each block, then over the blocks of each spatial cell
+   sums = np.dot(f, table)
+   counts = np.diff(offsets)
+   nonempty = counts > 0
+   def cell_sum(blockvalues):
+      out = np.zeros((ncells,) + blockvalues.shape[1:])
+      if np.any(nonempty):
+         out[nonempty] = np.add.reduceat(blockvalues, offsets[:-1][nonempty], axis=0)
+      return out
+
+   M0 = sums[:,0]
+   F1 = sums[:,1:4]
+   F2 = sums[:,4:13].reshape(-1,3,3)
+   G0 = sums[:,13]
+   G1 = sums[:,14:17]
+
+   S0 = cell_sum(M0)
+   with np.errstate(divide='ignore', invalid='ignore'):
+      V = cell_sum(corners*M0[:,np.newaxis] + F1) / S0[:,np.newaxis]
+
+   # Central moments: velocities relative to the bulk velocity of the owning cell
+   s = corners - np.repeat(V, counts, axis=0)
+   s2 = np.sum(s**2, axis=-1)
+   sF1 = s[:,:,np.newaxis]*F1[:,np.newaxis,:]
+   P = cell_sum(s[:,:,np.newaxis]*s[:,np.newaxis,:]*M0[:,np.newaxis,np.newaxis] + sF1 + np.transpose(sF1, (0,2,1)) + F2)
+   Q = cell_sum(s2[:,np.newaxis]*(s*M0[:,np.newaxis] + F1) + 2*np.sum(s*F1, axis=-1)[:,np.newaxis]*s
+                + 2*np.einsum('nij,nj->ni', F2, s) + G0[:,np.newaxis]*s + G1)
+
+   dV = np.prod(dv)
+   rho = S0*dV
+   missing = ~(S0 > 0)
+   rho[missing] = np.nan
+   P = P*mass*dV
+   Q = Q*0.5*mass*dV
+   P[missing] = np.nan
+   Q[missing] = np.nan
+   return {"rho": rho, "v": V, "ptensor": P, "heatflux": Q}
+
+def _velocity_moments_chunk(vlsvReader, cellids, pop, mass, region, sphere):
+   ''' Batched read and moments of one chunk of cells
+   '''
+   block_ids, avgs, offsets = vlsvReader.read_velocity_cells_batch(cellids, pop=pop)
+   return velocity_moments_from_blocks(block_ids, avgs, offsets, vlsvReader.get_velocity_mesh_size(pop),
+                                       vlsvReader.get_velocity_mesh_extent(pop)[0:3], vlsvReader.get_velocity_mesh_dv(pop),
+                                       vlsvReader.get_WID(), mass=mass, region=region, sphere=sphere)
+
+def _velocity_moments_worker(args):
+   ''' Process pool worker, opens its own reader for the file
+   '''
+   from vlsvreader import VlsvReader
+   file_name, cellids, pop, mass, region, sphere = args
+   return _velocity_moments_chunk(VlsvReader(file_name), cellids, pop, mass, region, sphere)
+
+def velocity_moments(vlsvReader, cellids=None, pop="proton", region="all", sphere=None, mass=None, processes=1, chunk_size=512):
+   ''' Computes the 0th to 3rd velocity moments from the stored VDFs of many spatial cells
+
+   :param vlsvReader:   Some VlsvReader with a file open
+   :param cellids:      List of cell IDs, by default all cells with velocity distributions of the population
+   :param pop:          Population name
+   :param region:       "all", "thermal" (inside the sphere) or "nonthermal" (outside the sphere), like in backstream.py
+   :param sphere:       (origin [vx,vy,vz], radius) of the thermal sphere. If None for the thermal or nonthermal region,
+                        it is read from the [<pop>_thermal] section of the run configuration.
+   :param mass:         Particle mass, by default from vlsvvariables.speciesamu
+   :param processes:    Number of worker processes, each reading its own chunks of cells
+   :param chunk_size:   Number of cells read and reduced at once
+   :returns: dictionary with "cellids" [N], "rho" [N] (1/m^3), "v" [N,3] (m/s), "ptensor" [N,3,3] (Pa) and
+             "heatflux" [N,3] (W/m^2). Cells without a velocity distribution are NaN.
+
+   .. code-block:: python
+
+      # Example usage:
+      moments = velocity_moments(f, cellids=[1111,1112])
+      relative_error = moments["rho"] / f.read_variable("proton/vg_rho", cellids=[1111,1112]) - 1
+
+   .. seealso:: :func:`velocity_moments_from_blocks` :func:`VlsvReader.read_velocity_cells_batch`
+   '''
+   if cellids is None:
+      cellids = vlsvReader.read(mesh="SpatialGrid", tag="CELLSWITHBLOCKS", name=pop)
+   cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+   if mass is None:
+      mass = vlsvvariables.speciesamu[pop]*mp
+   if region != "all" and sphere is None:
+      sphere = thermal_sphere(vlsvReader, pop)
+
+   chunks = [cellids[i:i+chunk_size] for i in range(0, len(cellids), chunk_size)]
+   if processes <= 1 or len(chunks) <= 1:
+      results = [_velocity_moments_chunk(vlsvReader, chunk, pop, mass, region, sphere) for chunk in chunks]
+   else:
+      from multiprocessing import Pool
+      pool = Pool(processes)
+      results = pool.map(_velocity_moments_worker, [(vlsvReader.file_name, chunk, pop, mass, region, sphere) for chunk in chunks])
+      pool.close()
+      pool.join()
+
+   output = {"cellids": cellids}
+   for name in moment_names:
+      if len(results) > 0:
+         output[name] = np.concatenate([r[name] for r in results])
+      else:
+         output[name] = np.zeros((0,) + {"rho":(), "v":(3,), "ptensor":(3,3), "heatflux":(3,)}[name])
+   return output
+
+def thermal_sphere(vlsvReader, pop="proton"):
+   ''' Reads the thermal sphere of a population from the run configuration stored in the file
+
+   :param vlsvReader:   Some VlsvReader with a file open
+   :param pop:          Population name
+   :returns: (origin [vx,vy,vz], radius) from the [<pop>_thermal] section
+   '''
+   config = vlsvReader.get_config()
+   if config is None or not (pop+"_thermal") in config:
+      raise ValueError("No thermal sphere for population "+pop+" in the file configuration, give it explicitly")
+   section = config[pop+"_thermal"]
+   origin = np.array([float(section[c][-1]) for c in ("vx", "vy", "vz")])
+   return origin, float(section["radius"][-1])
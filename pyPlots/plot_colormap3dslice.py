@@ -741,19 +741,11 @@ def plot_colormap3dslice(filename=None,
                         pass_map = np.swapaxes(pass_map, 0,1)
                 else:
                     # vlasov grid, AMR
-                    pass_map = f.read_variable(mapval)
-                    pass_map = pass_map[indexids] # sort
                     if pass3d:
-                        if np.ndim(pass_map)==1:
-                            pass_shape = None
-                        elif np.ndim(pass_map)==2: # vector variable
-                            pass_shape = pass_map.shape[1]
-                        elif np.ndim(pass_map)==3:  # tensor variable
-                            pass_shape = (pass_map.shape[1], pass_map.shape[2])
-                        else:
-                            logging.info("Error in reshaping pass_maps!")
-                        pass_map = ids3d.idmesh3d2(cellids, pass_map, meshReflevel, xsize, ysize, zsize, pass_shape)
+                        pass_map = f.read_variable_as_uniform(mapval, reflevel=meshReflevel)
                     else:
+                        pass_map = f.read_variable(mapval)
+                        pass_map = pass_map[indexids] # sort
                         pass_map = pass_map[indexlist] # find required cells
                         if np.ndim(pass_map)==1:
                             pass_shape = None
@@ -863,19 +855,12 @@ def plot_colormap3dslice(filename=None,
                             pass_map = np.swapaxes(pass_map, 0,1)
                     else:
                         # vlasov grid, AMR
-                        pass_map = fstep.read_variable(mapval)
-                        pass_map = pass_map[step_indexids] # sort
                         if pass3d:
-                            if np.ndim(pass_map)==1:
-                                pass_shape = None
-                            elif np.ndim(pass_map)==2: # vector variable
-                                pass_shape = pass_map.shape[1]
-                            elif np.ndim(pass_map)==3:  # tensor variable
-                                pass_shape = (pass_map.shape[1], pass_map.shape[2])
-                            else:
-                                logging.info("Error in reshaping pass_maps!")
-                            pass_map = ids3d.idmesh3d2(step_cellids, pass_map, meshReflevel, xsize, ysize, zsize, pass_shape)
+                            # Reuses the cell to voxel map of the main file if the grid has not changed
+                            pass_map = fstep.read_variable_as_uniform(mapval, mesh_map=f.get_uniform_mesh_map(reflevel=meshReflevel))
                         else:
+                            pass_map = fstep.read_variable(mapval)
+                            pass_map = pass_map[step_indexids] # sort
                             pass_map = pass_map[step_indexlist] # find required cells
                             if np.ndim(pass_map)==1:
                                 pass_shape = None
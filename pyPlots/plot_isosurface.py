@@ -342,36 +342,19 @@ def plot_isosurface(filename=None,
 
     if surf_op is None:
             surf_op="pass"
-    surf_datamap_info = f.read_variable_info(surf_var, operator=surf_op)
-
-    surf_datamap = surf_datamap_info.data
-
-    # Verify data shape
-    if np.ndim(surf_datamap)==0:
-        logging.info("Error, read only single surface variable value from vlsv file! surf_datamap.shape being " + str(surf_datamap.shape))
-        return -1
-    
-
     #Define the box limits
     low = np.array([boxcoords[0], boxcoords[2], boxcoords[4]])*unit
     up = np.array([boxcoords[1], boxcoords[3], boxcoords[5]])*unit
 
-    # Choose CellIDs inside the box
-    ids, idx = ids3d.ids3d_box(cellids, low, up, reflevel, xsize, ysize, zsize, [xmin, ymin, zmin, xmax, ymax, zmax])
-
-    surf_datamap = surf_datamap[indexids]
-    surf_datamap = surf_datamap[idx]
+    # Resample the cells inside the box onto a uniform grid
+    surf_data_in_box = f.read_variable_as_uniform(surf_var, low=low, up=up, reflevel=reflevel, operator=surf_op)
+    low = f.get_uniform_mesh_map(low=low, up=up, reflevel=reflevel)["low"]
 
-    # Reshape surface data
-    if np.ndim(surf_datamap)==1:
-        surf_data_in_box = ids3d.idmesh3d2(ids, surf_datamap, reflevel, xsize, ysize, zsize,  None)
-    elif np.ndim(surf_datamap)==2:
-        surf_data_in_box = ids3d.idmesh3d2(ids, surf_datamap, reflevel, xsize, ysize, zsize, surf_datamap.shape[1])
-    elif np.ndim(surf_datamap)==3:
-        surf_data_in_box = ids3d.idmesh3d2(ids, surf_datamap, reflevel, xsize, ysize, zsize, (surf_datamap.shape[1],surf_datamap.shape[2]))
-    else:
-        logging.info("Dimension error in constructing 2D AMR slice!")
+    # Verify data shape
+    if np.ndim(surf_data_in_box)!=3:
+        logging.info("Dimension error in constructing 3D AMR box! surf_data_in_box.shape being " + str(np.shape(surf_data_in_box)))
         return -1
+    surf_data_in_box = np.nan_to_num(surf_data_in_box)
 
     # Remove empty rows, columns and tubes
     empty_0 = np.where(~np.all(surf_data_in_box==0, axis=0))
@@ -2042,32 +2025,19 @@ def sheet_coordinate_finder(f, boxcoords, axisunit, cellids, reflevel, indexids,
             return -1
 
     # Read Bx data
-    sheet_datamap_info = f.read_variable_info("vg_b_vol", operator='x')
-
-    sheet_datamap = sheet_datamap_info.data
-
-    # Verify data shape
-    if np.ndim(sheet_datamap)==0:
-        logging.info("Error, read only single Bx value from vlsv file! sheet_datamap.shape being "+ str(sheet_datamap.shape))
-        return -1
-    
-
     #Define the box limits
     low = np.array([boxcoords[0], boxcoords[2], boxcoords[4]])*axisunit
     up = np.array([boxcoords[1], boxcoords[3], boxcoords[5]])*axisunit
 
-    # Choose CellIDs inside the box
-    ids, idx = ids3d.ids3d_box(cellids, low, up, reflevel, xsize, ysize, zsize, [xmin, ymin, zmin, xmax, ymax, zmax])
-
-    sheet_datamap = sheet_datamap[indexids]
-    sheet_datamap = sheet_datamap[idx]
+    # Resample Bx inside the box onto a uniform grid
+    sheet_data_in_box = f.read_variable_as_uniform("vg_b_vol", low=low, up=up, reflevel=reflevel, operator='x')
+    low = f.get_uniform_mesh_map(low=low, up=up, reflevel=reflevel)["low"]
 
-    # Reshape surface data
-    if np.ndim(sheet_datamap)==1:
-        sheet_data_in_box = ids3d.idmesh3d2(ids, sheet_datamap, reflevel, xsize, ysize, zsize,  None)
-    else:
+    # Verify data shape
+    if np.ndim(sheet_data_in_box)!=3:
         logging.info("Dimension error in constructing sheet!")
         return -1
+    sheet_data_in_box = np.nan_to_num(sheet_data_in_box)
 
     # Remove empty rows, columns and tubes
     empty_0 = np.where(~np.all(sheet_data_in_box==0, axis=0))
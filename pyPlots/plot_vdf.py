@@ -41,6 +41,7 @@ from matplotlib.cbook import get_sample_data
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 from rotation import rotateVectorToVector,rotateVectorToVector_X
+from vdfhistogram import histogram2d
 
 from packaging.version import Version
 
@@ -77,12 +78,14 @@ def doHistogram(f,VX,VY,Voutofslice,vxBinEdges,vyBinEdges,vthick,reducer="integr
                    (VY > min(vyBinEdges)) & (VY < max(vyBinEdges)) ]
 
     # Gather histogram of values
-    (nVhist,VXEdges,VYEdges) = np.histogram2d(VX[tuple(indexes)],VY[tuple(indexes)],bins=(vxBinEdges,vyBinEdges),weights=fw[tuple(indexes)],density=False)
+    VXEdges = np.asarray(vxBinEdges)
+    VYEdges = np.asarray(vyBinEdges)
+    nVhist = histogram2d(VX[tuple(indexes)],VY[tuple(indexes)],VXEdges,VYEdges,weights=fw[tuple(indexes)])[0]
 
     # Correct for summing multiple cells into one histogram output cell with the averaging reducer
     if reducer == "average":
         # Gather histogram of how many cells were summed for the histogram
-        (Chist,VXEdges,VYEdges) = np.histogram2d(VX[tuple(indexes)],VY[tuple(indexes)],bins=(vxBinEdges,vyBinEdges),density=False)
+        Chist = histogram2d(VX[tuple(indexes)],VY[tuple(indexes)],VXEdges,VYEdges)[0]
         nonzero = np.where(Chist != 0)
         nonzero = Chist > 0
         nVhist[nonzero] = np.divide(nVhist[nonzero],Chist[nonzero])
@@ -113,12 +116,50 @@ def doHistogram(f,VX,VY,Voutofslice,vxBinEdges,vyBinEdges,vthick,reducer="integr
 
     return (nVhist,VXEdges,VYEdges)
 
-def resampleReducer(V,f, inputcellsize, setThreshold, normvect, normvectX, slicetype, slicethick, reducer="integrate", wflux=None):
+# Dense base array of the last resampled VDF, reused when several slice orientations are requested for the same cell
+resampleBaseCache = {}
+
+def resampleBase(V, fw, inputcellsize, logspace, setThreshold, cachekey=None):
+    ''' Forms the dense array of a VDF for resampling, padded with one empty cell on each side
+
+    :returns: dense array (log of the values if logspace), the minimum and maximum cell centre velocities
+    '''
+    if cachekey is not None and cachekey in resampleBaseCache:
+        return resampleBaseCache[cachekey]
+
+    vmins = np.amin(V,axis=0)
+    vmaxs = np.amax(V,axis=0)
+    szs = np.trunc((vmaxs-vmins)/inputcellsize+1).astype(int)
+
+    #Form a dense array of the initial data
+    basearray, edges = np.histogramdd(V, bins=tuple(szs),
+        range=list(zip(vmins-0.5*inputcellsize,vmaxs+0.5*inputcellsize)),
+        density=False,weights=fw*inputcellsize**3)
+    basearray = np.pad(basearray,1)
+
+    nonzero = basearray > 0
+    if logspace:
+        newarray = np.ones_like(basearray)
+        newarray = newarray*np.log(sys.float_info.min)
+        np.log(basearray, where=nonzero, out=newarray)
+    else:
+        newarray = np.zeros_like(basearray)
+        newarray[nonzero] = basearray[nonzero]
+
+    base = (newarray, vmins, vmaxs)
+    if cachekey is not None:
+        resampleBaseCache.clear()
+        resampleBaseCache[cachekey] = base
+    return base
+
+def resampleReducer(V,f, inputcellsize, setThreshold, normvect, normvectX, slicetype, slicethick, reducer="integrate", wflux=None, logspace=None, cachekey=None):
 
     if wflux is not None:
         fw = f*np.linalg.norm(V, axis=-1)/(4*np.pi) # use particle flux as weighting in the histogram
     else:
         fw = f # use particle phase-space density as weighting in the histogram
+    if logspace is None:
+        logspace = logspaceResample
 
     NX = np.array(normvect)/np.linalg.norm(normvect)
     NY = np.array(normvectX)/np.linalg.norm(normvectX)
@@ -132,10 +173,11 @@ def resampleReducer(V,f, inputcellsize, setThreshold, normvect, normvectX, slice
     elif slicetype=="vecperp":
         R = np.stack((NY, NX, NZ)).T
     #logging.info(R)
-    vmins = np.amin(V,axis=0)
-    vmaxs = np.amax(V,axis=0)
+    if cachekey is not None:
+        cachekey = (cachekey, inputcellsize, wflux is not None, bool(logspace))
+    basearray, vmins, vmaxs = resampleBase(V, fw, inputcellsize, logspace, setThreshold, cachekey)
 
-    # let's see where the bounding box corners end up and pad the array accordingly
+    # let's see where the bounding box corners end up and pad the output grid accordingly
     vexts =[[vmins[0], vmins[1], vmins[2]],
             [vmins[0], vmins[1], vmaxs[2]],
             [vmins[0], vmaxs[1], vmaxs[2]],
@@ -152,36 +194,41 @@ def resampleReducer(V,f, inputcellsize, setThreshold, normvect, normvectX, slice
     rightpads = (np.abs(vmaxs/inputcellsize - vmaxsR/inputcellsize)).astype(int)
 
     szs = np.trunc((vmaxs-vmins)/inputcellsize+1).astype(int)
+    outszs = szs+leftpads+rightpads
 
     pivot = -vmins/inputcellsize+leftpads #assumes a previously centered V-space wrt. rotations, just need this in cellwidth units
 
-    #Form a dense array of the initial data
-    basearray, edges = np.histogramdd(V, bins=tuple(szs),
-        range=list(zip(vmins-0.5*inputcellsize,vmaxs+0.5*inputcellsize)),
-        density=False,weights=fw*inputcellsize**3)
-
-    newedges = [np.linspace(vminsR[d],vmaxsR[d], num=(szs+leftpads+rightpads)[d]+1) for d in [0,1,2]]
-    #need to expand the array a bit to not chop off anything
-    basearray = np.pad(basearray,tuple(zip(leftpads,rightpads)))
-
+    newedges = [np.linspace(vminsR[d],vmaxsR[d], num=outszs[d]+1) for d in [0,1,2]]
 
-    nonzero = basearray > 0
-
-
-    if logspaceResample:
-        newarray = np.ones_like(basearray)
-        newarray = newarray*np.log(sys.float_info.min)
-        np.log(basearray, where=nonzero, out=newarray)
+    #find the indices within slice thickness - direction 1 is the reduced dimension
+    #indexes = [(abs(Voutofslice) <= 0.5*vthick) in doHistogram
+    if slicethick!=0:
+        dnew = newedges[1][1]-newedges[1][0]
+        zeroInd = int(-newedges[1][0]/dnew)
+        zeroIndLow = int((-newedges[1][0]-slicethick/2)/dnew)
+        zeroIndHi = int((-newedges[1][0]+slicethick/2)/dnew)
+        if zeroIndHi <= zeroIndLow:
+            zeroIndHi = zeroIndLow+1
+        dind = zeroIndHi-zeroIndLow
+        # logging.info("slicethick " + slicethick +  ", dind " + dind +", zeroIndLow " + str(zeroIndLow) + ", dnew "+ str(dnew))
+        slabLow = min(max(zeroIndLow,0),outszs[1])
+        slabHi = min(max(zeroIndHi,slabLow),outszs[1])
     else:
-        newarray = np.zeros_like(basearray)
-        newarray[nonzero] = basearray[nonzero]
-
-    newarray = scipy.ndimage.affine_transform(newarray,R,
+        slabLow = 0
+        slabHi = outszs[1]
+
+    # Only sample the output voxels within the slab: output index o maps to R(o-pivot)+pivot in the padded
+    # output grid, which is shifted by the padding of the output grid and the one-cell padding of the base array.
+    # The one-cell pad keeps the whole interpolation stencil at the outer edge of the data box, also along axes
+    # where the output grid gets no padding
+    slabshift = np.array([0,slabLow,0])
+    newarray = scipy.ndimage.affine_transform(basearray,R,
+                                            output_shape=(outszs[0],slabHi-slabLow,outszs[2]),
                                             mode='constant',cval=np.log(setThreshold/10),
                                             order=1,
-                                            offset=pivot-np.matmul(R,pivot),
+                                            offset=pivot-np.matmul(R,pivot)-leftpads+1+np.matmul(R,slabshift),
                                             )
-    if logspaceResample:
+    if logspace:
         newarray = np.exp(newarray)
         newarray[np.logical_not(np.isfinite(newarray))] = 0
 
@@ -189,18 +236,8 @@ def resampleReducer(V,f, inputcellsize, setThreshold, normvect, normvectX, slice
     #better not to force conservation - values under threshold get folded into the distribution!
     #newarray = np.multiply(newarray,basearray.sum()/newarray.sum())
 
-    #find the indices within slice thickness - direction 1 is the reduced dimension
-    #indexes = [(abs(Voutofslice) <= 0.5*vthick) in doHistogram
     if slicethick!=0:
-        dnew = newedges[1][1]-newedges[1][0]
-        zeroInd = int(-newedges[1][0]/dnew)
-        zeroIndLow = int((-newedges[1][0]-slicethick/2)/dnew)
-        zeroIndHi = int((-newedges[1][0]+slicethick/2)/dnew)
-        if zeroIndHi <= zeroIndLow:
-            zeroIndHi = zeroIndLow+1
-        dind = zeroIndHi-zeroIndLow
-        # logging.info("slicethick " + slicethick +  ", dind " + dind +", zeroIndLow " + str(zeroIndLow) + ", dnew "+ str(dnew))
-        result = newarray[:,zeroIndLow:zeroIndHi].sum(axis=1).T
+        result = newarray.sum(axis=1).T
         if reducer == "average":
             result = np.divide(result,dind*inputcellsize**3)
         else: #integrate
@@ -242,8 +279,7 @@ def vSpaceReducer(vlsvReader, cid, slicetype, normvect, VXBins, VYBins, pop="pro
     inputcellsize=(vxmax-vxmin)/vxsize
     logging.info("Input velocity grid cell size "+str(inputcellsize))
 
-    velcells = vlsvReader.read_velocity_cells(cid, pop=pop)
-    velcellslist = list(zip(*velcells.items()))
+    vcellids, f = vlsvReader.read_velocity_cells_array(cid, pop=pop)
 
     if slicethick is not None and slicethick !=0:
         if slicethick < 0:
@@ -254,11 +290,10 @@ def vSpaceReducer(vlsvReader, cid, slicetype, normvect, VXBins, VYBins, pop="pro
             warnings.warn("You seem to be averaging across some width of the VDF. Are you sure you don't want to integrate instead?")
 
     # check that velocity space has cells
-    if(len(velcellslist) <= 0):
+    if(len(vcellids) <= 0):
         return (False,0,0,0)
 
-    f = np.asarray(velcellslist[1])
-    V = vlsvReader.get_velocity_cell_coordinates(velcellslist[0], pop=pop)
+    V = vlsvReader.get_velocity_cell_coordinates(vcellids, pop=pop)
     logging.info("Found "+str(len(V))+" v-space cells")
 
     # center on highest f-value
@@ -300,6 +335,8 @@ def vSpaceReducer(vlsvReader, cid, slicetype, normvect, VXBins, VYBins, pop="pro
         return (False,0,0,0)
     f = f[ii_f]
     V = V[ii_f,:][0,:,:]
+    # The resampler can reuse the dense array of this cell for other slice orientations
+    resampleKey = (vlsvReader.file_name, cid, pop, str(center), setThreshold)
 
     if slicethick is None:
         # Geometric magic to widen the slice to assure that each cell has some velocity grid points inside it.
@@ -352,7 +389,7 @@ def vSpaceReducer(vlsvReader, cid, slicetype, normvect, VXBins, VYBins, pop="pro
             if normvectX is None:
                 warnings.warn("Please provide a normvectX for the resampler!")
                 return(False,0,0,0)
-            return resampleReducer(V,f, inputcellsize,setThreshold, normvect, normvectX, slicetype, slicethick, reducer=reducer, wflux=wflux)
+            return resampleReducer(V,f, inputcellsize,setThreshold, normvect, normvectX, slicetype, slicethick, reducer=reducer, wflux=wflux, cachekey=resampleKey)
 
     elif slicetype=="Bperp" or slicetype=="Bpara" or slicetype=="Bpara1":
          if resampler is False:
@@ -391,7 +428,7 @@ def vSpaceReducer(vlsvReader, cid, slicetype, normvect, VXBins, VYBins, pop="pro
                   if abs(1.0-np.amax(testvect))>1.e-3:
                      logging.info("Error in rotation: testvector " + str((count,testvect)) + " largest component is not unity")
          else:
-            return resampleReducer(V,f, inputcellsize, setThreshold, normvect, normvectX, slicetype, slicethick, reducer=reducer, wflux=wflux)
+            return resampleReducer(V,f, inputcellsize, setThreshold, normvect, normvectX, slicetype, slicethick, reducer=reducer, wflux=wflux, cachekey=resampleKey)
     else:
         logging.info("Error finding rotation of v-space!")
         return (False,0,0,0)
@@ -40,6 +40,7 @@ from matplotlib.cbook import get_sample_data
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 from rotation import rotateVectorToVector,rotateVectorToVector_X
+from vdfhistogram import histogram1d
 
 # Verify that given cell has a saved vspace
 def verifyCellWithVspace(vlsvReader,cid):
@@ -65,8 +66,9 @@ def doProfiles(f,VX,VY,Voutofslice,slicethick):
         range1a = np.amin(inax1)
         range1b = np.amax(inax1)+slicethick
         nbins1 = int((range1b-range1a)/slicethick)
-        bins1, axis1 = np.histogram(inax1, nbins1, range=[range1a,range1b], weights=f[indexes1])
-        nums1, axis1 = np.histogram(inax1, nbins1, range=[range1a,range1b])
+        axis1 = np.linspace(range1a, range1b, nbins1+1)
+        bins1 = histogram1d(inax1, axis1, weights=f[indexes1])[0]
+        nums1 = histogram1d(inax1, axis1)[0]
         nonzero = np.where(nums1 != 0)
         bins1[nonzero] = np.divide(bins1[nonzero],nums1[nonzero])
 
@@ -75,8 +77,9 @@ def doProfiles(f,VX,VY,Voutofslice,slicethick):
         range2a = np.amin(inax2)
         range2b = np.amax(inax2)+slicethick
         nbins2 = int((range2b-range2a)/slicethick)
-        bins2, axis2 = np.histogram(inax2, nbins2, range=[range2a,range2b], weights=f[indexes2])
-        nums2, axis2 = np.histogram(inax2, nbins2, range=[range2a,range2b])
+        axis2 = np.linspace(range2a, range2b, nbins2+1)
+        bins2 = histogram1d(inax2, axis2, weights=f[indexes2])[0]
+        nums2 = histogram1d(inax2, axis2)[0]
         nonzero = np.where(nums2 != 0)
         bins2[nonzero] = np.divide(bins2[nonzero],nums2[nonzero])
 
@@ -85,8 +88,9 @@ def doProfiles(f,VX,VY,Voutofslice,slicethick):
         range3a = np.amin(inax3)
         range3b = np.amax(inax3)+slicethick
         nbins3 = int((range3b-range3a)/slicethick)
-        bins3, axis3 = np.histogram(inax3, nbins3, range=[range3a,range3b], weights=f[indexes3])
-        nums3, axis3 = np.histogram(inax3, nbins3, range=[range3a,range3b])
+        axis3 = np.linspace(range3a, range3b, nbins3+1)
+        bins3 = histogram1d(inax3, axis3, weights=f[indexes3])[0]
+        nums3 = histogram1d(inax3, axis3)[0]
         nonzero = np.where(nums3 != 0)
         bins3[nonzero] = np.divide(bins3[nonzero],nums3[nonzero])
 
@@ -119,15 +123,13 @@ def vSpaceReducer(vlsvReader, cid, slicetype, normvect, pop="proton",
     inputcellsize=(vxmax-vxmin)/vxsize
     logging.info("Input velocity grid cell size "+str(inputcellsize))
 
-    velcells = vlsvReader.read_velocity_cells(cid, pop=pop)
-    velcellslist = list(zip(*velcells.items()))
+    vcellids, f = vlsvReader.read_velocity_cells_array(cid, pop=pop)
     
     # check that velocity space has cells
-    if(len(velcellslist) <= 0):
+    if(len(vcellids) <= 0):
         return (False,0,0,0)
     
-    f = np.asarray(velcellslist[1])
-    V = vlsvReader.get_velocity_cell_coordinates(velcellslist[0], pop=pop)
+    V = vlsvReader.get_velocity_cell_coordinates(vcellids, pop=pop)
     logging.info("Found "+str(len(V))+" v-space cells")
 
     # center on highest f-value
@@ -29,6 +29,7 @@ import pylab as pl
 from reducer import DataReducerVariable
 from rotation import rotateTensorToVector, rotateArrayTensorToVector
 from gyrophaseangle import gyrophase_angles
+from velocitymoments import velocity_moments
 import vlsvvariables
 import sys
 import math
@@ -786,6 +787,34 @@ def vg_reflevel(variables, reader):
    cellids = variables[0]
    return reader.get_amr_level(cellids)
 
+def vdf_moment(moment, region="all"):
+   ''' Returns a data reducer function for a velocity moment integrated from the VDFs of the active population
+
+       :param moment:  "rho", "v", "ptensor" or "heatflux"
+       :param region:  "all", "thermal" or "nonthermal", see :func:`velocity_moments`
+   '''
+   def reducer( variables, reader ):
+      cellids = variables[0]
+      result = velocity_moments(reader, cellids=np.atleast_1d(cellids), pop=vlsvvariables.activepopulation, region=region)[moment]
+      if np.ndim(cellids) == 0:
+         return result[0]
+      return result
+   return reducer
+
+def epsilon_m(model="bimaxwellian"):
+   ''' Returns a data reducer function for the non-Maxwellianity of the VDFs of the active population
+
+       :param model:  "bimaxwellian" or "maxwellian", see :func:`epsilon_M_cells`
+   '''
+   def reducer( variables, reader ):
+      from non_maxwellianity import epsilon_M_cells
+      cellids = variables[0]
+      result = epsilon_M_cells(reader, cellids=np.atleast_1d(cellids), pop=vlsvvariables.activepopulation, model=model)
+      if np.ndim(cellids) == 0:
+         return result[0]
+      return result
+   return reducer
+
 def _normalize(vec):
    '''
       (private) helper function, normalizes a multidimensinonal array of vectors
@@ -1253,6 +1282,19 @@ multipopv5reducers["pop/vg_p_perpendicular_thermal"] = DataReducerVariable(["pop
 multipopv5reducers["pop/vg_p_anisotropy_thermal"] =   DataReducerVariable(["pop/vg_ptensor_rotated_thermal"], Anisotropy, "", 1, latex=r"$P_{\perp,\mathrm{REPLACEPOP,th}} P_{\parallel,\mathrm{REPLACEPOP,th}}^{-1}$", latexunits=r"")
 multipopv5reducers["pop/vg_gyrotropy_thermal"] =     DataReducerVariable(["pop/vg_ptensor_thermal_diagonal", "pop/vg_ptensor_thermal_offdiagonal","vg_b_vol"], gyrotropy, "", 1, latex=r"$Q_\mathrm{REPLACEPOP,th}$", latexunits=r"")
 
+multipopv5reducers["pop/vg_vdf_rho"] =               DataReducerVariable(["CellID"], vdf_moment("rho"), "1/m3", 1, latex=r"$n_\mathrm{REPLACEPOP,vdf}$",latexunits=r"$\mathrm{m}^{-3}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_v"] =                 DataReducerVariable(["CellID"], vdf_moment("v"), "m/s", 3, latex=r"$V_\mathrm{REPLACEPOP,vdf}$",latexunits=r"$\mathrm{m}\,\mathrm{s}^{-1}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_ptensor"] =           DataReducerVariable(["CellID"], vdf_moment("ptensor"), "Pa", 9, latex=r"$\mathcal{P}_\mathrm{REPLACEPOP,vdf}$", latexunits=r"$\mathrm{Pa}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_heatflux"] =          DataReducerVariable(["CellID"], vdf_moment("heatflux"), "W/m2", 3, latex=r"$\vec{q}_\mathrm{REPLACEPOP,vdf}$", latexunits=r"$\mathrm{W}\,\mathrm{m}^{-2}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_rho_thermal"] =       DataReducerVariable(["CellID"], vdf_moment("rho", "thermal"), "1/m3", 1, latex=r"$n_\mathrm{REPLACEPOP,th,vdf}$",latexunits=r"$\mathrm{m}^{-3}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_v_thermal"] =         DataReducerVariable(["CellID"], vdf_moment("v", "thermal"), "m/s", 3, latex=r"$V_\mathrm{REPLACEPOP,th,vdf}$",latexunits=r"$\mathrm{m}\,\mathrm{s}^{-1}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_ptensor_thermal"] =   DataReducerVariable(["CellID"], vdf_moment("ptensor", "thermal"), "Pa", 9, latex=r"$\mathcal{P}_\mathrm{REPLACEPOP,th,vdf}$", latexunits=r"$\mathrm{Pa}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_rho_nonthermal"] =    DataReducerVariable(["CellID"], vdf_moment("rho", "nonthermal"), "1/m3", 1, latex=r"$n_\mathrm{REPLACEPOP,st,vdf}$",latexunits=r"$\mathrm{m}^{-3}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_v_nonthermal"] =      DataReducerVariable(["CellID"], vdf_moment("v", "nonthermal"), "m/s", 3, latex=r"$V_\mathrm{REPLACEPOP,st,vdf}$",latexunits=r"$\mathrm{m}\,\mathrm{s}^{-1}$", useReader=True)
+multipopv5reducers["pop/vg_vdf_ptensor_nonthermal"]= DataReducerVariable(["CellID"], vdf_moment("ptensor", "nonthermal"), "Pa", 9, latex=r"$\mathcal{P}_\mathrm{REPLACEPOP,st,vdf}$", latexunits=r"$\mathrm{Pa}$", useReader=True)
+multipopv5reducers["pop/vg_epsilon_m"] =              DataReducerVariable(["CellID"], epsilon_m("bimaxwellian"), "", 1, latex=r"$\epsilon_\mathrm{M,REPLACEPOP}$", latexunits=r"", useReader=True)
+multipopv5reducers["pop/vg_epsilon_m_maxwellian"] =   DataReducerVariable(["CellID"], epsilon_m("maxwellian"), "", 1, latex=r"$\epsilon_\mathrm{M,REPLACEPOP,iso}$", latexunits=r"", useReader=True)
+
 multipopv5reducers["pop/vg_temperature"] =            DataReducerVariable(["pop/vg_pressure", "pop/vg_rho"], Temperature, "K", 1, latex=r"$T_\mathrm{REPLACEPOP}$", latexunits=r"$\mathrm{K}$")
 multipopv5reducers["pop/vg_ttensor"] =                DataReducerVariable(["pop/vg_ptensor", "pop/vg_rho"], Temperature, "K", 9, latex=r"$\mathcal{T}_\mathrm{REPLACEPOP}$", latexunits=r"$\mathrm{K}$")
 multipopv5reducers["pop/vg_ttensor_rotated"] =         DataReducerVariable(["pop/vg_ptensor_rotated", "pop/vg_rho"], Temperature, "K", 9, latex=r"$\mathcal{T}^\mathrm{R}_\mathrm{REPLACEPOP}$", latexunits=r"$\mathrm{K}$")
@@ -0,0 +1,335 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+''' Compact archives of the VDFs of selected cells over a series of files.
+
+   The archive is a zip file of .npy arrays (readable with np.load): an index with the times, source files, cell ids
+   and velocity mesh, and for each time step the velocity blocks of all archived cells, optionally in float32 and
+   zlib-compressed. Time steps are written one at a time, so archives of long series never need to fit in memory.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt, glob
+      files = sorted(glob.glob("bulk.*.vlsv"))
+      pt.vlsvfile.extract_vdf_archive(files, [1111, 1112], "vdfs.npz")
+      archive = pt.vlsvfile.VdfArchive("vdfs.npz")
+      step = archive.step(10)
+      vcellids, f = step.read_velocity_cells_array(1111)
+      moments = pt.calculations.velocity_moments(step)
+
+'''
+
+import numpy as np
+import logging
+import warnings
+import zipfile
+
+def _write_array(zfile, name, array):
+   ''' Writes an array as a .npy member of an open zip file
+   '''
+   with zfile.open(name + '.npy', 'w', force_zip64=True) as fh:
+      np.lib.format.write_array(fh, np.asanyarray(array), allow_pickle=False)
+
+def extract_vdf_archive(vlsvFiles, cellids, file_name, pop="proton", dtype=np.float32, compress=True):
+   ''' Extracts the VDFs of some cells from a series of files into an archive
+
+   :param vlsvFiles:   List of file names
+   :param cellids:     List of cell IDs to archive
+   :param file_name:   Name of the archive file (.npz)
+   :param pop:         Population name
+   :param dtype:       Data type of the stored VDF values, None keeps the type of the files
+   :param compress:    Compress the archive with zlib
+   :returns: the number of archived time steps
+
+   Files that cannot be read are skipped with a warning. All files must share the velocity mesh of the first one.
+
+   .. seealso:: :class:`VdfArchive` :func:`VlsvReader.read_velocity_cells_batch`
+   '''
+   from vlsvreader import VlsvReader
+   cellids = np.atleast_1d(np.asarray(cellids, dtype=np.int64))
+   mesh = None
+   times = []
+   files = []
+   with zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED, allowZip64=True) as zfile:
+      for vlsvFile in vlsvFiles:
+         try:
+            vlsvReader = VlsvReader(vlsvFile)
+            file_mesh = (vlsvReader.get_velocity_mesh_size(pop), vlsvReader.get_velocity_mesh_extent(pop),
+                         vlsvReader.get_velocity_mesh_dv(pop), vlsvReader.get_WID())
+            with warnings.catch_warnings():
+               warnings.simplefilter("ignore")
+               block_ids, avgs, offsets = vlsvReader.read_velocity_cells_batch(cellids, pop=pop)
+         except Exception as e:
+            warnings.warn("Could not read the VDFs of " + str(vlsvFile) + ": " + str(e))
+            continue
+         if mesh is None:
+            mesh = file_mesh
+         elif not (np.array_equal(mesh[0], file_mesh[0]) and np.allclose(mesh[1], file_mesh[1]) and mesh[3] == file_mesh[3]):
+            raise ValueError("The velocity mesh of " + str(vlsvFile) + " differs from the first archived file")
+
+         t = vlsvReader.read_parameter('t')
+         if t is None:
+            t = vlsvReader.read_parameter('time')
+         step = 'step%06d_' % len(times)
+         _write_array(zfile, step + 'offsets', offsets)
+         _write_array(zfile, step + 'block_ids', block_ids.astype(np.uint32 if np.prod(mesh[0]) < 2**32 else np.int64))
+         _write_array(zfile, step + 'avgs', avgs if dtype is None else avgs.astype(dtype))
+         times.append(np.nan if t is None else float(t))
+         files.append(str(vlsvFile))
+         logging.info('Archived ' + str(offsets[-1]) + ' blocks of ' + str(np.count_nonzero(np.diff(offsets))) + '/'
+                      + str(len(cellids)) + ' cells from ' + str(vlsvFile))
+
+      # The index is written last
+      if mesh is None:
+         mesh = (np.zeros(3, dtype=np.int64), np.zeros(6), np.zeros(3), 4)
+      _write_array(zfile, 'times', np.array(times))
+      _write_array(zfile, 'files', np.array(files, dtype=str))
+      _write_array(zfile, 'cellids', cellids)
+      _write_array(zfile, 'pop', np.array(pop))
+      _write_array(zfile, 'mesh_size', np.asarray(mesh[0], dtype=np.int64))
+      _write_array(zfile, 'mesh_extent', np.asarray(mesh[1], dtype=float))
+      _write_array(zfile, 'mesh_dv', np.asarray(mesh[2], dtype=float))
+      _write_array(zfile, 'WID', np.array(mesh[3], dtype=np.int64))
+   return len(times)
+
+class VdfArchive(object):
+   ''' Reader for archives written by :func:`extract_vdf_archive`
+
+       .. code-block:: python
+
+          # Example usage:
+          archive = VdfArchive("vdfs.npz")
+          for i in range(len(archive)):
+             vdf = archive.step(i).read_velocity_distribution(1111)
+
+       .. seealso:: :class:`VdfArchiveStep`
+   '''
+   def __init__(self, file_name):
+      self.file_name = file_name
+      self.__data = np.load(file_name, allow_pickle=False)
+      self.times = self.__data['times']
+      self.files = [str(f) for f in self.__data['files']]
+      self.cellids = self.__data['cellids']
+      self.pop = str(self.__data['pop'])
+      self.mesh_size = self.__data['mesh_size']
+      self.mesh_extent = self.__data['mesh_extent']
+      self.mesh_dv = self.__data['mesh_dv']
+      self.WID = int(self.__data['WID'])
+      self.__steps = {}
+
+   def __len__(self):
+      return len(self.times)
+
+   def close(self):
+      self.__data.close()
+
+   def get_times(self):
+      ''' Returns the simulation times of the archived time steps
+      '''
+      return self.times
+
+   def get_cellids(self):
+      ''' Returns the archived cell ids
+      '''
+      return self.cellids
+
+   def time_index(self, t):
+      ''' Returns the index of the time step closest to the given simulation time
+      '''
+      return int(np.nanargmin(np.abs(self.times - t)))
+
+   def read_step(self, index):
+      ''' Reads the velocity blocks of all archived cells of one time step
+
+      :param index:  Index of the time step
+      :returns: block ids [N], block values [N, WID^3] and per-cell offsets [ncells+1], as
+                :func:`VlsvReader.read_velocity_cells_batch` for the archived cells
+      '''
+      step = 'step%06d_' % index
+      return (self.__data[step + 'block_ids'].astype(np.int64), self.__data[step + 'avgs'],
+              self.__data[step + 'offsets'].astype(np.int64))
+
+   def step(self, index):
+      ''' Returns a reader for the VDFs of one time step
+
+      :param index:  Index of the time step
+      :returns: a :class:`VdfArchiveStep`
+      '''
+      if not index in self.__steps:
+         # Keep only the most recent step in memory
+         self.__steps = {index: VdfArchiveStep(self, index)}
+      return self.__steps[index]
+
+class VdfArchiveStep(object):
+   ''' The VDFs of one archived time step, with the velocity space methods of :class:`VlsvReader`, so that code reading
+       VDFs (read_velocity_cells, read_velocity_cells_batch, velocity_moments, vdf_histograms, ...) can use it directly.
+   '''
+   def __init__(self, archive, index):
+      self.archive = archive
+      self.index = index
+      self.file_name = archive.files[index]
+      self.__block_ids, self.__avgs, self.__offsets = archive.read_step(index)
+      cellids = archive.get_cellids()
+      order = np.argsort(cellids)
+      self.__cellids = cellids[order]
+      self.__rows = order
+
+   def __check_pop(self, pop):
+      if pop != self.archive.pop:
+         raise ValueError("Population " + str(pop) + " is not archived, the archive holds " + self.archive.pop)
+
+   def __block_range(self, cellid):
+      i = np.searchsorted(self.__cellids, cellid)
+      if i >= len(self.__cellids) or self.__cellids[i] != cellid:
+         return None
+      row = self.__rows[i]
+      return self.__offsets[row], self.__offsets[row+1]
+
+   def get_WID(self):
+      return self.archive.WID
+
+   def check_population(self, popname):
+      return popname == self.archive.pop
+
+   def check_variable(self, name):
+      return False
+
+   def check_parameter(self, name):
+      return name in ("t", "time")
+
+   def read_parameter(self, name):
+      ''' Returns the simulation time for "t" and "time", None for other parameters
+      '''
+      if name in ("t", "time"):
+         return self.archive.times[self.index]
+      return None
+
+   def read(self, name="", tag="", mesh="", operator="pass", cellids=-1):
+      ''' Reads the CELLSWITHBLOCKS and BLOCKSPERCELL arrays of the archived cells
+      '''
+      self.__check_pop(name)
+      counts = np.diff(self.__offsets)
+      if tag == "CELLSWITHBLOCKS":
+         return self.archive.get_cellids()[counts > 0]
+      if tag == "BLOCKSPERCELL":
+         return counts[counts > 0]
+      raise ValueError("Tag " + str(tag) + " is not archived")
+
+   def get_velocity_mesh_size(self, pop="proton"):
+      self.__check_pop(pop)
+      return self.archive.mesh_size.copy()
+
+   def get_velocity_block_size(self, pop="proton"):
+      self.__check_pop(pop)
+      return np.array([self.archive.WID]*3)
+
+   def get_velocity_mesh_extent(self, pop="proton"):
+      self.__check_pop(pop)
+      return self.archive.mesh_extent.copy()
+
+   def get_velocity_mesh_dv(self, pop="proton"):
+      self.__check_pop(pop)
+      return self.archive.mesh_dv.copy()
+
+   def get_velocity_block_coordinates(self, blocks, pop="proton", dtype=np.float64):
+      ''' Returns the lower corner coordinates of the given blocks, see :func:`VlsvReader.get_velocity_block_coordinates`
+      '''
+      blocks = np.atleast_1d(blocks).astype(np.int64)
+      size = self.get_velocity_mesh_size(pop)
+      yz, ix = np.divmod(blocks, size[0])
+      iz, iy = np.divmod(yz, size[1])
+      return (self.archive.mesh_extent[0:3] + np.stack((ix, iy, iz), axis=-1) * self.archive.WID * self.archive.mesh_dv).astype(dtype)
+
+   def __cell_offsets(self, dtype):
+      WID = self.archive.WID
+      local = np.arange(WID**3)
+      return ((np.stack((local % WID, (local // WID) % WID, local // (WID*WID)), axis=-1) + 0.5) * self.archive.mesh_dv).astype(dtype)
+
+   def get_velocity_cell_coordinates(self, vcellids, pop="proton", dtype=np.float64):
+      ''' Returns the coordinates of the given velocity cells, see :func:`VlsvReader.get_velocity_cell_coordinates`
+      '''
+      blocks, cells = np.divmod(np.atleast_1d(vcellids).astype(np.int64), self.archive.WID**3)
+      return self.get_velocity_block_coordinates(blocks, pop, dtype) + self.__cell_offsets(dtype)[cells]
+
+   def construct_velocity_cells(self, blocks):
+      WID3 = self.archive.WID**3
+      return np.ravel(np.array(blocks, dtype=np.int64)[:, np.newaxis] * WID3 + np.arange(WID3))
+
+   def construct_velocity_cell_coordinates(self, blocks, pop="proton", dtype=np.float64):
+      ''' Returns the velocity cell coordinates in the given blocks, see :func:`VlsvReader.construct_velocity_cell_coordinates`
+      '''
+      corners = self.get_velocity_block_coordinates(blocks, pop, dtype)
+      return (corners[:, np.newaxis, :] + self.__cell_offsets(dtype)[np.newaxis, :, :]).reshape(-1, 3)
+
+   def read_velocity_cells_batch(self, cellids, pop="proton", max_gap=256):
+      ''' Returns the velocity blocks of many cells, see :func:`VlsvReader.read_velocity_cells_batch`
+      '''
+      self.__check_pop(pop)
+      cellids = np.atleast_1d(cellids)
+      ranges = [self.__block_range(c) for c in cellids]
+      if any(r is None or r[0] == r[1] for r in ranges):
+         warnings.warn("Cell(s) does not have velocity distribution")
+      ranges = [(0, 0) if r is None else r for r in ranges]
+      offsets = np.zeros(len(cellids)+1, dtype=np.int64)
+      offsets[1:] = np.cumsum([end - start for start, end in ranges])
+      if offsets[-1] == 0:
+         return np.zeros(0, dtype=np.int64), np.zeros((0, self.archive.WID**3), dtype=self.__avgs.dtype), offsets
+      block_ids = np.concatenate([self.__block_ids[start:end] for start, end in ranges])
+      avgs = np.concatenate([self.__avgs[start:end] for start, end in ranges])
+      return block_ids, avgs, offsets
+
+   def read_velocity_cells_array(self, cellid, pop="proton", flat=True):
+      ''' Returns the velocity cells of a cell as arrays, see :func:`VlsvReader.read_velocity_cells_array`
+      '''
+      block_ids, avgs, offsets = self.read_velocity_cells_batch([cellid], pop)
+      if not flat:
+         return block_ids, avgs
+      return self.construct_velocity_cells(block_ids), avgs.reshape(-1)
+
+   def read_velocity_cells(self, cellid, pop="proton"):
+      ''' Returns a map of velocity cell ids and values, see :func:`VlsvReader.read_velocity_cells`
+      '''
+      vcellids, values = self.read_velocity_cells_array(cellid, pop)
+      return dict(zip(vcellids, values))
+
+   def read_velocity_distribution(self, cellid, pop="proton"):
+      ''' Returns the velocity distribution of a cell, see :func:`VlsvReader.read_velocity_distribution`
+      '''
+      from velocitydistribution import VelocityDistribution
+      block_ids, avgs = self.read_velocity_cells_array(cellid, pop, flat=False)
+      return VelocityDistribution(block_ids, avgs, self.archive.mesh_size, self.archive.mesh_extent[0:3],
+                                  self.archive.mesh_dv, self.archive.WID)
+
+   def write_vlsv(self, vlsvReader, file_name):
+      ''' Writes the archived VDFs of this time step into a vlsv file with the meshes of the source file
+
+      :param vlsvReader:  VlsvReader of the source file (or another file of the same run)
+      :param file_name:   Name of the new vlsv file
+      '''
+      from vlsvwriter import VlsvWriter
+      cellids = self.read(name=self.archive.pop, tag="CELLSWITHBLOCKS")
+      writer = VlsvWriter(vlsvReader, file_name, copy_meshes=["SpatialGrid", self.archive.pop])
+      writer.write_velocity_space(vlsvReader, cellids, [self.read_velocity_cells_array(c, self.archive.pop, flat=False) for c in cellids],
+                                  pop=self.archive.pop)
+      writer.close()
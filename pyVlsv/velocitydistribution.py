@@ -0,0 +1,237 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import numpy as np
+import numbers
+
+class VelocityDistribution(object):
+   ''' Block-sparse velocity distribution function of a single spatial cell.
+
+       Holds the ids of the stored velocity blocks and the values of their WID^3 cells, together with the
+       description of the velocity mesh, and provides vectorized conversions to coordinates and dense arrays.
+
+       .. code-block:: python
+
+          # Example usage:
+          vdf = vlsvReader.read_velocity_distribution(cellid, pop="proton")
+          f, edges = vdf.dense()
+          coarse = vdf.downsample(1)
+          diff = vdf - otherReader.read_velocity_distribution(cellid, pop="proton")
+
+       .. seealso:: :func:`VlsvReader.read_velocity_distribution`
+   '''
+   def __init__(self, block_ids, values, mesh_size, vmin, dv, WID=4):
+      ''' Creates a velocity distribution
+
+          :param block_ids:   Velocity block ids, array [nblocks]
+          :param values:      Values of the cells of each block, array [nblocks, WID^3]
+          :param mesh_size:   Size of the velocity mesh in blocks [vxblocks, vyblocks, vzblocks]
+          :param vmin:        Lower corner of the velocity mesh [vxmin, vymin, vzmin]
+          :param dv:          Velocity cell size [dvx, dvy, dvz]
+          :param WID:         Velocity block width in cells
+      '''
+      self.WID = int(WID)
+      self.mesh_size = np.array(mesh_size, dtype=np.int64)
+      self.vmin = np.array(vmin, dtype=float)
+      self.dv = np.array(dv, dtype=float)
+      block_ids = np.atleast_1d(np.array(block_ids, dtype=np.int64))
+      values = np.asarray(values).reshape(len(block_ids), self.WID**3)
+      # Keep the blocks sorted by id so that distributions can be aligned with searchsorted
+      order = np.argsort(block_ids, kind="stable")
+      self.block_ids = block_ids[order]
+      self.values = values[order]
+
+   def __len__(self):
+      return len(self.block_ids)
+
+   def __repr__(self):
+      return "VelocityDistribution("+str(len(self.block_ids))+" blocks, WID="+str(self.WID)+", dv="+str(self.dv)+")"
+
+   def same_mesh(self, other):
+      ''' Returns True if the other distribution is defined on the same velocity mesh
+      '''
+      return (self.WID == other.WID and np.array_equal(self.mesh_size, other.mesh_size)
+              and np.allclose(self.vmin, other.vmin) and np.allclose(self.dv, other.dv))
+
+   def copy(self, block_ids=None, values=None):
+      ''' Returns a distribution on the same mesh, with the given blocks (by default a copy of these blocks)
+      '''
+      if block_ids is None:
+         block_ids = self.block_ids.copy()
+         values = self.values.copy()
+      return VelocityDistribution(block_ids, values, self.mesh_size, self.vmin, self.dv, self.WID)
+
+   def vcellids(self):
+      ''' Returns the velocity cell ids of all stored cells, in the order of values.ravel()
+
+          .. seealso:: :func:`VlsvReader.read_velocity_cells_array`
+      '''
+      WID3 = self.WID**3
+      return (self.block_ids[:, np.newaxis] * WID3 + np.arange(WID3)[np.newaxis, :]).reshape(-1)
+
+   def block_indices(self):
+      ''' Returns the (i,j,k) indices of the stored blocks in the velocity mesh, array [nblocks, 3]
+      '''
+      return np.stack((self.block_ids % self.mesh_size[0],
+                       (self.block_ids // self.mesh_size[0]) % self.mesh_size[1],
+                       self.block_ids // (self.mesh_size[0] * self.mesh_size[1])), axis=-1)
+
+   def block_coordinates(self):
+      ''' Returns the lower corner velocity coordinates of the stored blocks, array [nblocks, 3]
+      '''
+      return self.vmin + self.block_indices() * (self.WID * self.dv)
+
+   def cell_offsets(self):
+      ''' Returns the lookup table of velocity cell centres relative to the lower corner of their block, array [WID^3, 3]
+      '''
+      local = np.arange(self.WID**3)
+      return (np.stack((local % self.WID, (local // self.WID) % self.WID, local // self.WID**2), axis=-1) + 0.5) * self.dv
+
+   def cell_indices(self):
+      ''' Returns the global (i,j,k) velocity cell indices of all stored cells, array [nblocks*WID^3, 3]
+      '''
+      local = np.arange(self.WID**3)
+      local = np.stack((local % self.WID, (local // self.WID) % self.WID, local // self.WID**2), axis=-1)
+      return (self.block_indices()[:, np.newaxis, :] * self.WID + local[np.newaxis, :, :]).reshape(-1, 3)
+
+   def coordinates(self):
+      ''' Returns the velocity coordinates of the centres of all stored cells, array [nblocks*WID^3, 3]
+
+          .. seealso:: :func:`VlsvReader.get_velocity_cell_coordinates`
+      '''
+      return (self.block_coordinates()[:, np.newaxis, :] + self.cell_offsets()[np.newaxis, :, :]).reshape(-1, 3)
+
+   def dense(self, vmin=None, vmax=None):
+      ''' Materialises the distribution as a dense 3D array at the native velocity resolution.
+
+          :param vmin:  Lower corner of the bounding box [vx,vy,vz], defaults to the lower corner of the stored blocks
+          :param vmax:  Upper corner of the bounding box [vx,vy,vz], defaults to the upper corner of the stored blocks
+          :returns: array [nvx, nvy, nvz] indexed as [vx, vy, vz], and the list of the cell edges along each dimension.
+                    The bounding box is expanded to whole velocity cells.
+      '''
+      indices = self.cell_indices()
+      mesh_cells = self.mesh_size * self.WID
+      if vmin is None:
+         low = (np.amin(indices, axis=0) if len(indices) > 0 else np.zeros(3, dtype=np.int64))
+      else:
+         low = np.clip(np.floor((np.array(vmin, dtype=float) - self.vmin) / self.dv), 0, mesh_cells).astype(np.int64)
+      if vmax is None:
+         high = (np.amax(indices, axis=0) + 1 if len(indices) > 0 else np.zeros(3, dtype=np.int64))
+      else:
+         high = np.clip(np.ceil((np.array(vmax, dtype=float) - self.vmin) / self.dv), 0, mesh_cells).astype(np.int64)
+      high = np.maximum(high, low)
+
+      array = np.zeros(tuple(high - low), dtype=self.values.dtype)
+      inside = np.all((indices >= low) & (indices < high), axis=1)
+      local = indices[inside] - low
+      array[local[:, 0], local[:, 1], local[:, 2]] = self.values.reshape(-1)[inside]
+      edges = [self.vmin[d] + np.arange(low[d], high[d]+1) * self.dv[d] for d in range(3)]
+      return array, edges
+
+   def downsample(self, k=1):
+      ''' Returns the distribution averaged onto a velocity mesh coarser by a factor 2^k in each dimension.
+          The integral of the distribution is conserved.
+
+          :param k:  Downsampling exponent, the cell size grows by 2^k
+          :returns: a new VelocityDistribution
+      '''
+      factor = 2**int(k)
+      if factor == 1:
+         return self.copy()
+      if factor <= self.WID:
+         new_WID = self.WID // factor
+         new_mesh_size = self.mesh_size.copy()
+      else:
+         new_WID = 1
+         new_mesh_size = -(-self.mesh_size * self.WID // factor)
+      new_cells = new_mesh_size * new_WID
+
+      coarse = self.cell_indices() // factor
+      keys = coarse[:, 0] + new_cells[0] * (coarse[:, 1] + new_cells[1] * coarse[:, 2])
+      unique_keys, inverse = np.unique(keys, return_inverse=True)
+      means = np.bincount(inverse.reshape(-1), weights=self.values.reshape(-1), minlength=len(unique_keys)) / factor**3
+
+      cells = np.stack((unique_keys % new_cells[0], (unique_keys // new_cells[0]) % new_cells[1], unique_keys // (new_cells[0] * new_cells[1])), axis=-1)
+      blocks = cells // new_WID
+      local = cells % new_WID
+      block_keys = blocks[:, 0] + new_mesh_size[0] * (blocks[:, 1] + new_mesh_size[1] * blocks[:, 2])
+      new_ids, block_inverse = np.unique(block_keys, return_inverse=True)
+      new_values = np.zeros((len(new_ids), new_WID**3), dtype=self.values.dtype)
+      new_values[block_inverse.reshape(-1), local[:, 0] + new_WID * (local[:, 1] + new_WID * local[:, 2])] = means
+      return VelocityDistribution(new_ids, new_values, new_mesh_size, self.vmin, self.dv * factor, new_WID)
+
+   def mask(self, threshold):
+      ''' Returns the distribution with the values below the threshold set to zero and the blocks without any
+          values above the threshold removed, like the sparse velocity space of Vlasiator.
+
+          :param threshold:  Sparsity threshold, e.g. the value of vg_effectivesparsitythreshold
+          :returns: a new VelocityDistribution
+      '''
+      above = self.values >= threshold
+      keep = np.any(above, axis=1)
+      return self.copy(self.block_ids[keep], np.where(above[keep], self.values[keep], 0))
+
+   def __aligned(self, other):
+      ''' Returns the union of the block ids of two distributions and both value arrays on it
+      '''
+      if not self.same_mesh(other):
+         raise ValueError("Velocity distributions are defined on different velocity meshes")
+      block_ids = np.union1d(self.block_ids, other.block_ids)
+      dtype = np.result_type(self.values.dtype, other.values.dtype)
+      mine = np.zeros((len(block_ids), self.WID**3), dtype=dtype)
+      theirs = np.zeros((len(block_ids), self.WID**3), dtype=dtype)
+      mine[np.searchsorted(block_ids, self.block_ids)] = self.values
+      theirs[np.searchsorted(block_ids, other.block_ids)] = other.values
+      return block_ids, mine, theirs
+
+   def __operate(self, other, operation):
+      if isinstance(other, VelocityDistribution):
+         block_ids, mine, theirs = self.__aligned(other)
+         return self.copy(block_ids, operation(mine, theirs))
+      if isinstance(other, numbers.Number):
+         return self.copy(self.block_ids.copy(), operation(self.values, other))
+      return NotImplemented
+
+   def __add__(self, other):
+      return self.__operate(other, np.add)
+
+   def __radd__(self, other):
+      return self.__operate(other, np.add)
+
+   def __sub__(self, other):
+      return self.__operate(other, np.subtract)
+
+   def __rsub__(self, other):
+      return self.__operate(other, lambda a, b: np.subtract(b, a))
+
+   def __mul__(self, other):
+      return self.__operate(other, np.multiply)
+
+   def __rmul__(self, other):
+      return self.__operate(other, np.multiply)
+
+   def __truediv__(self, other):
+      return self.__operate(other, np.divide)
+
+   def __neg__(self):
+      return self.copy(self.block_ids.copy(), -self.values)
@@ -0,0 +1,301 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+''' Catalogs of run directories: which file holds which simulation time, variables, populations and VDFs.
+
+   The catalog is built from the XML footers of the files only, in parallel, and stored in a small JSON index file
+   in the run directory. When the catalog is opened again, only files that are new or whose size or modification
+   time changed are scanned.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      catalog = pt.vlsvfile.VlsvCatalog("/path/to/run/", pattern="bulk*.vlsv", processes=8)
+      f = pt.vlsvfile.VlsvReader(catalog.file_at_time(1200.0))
+      with_vdfs = catalog.select(vdf=True, tmin=1000, tmax=1500)
+      with_fg_b = catalog.select(variables="fg_b")
+
+'''
+
+import bisect
+import glob
+import json
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+import numpy as np
+from vlsvfooter import footer_datatypes, read_footer_bytes
+
+catalog_version = 1
+
+def _read_footer_value(fptr, element):
+   ''' Reads the (first) value of a footer entry, e.g. a PARAMETER
+   '''
+   dtype = footer_datatypes[(element.attrib["datatype"], int(element.attrib["datasize"]))]
+   fptr.seek(int(element.text))
+   return np.fromfile(fptr, dtype=dtype, count=1)[0].item()
+
+def _file_step(file_name):
+   ''' Returns the step number in a file name like bulk.0001234.vlsv, or None
+   '''
+   match = re.search(r"(\d+)\D*$", os.path.basename(file_name))
+   return int(match.group(1)) if match else None
+
+def catalog_entry(file_name):
+   ''' Scans the footer of one vlsv file for the catalog
+
+   :param file_name:    Name of the vlsv file
+   :returns: dictionary with the "name", "size", "mtime", "step", "time" (None if not stored), "variables",
+             "populations" and "vdf_populations" (populations with stored velocity distributions) of the file.
+             For a file that cannot be read (e.g. one that is still being written) only the "name" and the
+             "error" are returned.
+   '''
+   try:
+      return _scan_footer(file_name)
+   except Exception as e:
+      return {"name": os.path.basename(file_name), "error": repr(e)}
+
+def _scan_footer(file_name):
+   ''' Scans the footer of one vlsv file, see :func:`catalog_entry`
+   '''
+   stat = os.stat(file_name)
+   with open(file_name, "rb") as fptr:
+      footer = ET.fromstring(read_footer_bytes(fptr))
+      time = None
+      variables = []
+      populations = []
+      vdf_populations = []
+      for child in footer:
+         if child.tag == "PARAMETER" and time is None and child.attrib.get("name") in ("time", "t"):
+            time = float(_read_footer_value(fptr, child))
+         elif child.tag == "VARIABLE" and "name" in child.attrib:
+            name = child.attrib["name"]
+            variables.append(name)
+            if "/" in name and not name.split("/")[0] in populations:
+               populations.append(name.split("/")[0])
+         elif child.tag == "BLOCKIDS":
+            pop = child.attrib.get("name", "avgs")
+            if not pop in populations:
+               populations.append(pop)
+            if int(child.attrib["arraysize"]) > 0 and not pop in vdf_populations:
+               vdf_populations.append(pop)
+   return {"name": os.path.basename(file_name), "size": stat.st_size, "mtime": stat.st_mtime,
+           "step": _file_step(file_name), "time": time, "variables": sorted(set(variables)),
+           "populations": populations, "vdf_populations": vdf_populations}
+
+class VlsvCatalog(object):
+   ''' Class for the catalog of the vlsv files of a run directory, ordered by simulation time
+   '''
+
+   def __init__(self, directory, pattern="bulk*.vlsv", index_file=None, processes=1):
+      ''' Opens the catalog of a run directory, scanning the files that are not in the index file yet
+
+      :param directory:    Directory of the run
+      :param pattern:      Pattern of the file names in the directory
+      :param index_file:   Name of the index file, by default .vlsvcatalog_<pattern>.json in the directory
+      :param processes:    Number of worker processes scanning the files
+      '''
+      self.directory = os.path.abspath(directory)
+      self.pattern = pattern
+      if index_file is None:
+         index_file = os.path.join(self.directory, ".vlsvcatalog_" + re.sub(r"[^\w.-]", "_", pattern) + ".json")
+      self.index_file = index_file
+      self.entries = []
+      self.__times = np.zeros(0)
+      self.__load()
+      self.update(processes)
+
+   def __load(self):
+      ''' Reads the entries of the index file, if any
+      '''
+      if not os.path.isfile(self.index_file):
+         return
+      try:
+         with open(self.index_file, "r") as f:
+            index = json.load(f)
+         if index.get("version") == catalog_version:
+            self.entries = index["entries"]
+      except ValueError:
+         logging.info("Ignoring unreadable catalog index " + self.index_file)
+
+   def __save(self):
+      ''' Writes the entries to the index file, if the directory is writable
+      '''
+      temporary = self.index_file + ".tmp"
+      try:
+         with open(temporary, "w") as f:
+            json.dump({"version": catalog_version, "pattern": self.pattern, "entries": self.entries}, f)
+         os.replace(temporary, self.index_file)
+      except OSError:
+         logging.info("Could not write the catalog index " + self.index_file + ", keeping the catalog in memory")
+
+   def __sort(self):
+      ''' Orders the entries by time (files without a time last) and name
+      '''
+      self.entries.sort(key=lambda e: (e["time"] is None, e["time"] if e["time"] is not None else 0, e["name"]))
+      self.__times = np.array([e["time"] for e in self.entries if e["time"] is not None], dtype=float)
+
+   def update(self, processes=1):
+      ''' Rescans the files that are new or changed since the last scan, and drops the removed files
+
+      :param processes:    Number of worker processes scanning the files
+      :returns: number of scanned files
+      '''
+      file_names = sorted(glob.glob(os.path.join(self.directory, self.pattern)))
+      known = dict((e["name"], e) for e in self.entries)
+      entries = []
+      scan = []
+      for file_name in file_names:
+         entry = known.get(os.path.basename(file_name))
+         try:
+            stat = os.stat(file_name)
+         except OSError:
+            continue
+         if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            entries.append(entry)
+         else:
+            scan.append(file_name)
+
+      if processes <= 1 or len(scan) <= 1:
+         scanned = [catalog_entry(f) for f in scan]
+      else:
+         from multiprocessing import Pool
+         pool = Pool(processes)
+         scanned = pool.map(catalog_entry, scan, chunksize=max(1, len(scan) // (4*processes)))
+         pool.close()
+         pool.join()
+      # Unreadable files are left out of the catalog (and the index file), so they are scanned again next time
+      for entry in scanned:
+         if "error" in entry:
+            logging.info("Skipping unreadable file " + os.path.join(self.directory, entry["name"]) + ": " + entry["error"])
+         else:
+            entries.append(entry)
+
+      changed = len(scan) > 0 or len(entries) != len(self.entries)
+      self.entries = entries
+      self.__sort()
+      if changed:
+         self.__save()
+      return len(scan)
+
+   def __len__(self):
+      return len(self.entries)
+
+   def __path(self, entry):
+      return os.path.join(self.directory, entry["name"])
+
+   def get_file_names(self):
+      ''' Returns the paths of all files, ordered by time
+      '''
+      return [self.__path(e) for e in self.entries]
+
+   def get_times(self):
+      ''' Returns the simulation times of the files that store one, in increasing order
+      '''
+      return self.__times.copy()
+
+   def entry(self, file_name):
+      ''' Returns the catalog entry of a file
+
+      :param file_name:    Path or base name of the file
+      '''
+      name = os.path.basename(file_name)
+      for e in self.entries:
+         if e["name"] == name:
+            return e
+      raise KeyError("File " + str(file_name) + " is not in the catalog of " + self.directory)
+
+   def index_at_time(self, t, side="nearest"):
+      ''' Binary search for the file of a simulation time
+
+      :param t:            Simulation time
+      :param side:         "nearest", "before" (last file with time <= t) or "after" (first file with time >= t)
+      :returns: index of the file in the entries, or None if there is no such file
+      '''
+      times = self.__times
+      if len(times) == 0:
+         return None
+      if side == "before":
+         i = bisect.bisect_right(times, t) - 1
+         return i if i >= 0 else None
+      elif side == "after":
+         i = bisect.bisect_left(times, t)
+         return i if i < len(times) else None
+      elif side == "nearest":
+         i = bisect.bisect_left(times, t)
+         if i == len(times) or (i > 0 and t - times[i-1] <= times[i] - t):
+            return i - 1
+         return i
+      raise ValueError("Unknown side " + str(side))
+
+   def file_at_time(self, t, side="nearest"):
+      ''' Returns the path of the file of a simulation time, see :func:`index_at_time`
+      '''
+      i = self.index_at_time(t, side)
+      return None if i is None else self.__path(self.entries[i])
+
+   def select(self, variables=None, populations=None, vdf=None, tmin=None, tmax=None, entries=False):
+      ''' Selects files by their contents and time
+
+      :param variables:    Variable name or list of names that all have to be stored in the file, e.g. "fg_b"
+      :param populations:  Population name or list of names that all have to be present in the file
+      :param vdf:          True selects files with velocity distributions (of the given populations, if any),
+                           False files without them
+      :param tmin:         Smallest simulation time
+      :param tmax:         Largest simulation time
+      :param entries:      Return the catalog entries instead of the file paths
+      :returns: list of file paths (or entries), ordered by time
+
+      .. code-block:: python
+
+         # Example usage:
+         restarts = catalog.select(vdf=True)
+         late_fg_b = catalog.select(variables=["fg_b", "fg_e"], tmin=1000.0)
+      '''
+      if isinstance(variables, str):
+         variables = [variables]
+      if isinstance(populations, str):
+         populations = [populations]
+      if tmin is None and tmax is None:
+         candidates = self.entries
+      else:
+         lo = 0 if tmin is None else bisect.bisect_left(self.__times, tmin)
+         hi = len(self.__times) if tmax is None else bisect.bisect_right(self.__times, tmax)
+         candidates = self.entries[lo:hi]
+
+      selected = []
+      for e in candidates:
+         if variables is not None:
+            stored = set(v.lower() for v in e["variables"])
+            if not all(v.lower() in stored for v in variables):
+               continue
+         if populations is not None and not all(p in e["populations"] for p in populations):
+            continue
+         if vdf is not None:
+            with_vdf = all(p in e["vdf_populations"] for p in populations) if populations else len(e["vdf_populations"]) > 0
+            if with_vdf != vdf:
+               continue
+         selected.append(e)
+      return selected if entries else [self.__path(e) for e in selected]
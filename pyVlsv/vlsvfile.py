@@ -40,3 +40,8 @@ from vlsvwriter import VlsvWriter
 from vlasiatorreader import VlasiatorReader
 
 from vlsvparticles import VlsvParticles
+from velocitydistribution import VelocityDistribution
+from vdfarchive import VdfArchive, VdfArchiveStep, extract_vdf_archive
+from vlsvrun import VlsvRun
+from vlsvcatalog import VlsvCatalog
+from vlsvfooter import read_parameters
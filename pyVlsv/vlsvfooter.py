@@ -0,0 +1,137 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+''' Fast reading of parameters from many vlsv files, without constructing a VlsvReader for each of them.
+
+   Only the XML footer of each file is read, and instead of parsing the whole footer only its PARAMETER entries are
+   picked out, after which the requested values are read from their offsets.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      params = pt.vlsvfile.read_parameters("/path/to/run/", ["time", "timestep", "dt"], processes=8)
+      times = params["time"]
+
+'''
+
+import glob
+import os
+import re
+import struct
+import numpy as np
+
+footer_datatypes = {("float", 4): np.float32, ("float", 8): np.float64, ("int", 4): np.int32, ("int", 8): np.int64,
+                    ("uint", 4): np.uint32, ("uint", 8): np.uint64}
+
+_parameter_entry = re.compile(rb"<PARAMETER\s([^>]*)>\s*(\d+)\s*</PARAMETER>")
+_attribute = re.compile(rb"(\w+)\s*=\s*\"([^\"]*)\"")
+
+# Same aliases as in VlsvReader.read_parameter
+_parameter_aliases = {"time": "t", "t": "time"}
+
+def read_footer_bytes(fptr):
+   ''' Reads the raw XML footer of an open vlsv file
+   '''
+   fptr.seek(8)
+   (offset,) = struct.unpack("Q", fptr.read(8))
+   fptr.seek(offset)
+   return fptr.read()
+
+def read_file_parameters(file_name, names):
+   ''' Reads parameters from the footer of one vlsv file
+
+   :param file_name:    Name of the vlsv file
+   :param names:        List of parameter names
+   :returns: list of the parameter values, None for parameters not in the file
+   '''
+   wanted = set(name.lower() for name in names)
+   wanted.update(_parameter_aliases[name] for name in list(wanted) if name in _parameter_aliases)
+   with open(file_name, "rb") as fptr:
+      entries = {}
+      for match in _parameter_entry.finditer(read_footer_bytes(fptr)):
+         attributes = dict((k.decode(), v.decode()) for k, v in _attribute.findall(match.group(1)))
+         name = attributes.get("name", "").lower()
+         if name in wanted:
+            entries[name] = (attributes, int(match.group(2)))
+
+      values = []
+      for name in names:
+         name = name.lower()
+         if not name in entries and _parameter_aliases.get(name) in entries:
+            name = _parameter_aliases[name]
+         if not name in entries:
+            values.append(None)
+            continue
+         attributes, offset = entries[name]
+         dtype = np.dtype(footer_datatypes[(attributes["datatype"], int(attributes["datasize"]))])
+         fptr.seek(offset)
+         values.append(np.frombuffer(fptr.read(dtype.itemsize), dtype=dtype)[0].item())
+   return values
+
+def _read_file_parameters_worker(args):
+   ''' Process pool worker
+   '''
+   return read_file_parameters(*args)
+
+def read_parameters(files, names=("time",), processes=1, pattern="bulk*.vlsv"):
+   ''' Reads parameters from the footers of many vlsv files
+
+   :param files:        List of file names, a glob pattern or a run directory
+   :param names:        List of parameter names, e.g. ["time", "timestep", "dt"]
+   :param processes:    Number of worker processes reading the files
+   :param pattern:      Pattern of the file names when files is a directory
+   :returns: dictionary with "file_names" (in the given order, sorted for a pattern or directory) and an array
+             [nfiles] of each parameter, NaN for files without the parameter
+
+   .. code-block:: python
+
+      # Example usage:
+      params = read_parameters(sorted(glob.glob("bulk.*.vlsv")), ["time", "dt"])
+      gaps = params["file_names"][1:][np.diff(params["time"]) > 2*params["dt"][1:]]
+
+   .. seealso:: :func:`VlsvReader.read_parameter`
+   '''
+   if isinstance(files, str):
+      if os.path.isdir(files):
+         files = glob.glob(os.path.join(files, pattern))
+      else:
+         files = glob.glob(files)
+      files = sorted(files)
+   file_names = list(files)
+   names = list(names)
+
+   jobs = [(f, names) for f in file_names]
+   if processes <= 1 or len(jobs) <= 1:
+      values = [read_file_parameters(*job) for job in jobs]
+   else:
+      from multiprocessing import Pool
+      pool = Pool(processes)
+      values = pool.map(_read_file_parameters_worker, jobs, chunksize=max(1, len(jobs) // (4*processes)))
+      pool.close()
+      pool.join()
+
+   output = {"file_names": np.array(file_names)}
+   for i, name in enumerate(names):
+      output[name] = np.array([np.nan if v[i] is None else v[i] for v in values], dtype=float)
+   return output
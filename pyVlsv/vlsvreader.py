@@ -30,6 +30,7 @@ import os
 import sys
 import re
 import numbers
+import hashlib
 
 import vlsvvariables
 from reduction import datareducers,multipopdatareducers,data_operators,v5reducers,multipopv5reducers,deprecated_datareducers
@@ -42,12 +43,16 @@ from vlsvwriter import VlsvWriter
 from variable import get_data
 import warnings
 import time
-from interpolator_amr import AMRInterpolator, supported_amr_interpolators
+from interpolator_amr import AMRInterpolator, supported_amr_interpolators, solve3
 from operator import itemgetter
+from velocitydistribution import VelocityDistribution
 
 
 interp_method_aliases = {"trilinear":"linear"}
 
+# Staggering of fsgrid variables that are not volume-centred
+fsgrid_variable_centerings = {"fg_b":"face", "fg_e":"edge"}
+
 class PicklableFile(object):
    def __init__(self, fileobj):
       self.fileobj = fileobj
@@ -156,12 +161,17 @@ class VlsvReader(object):
       if (hasattr(self, "__fptr")) and self.__fptr is not None:
          self.__fptr.close()
 
-   def __init__(self, file_name, fsGridDecomposition=None):
+   def __init__(self, file_name, fsGridDecomposition=None, shared=None):
       ''' Initializes the vlsv file (opens the file, reads the file footer and reads in some parameters)
 
           :param file_name:     Name of the vlsv file
           :param fsGridDecomposition: Either None or a len-3 list of ints.
                                        List (length 3): Use this as the decomposition directly. Product needs to match numWritingRanks.
+          :param shared:        Either None or a VlsvReader of another file of the same run. The mesh and population
+                                metadata, the fsgrid decomposition and the cell index dictionaries are taken from it
+                                instead of being rebuilt, when the corresponding data in the two files is identical.
+
+          .. seealso:: :class:`VlsvRun`
       '''
       # Make sure the path is set in file name: 
       file_name = os.path.abspath(file_name)
@@ -185,7 +195,12 @@ class VlsvReader(object):
       self.__blocks_per_cell = {} # per-pop
       self.__blocks_per_cell_offsets = {} # per-pop
       self.__order_for_cellid_blocks = {} # per-pop
+      self.__cells_with_blocks_tree = {} # per-pop, SEE: get_cellid_with_vdf(self)
       self.__vg_indexes_on_fg = np.array([]) # SEE: map_vg_onto_fg(self)
+      self.__ionosphere_index = None # SEE: get_ionosphere_barycentric_coordinates(self)
+      self.__uniform_mesh_maps = {} # SEE: get_uniform_mesh_map(self)
+      self.__velocity_lookup_tables = {} # per (pop, dtype), SEE: get_velocity_lookup_tables(self)
+      self.__array_digests = {} # per (mesh, tag, name), SEE: __matches_shared(self)
 
       self.variable_cache = {} # {(varname, operator):data}
 
@@ -203,6 +218,19 @@ class VlsvReader(object):
       self.__cell_duals = {} # cellid : tuple of vertex-indices that span this cell
       self.__regular_neighbor_cache = {} # cellid-of-low-corner : (8,) np.array of cellids)
 
+      self.__shared = shared
+      if shared is None or not self.__adopt_mesh_metadata(shared):
+         self.__read_mesh_metadata()
+
+      if self.check_parameter("j_per_b_modifier"):
+         vlsvvariables.J_per_B_modifier = self.read_parameter("j_per_b_modifier")
+
+      self.__fptr.close()
+
+
+   def __read_mesh_metadata(self):
+      ''' Reads the spatial mesh and the velocity meshes of all populations
+      '''
       # Check if the file is using new or old vlsv format
       # Read parameters (Note: Reading the spatial cell locations and
       # storing them will anyway take the most time and memory):
@@ -364,11 +392,80 @@ class VlsvReader(object):
 
       vlsvvariables.cellsize = self.__dx
 
-      if self.check_parameter("j_per_b_modifier"):
-         vlsvvariables.J_per_B_modifier = self.read_parameter("j_per_b_modifier")
+   def __mesh_signature(self):
+      ''' Returns the attributes of the mesh and population entries of the footer, without their file offsets
+      '''
+      signature = []
+      for child in self.__xml_root:
+         if child.tag.startswith("MESH") or child.tag == "BLOCKIDS":
+            signature.append((child.tag, tuple(sorted(child.attrib.items()))))
+      return signature
 
-      self.__fptr.close()
+   def __adopt_mesh_metadata(self, shared):
+      ''' Takes the spatial and velocity mesh metadata from a reader of another file of the same run,
+          if the mesh entries of the two footers and the spatial bounding boxes agree.
+
+      :param shared:    VlsvReader of another file of the run
+      :returns: True if the metadata was adopted
+      '''
+      if self.__mesh_signature() != shared.__mesh_signature():
+         return False
+      # Same sizes do not mean the same extents, so compare the node coordinates of the spatial and velocity meshes
+      meshes = ["SpatialGrid"] + [child.attrib.get("name", "avgs") for child in self.__xml_root if child.tag == "BLOCKIDS"]
+      for mesh in meshes:
+         for tag in ("MESH_BBOX", "MESH_NODE_CRDS_X", "MESH_NODE_CRDS_Y", "MESH_NODE_CRDS_Z"):
+            digest = self.__array_digest((tag, ""), mesh)
+            if digest is None or digest != shared.__array_digest((tag, ""), mesh):
+               return False
+
+      self.__xcells, self.__ycells, self.__zcells = shared.__xcells, shared.__ycells, shared.__zcells
+      self.__xblock_size, self.__yblock_size, self.__zblock_size = shared.__xblock_size, shared.__yblock_size, shared.__zblock_size
+      self.__xmin, self.__ymin, self.__zmin = shared.__xmin, shared.__ymin, shared.__zmin
+      self.__xmax, self.__ymax, self.__zmax = shared.__xmax, shared.__ymax, shared.__zmax
+      self.__dx, self.__dy, self.__dz = shared.__dx, shared.__dy, shared.__dz
+      self.__meshes = shared.__meshes
+      self.active_populations = list(shared.active_populations)
+      self.__velocity_lookup_tables = shared.__velocity_lookup_tables
+      return True
+
+   def __array_digest(self, key, mesh="SpatialGrid"):
+      ''' Returns the SHA-1 digest of an array of the file, None if the file does not have it
+
+      :param key:       (tag, name) of the array
+      :param mesh:      Mesh of the array
+      '''
+      if not (mesh,) + key in self.__array_digests:
+         data = self.read(mesh=mesh, tag=key[0], name=key[1])
+         if data is not None:
+            data = hashlib.sha1(np.ascontiguousarray(data).tobytes()).hexdigest()
+         self.__array_digests[(mesh,) + key] = data
+      return self.__array_digests[(mesh,) + key]
+
+   def __matches_shared(self, key, data):
+      ''' Checks whether a SpatialGrid array of this file is identical to the one in the file of the shared reader
+
+      :param key:       (tag, name) of the array
+      :param data:      The array as read from this file
+      :returns: True if there is a shared reader and the digests of the arrays agree
+      '''
+      if self.__shared is None or data is None:
+         return False
+      self.__array_digests[("SpatialGrid",) + key] = hashlib.sha1(np.ascontiguousarray(data).tobytes()).hexdigest()
+      return self.__shared.__array_digest(key) == self.__array_digests[("SpatialGrid",) + key]
 
+   def shared_metadata(self):
+      ''' Returns the file-independent data this reader currently shares with the reader given as `shared`
+
+      :returns: dictionary with booleans "mesh", "cellids", "fsgrid" and "blocks" (a dictionary per population)
+      '''
+      shared = self.__shared
+      if shared is None:
+         return {"mesh": False, "cellids": False, "fsgrid": False, "blocks": {}}
+      return {"mesh": self.__meshes is shared.__meshes,
+              "cellids": len(self.__fileindex_for_cellid) > 0 and self.__fileindex_for_cellid is shared.__fileindex_for_cellid,
+              "fsgrid": self.__fsGridDecomposition is not None and self.__fsGridDecomposition is shared.__fsGridDecomposition,
+              "blocks": {pop: self.__order_for_cellid_blocks[pop] is shared.__order_for_cellid_blocks.get(pop)
+                         for pop in self.__order_for_cellid_blocks}}
 
    def __read_xml_footer(self):
       ''' Reads in the XML footer of the VLSV file and store all the content
@@ -406,6 +503,12 @@ class VlsvReader(object):
       
       cellids=self.read(mesh="SpatialGrid",name="CellID", tag="VARIABLE")
 
+      # Identical cell ordering in the shared reader: use its dictionary
+      if self.__matches_shared(("VARIABLE", "CellID"), cellids):
+         self.__shared.__read_fileindex_for_cellid()
+         self.__fileindex_for_cellid = self.__shared.__fileindex_for_cellid
+         return
+
       #Check if it is not iterable. If it is a scale then make it a list
       if(not isinstance(cellids, Iterable)):
          cellids=[ cellids ]
@@ -537,6 +640,16 @@ class VlsvReader(object):
       self.__cells_with_blocks[pop] = np.atleast_1d(self.read(mesh="SpatialGrid",tag="CELLSWITHBLOCKS", name=pop))
       self.__blocks_per_cell[pop] = np.atleast_1d(self.read(mesh="SpatialGrid",tag="BLOCKSPERCELL", name=pop))
 
+      # Identical cells with blocks and block counts in the shared reader: use its offsets and dictionary
+      if (self.__matches_shared(("CELLSWITHBLOCKS", pop), self.__cells_with_blocks[pop]) and
+          self.__matches_shared(("BLOCKSPERCELL", pop), self.__blocks_per_cell[pop])):
+         self.__shared.__set_cell_offset_and_blocks_nodict(pop)
+         self.__cells_with_blocks[pop] = self.__shared.__cells_with_blocks[pop]
+         self.__blocks_per_cell[pop] = self.__shared.__blocks_per_cell[pop]
+         self.__blocks_per_cell_offsets[pop] = self.__shared.__blocks_per_cell_offsets[pop]
+         self.__order_for_cellid_blocks[pop] = self.__shared.__order_for_cellid_blocks[pop]
+         return
+
       self.__blocks_per_cell_offsets[pop] = np.empty(len(self.__cells_with_blocks[pop]))
       self.__blocks_per_cell_offsets[pop][0] = 0.0
       self.__blocks_per_cell_offsets[pop][1:] = np.cumsum(self.__blocks_per_cell[pop][:-1])
@@ -933,6 +1046,32 @@ class VlsvReader(object):
       raise ValueError("Variable or attribute not found")
 
 
+   def __read_rows_coalesced(self, fptr, variable_offset, datatype, element_size, vector_size, indices, max_gap_bytes=65536):
+      ''' Reads rows of an array at the given file indices. The rows are read in file order, and rows separated by
+          less than max_gap_bytes are read with a single read.
+
+          :returns: array [len(indices), vector_size] in the order of indices
+      '''
+      dtype = np.dtype({"float": "f", "int": "i", "uint": "u"}[datatype] + str(element_size))
+      indices = np.asarray(indices, dtype=np.int64)
+      rows = np.zeros((len(indices), vector_size), dtype=dtype)
+      if len(indices) == 0:
+         return rows
+      max_gap = max(1, max_gap_bytes // (element_size*vector_size))
+      order = np.argsort(indices, kind="stable")
+      sorted_indices = indices[order]
+      new_run = np.ones(len(indices), dtype=bool)
+      new_run[1:] = sorted_indices[1:] > sorted_indices[:-1] + max_gap
+      run_first = np.flatnonzero(new_run)
+      run_last = np.append(run_first[1:], len(indices))
+      for first, last in zip(run_first, run_last):
+         start = sorted_indices[first]
+         length = sorted_indices[last-1] - start + 1
+         fptr.seek(int(variable_offset + start*element_size*vector_size))
+         run = np.fromfile(fptr, dtype=dtype, count=vector_size*length).reshape(length, vector_size)
+         rows[order[first:last]] = run[sorted_indices[first:last] - start]
+      return rows
+
    def read(self, name="", tag="", mesh="", operator="pass", cellids=-1):
       ''' Read data from the open vlsv file. 
       
@@ -1015,15 +1154,18 @@ class VlsvReader(object):
                # data from the file system and sort through it. For the CSC disk system, this
                # becomes more efficient for over ca. 5000 cellids.
                arraydata = []
+               coalesce = False
                if lencellids>5000: 
                   result_size = len(cellids)
                   read_size = array_size
                   read_offsets = [0]
-               else: # Read multiple cell ids one-by-one
+               else: # Read multiple cell ids in runs of nearby cells
                   result_size = len(cellids)
                   read_size = 1
-                  read_offsets = [self.__fileindex_for_cellid[cid]*element_size*vector_size for cid in cellids]
+                  read_offsets = []
+                  coalesce = True
             except: # single cell or all cells
+               coalesce = False
                if cellids < 0: # -1, read all cells
                   result_size = array_size
                   read_size = array_size
@@ -1050,6 +1192,10 @@ class VlsvReader(object):
                   data = np.fromfile(fptr, dtype=np.uint64, count=vector_size*read_size)
                if len(read_offsets)!=1:
                   arraydata.append(data)
+
+            if coalesce:
+               data = self.__read_rows_coalesced(fptr, variable_offset, datatype, element_size, vector_size,
+                                                 [self.__fileindex_for_cellid[cid] for cid in cellids]).reshape(-1)
             
             if len(read_offsets)==1 and result_size<read_size:
                # Many single cell id's requested
@@ -1059,7 +1205,7 @@ class VlsvReader(object):
                   arraydata.append(data[append_offset:append_offset+vector_size])
                data = np.squeeze(np.array(arraydata))
 
-            if len(read_offsets)!=1:
+            if len(read_offsets)!=1 and not coalesce:
                # Not-so-many single cell id's requested
                data = np.squeeze(np.array(arraydata))
 
@@ -1120,9 +1266,7 @@ class VlsvReader(object):
             output = np.zeros(len(actualcellids))
             index = 0
             for singlecellid in actualcellids:
-               velocity_cell_data = self.read_velocity_cells(singlecellid)
-               # Get cells:
-               vcellids = list(velocity_cell_data.keys())
+               vcellids, velocity_cell_data = self.read_velocity_cells_array(singlecellid)
                # Get coordinates:
                velocity_coordinates = self.get_velocity_cell_coordinates(vcellids)
                tmp_vars = []
@@ -1178,6 +1322,8 @@ class VlsvReader(object):
             else:
                tvar = i.split('/',1)[1]
                tmp_vars.append( self.read( popname+'/'+tvar, tag, mesh, "pass", cellids ) )
+         if reducer.useReader:
+            return data_operators[operator](reducer.operation( tmp_vars, self ))
          return data_operators[operator](reducer.operation( tmp_vars ))
 
       fptr.close()
@@ -1248,23 +1394,31 @@ class VlsvReader(object):
       return -1
          
 
-   def read_interpolated_fsgrid_variable(self, name, coordinates, operator="pass",periodic=[True,True,True], method="linear"):
-      ''' Read a linearly interpolated FSgrid variable value from the open vlsv file. Feel free to vectorize!
-      Note that this does not account for varying centerings of fsgrid data.
+   def read_interpolated_fsgrid_variable(self, name, coordinates, operator="pass",periodic=[True,True,True], method="linear",
+                                         centering=None, fg_data=None, fg_offset=(0,0,0)):
+      ''' Read a linearly interpolated FSgrid variable value from the open vlsv file.
+      Vector components of staggered variables are interpolated from their own sample locations
+      (face-centred fg_b, edge-centred fg_e), see read_fg_variable_as_volumetric.
       Arguments:
       :param name: Name of the (FSgrid) variable
       :param coords: Coordinates from which to read data 
       :param periodic: Periodicity of the system. Default is periodic in all dimension
-      :param operator: Datareduction operator. "pass" does no operation on data
+      :param operator: Datareduction operator. "pass" does no operation on data. Applied after interpolation.
+      :param method: Interpolation method, default "linear", options: ["nearest", "linear"]
+      :param centering: Centering of the variable, "volume", "face" or "edge". Default: known centering of the variable, or "volume".
+      :param fg_data: Optional fsgrid array (or a subvolume of it, shaped [nx,ny,nz] or [nx,ny,nz,ncomponents]) to use instead
+                      of reading the variable from the file. By default a cached variable (see read_variable_to_cache) is used if present.
+      :param fg_offset: fsgrid index of the [0,0,0] element of fg_data. Points whose stencil leaves the subvolume get nans.
       :returns: numpy array with the data
 
-      .. seealso:: :func:`read` :func:`read_variable_info`
+      .. seealso:: :func:`read` :func:`read_variable_info` :func:`read_fg_variable_as_volumetric`
       '''
 
-      if method != "Linear":
-         raise NotImplementedError("interpolation method "+method+" not implemented for read_interpolated_fsgrid_variable, only linear supported so far.")
-      
-      warnings.warn("read_interpolated_fsgrid_variable: face- vs. edge- centered variables not accounted for!")
+      method = method.lower()
+      if method in interp_method_aliases.keys():
+         method = interp_method_aliases[method]
+      if method not in ["nearest", "linear"]:
+         raise NotImplementedError("interpolation method "+method+" not implemented for read_interpolated_fsgrid_variable, only linear and nearest supported so far.")
 
       if name[0:3] != 'fg_':
          raise ValueError("Interpolation of FsGrid called on non-FsGrid data; exiting.")
@@ -1272,104 +1426,244 @@ class VlsvReader(object):
       if (len(periodic)!=3):
          raise ValueError("Periodic must be a list of 3 booleans.")
 
-      #First off let's fetch the data and some meta
-      fg_data=self.read_fsgrid_variable( name,operator=operator)
-      fg_size=self.get_fsgrid_mesh_size()
-      nx,ny,nz=fg_size
-      extents=self.get_fsgrid_mesh_extent()
-      xmin,ymin,zmin,xmax,ymax,zmax=extents
-      dx=abs((xmax-xmin)/nx)
-      dy=abs((ymax-ymin)/ny)
-      dz=abs((zmax-zmin)/nz)
-
-      def getFsGridIndices(indices):
-         ''' 
-         Returns indices based on boundary conditions
-         '''
-         ind=-1*np.ones((3))
-         for c,index in enumerate(indices):
-            #Non periodic case
-            if ((index<0 or index>fg_size[c]-1) and not periodic[c]):
-               # Returns False, interpolateSingle converts that to nans
-               warnings.warn("Requested fsgrid index for interpolation outside simulation domain.", UserWarning)
-               return False
-             # Here we are either periodic or (not periodic and inside the domain)
-            if (index >= fg_size[c] or index <0):
-                ind[c] = index%fg_size[c]
-            elif (index>=0 and index<=fg_size[c]-1):
-                ind[c]=index
-            else:
-                #If we end up here then something is really wrong
-                raise ValueError("FsGrid interpolation ran into a failure and could not locate all neighbors.","Indices in question= ",indices)
-
-         return int(ind[0]),int(ind[1]),int(ind[2]) 
-
-
-
-      def interpolateSingle(r):
-         ''' 
-         Simple trilinear routine for interpolating fsGrid quantities 
-         at arbitrary coordinates r.
-         Inputs:
-             r: array of coordinates at which to perform the interpolation. 
-                Example: r=[x,y,z] in meters
-         Outputs:
-             Numpy array with interpolated data at r. Can be scalar or vector.
-         '''
-         import sys
-         if (len(r) !=3 ):
-            raise ValueError("Interpolation cannot be performed. Exiting")
-
-         x,y,z=r
-         xl=int(np.floor((x-xmin)/dx))
-         yl=int(np.floor((y-ymin)/dy))
-         zl=int(np.floor((z-zmin)/dz))
-    
-         #Normalize distances in a unit cube 
-         xd=(x-xmin)/dx - xl
-         yd=(y-ymin)/dy - yl
-         zd=(z-zmin)/dz - zl
-       
-         # Calculate Neighbors' Weights
-         w=np.zeros(8)
-         w[0] = (1.0-xd)*(1.0-yd)*(1.0-zd)
-         w[1] = (xd)*(1.0-yd)*(1.0-zd)
-         w[2] = (1.0-xd)*(yd)*(1.0-zd)
-         w[3] = (xd)*(yd)*(1.0-zd)
-         w[4] = (1.0-xd)*(1.0-yd)*(zd)
-         w[5] = (xd)*(1.0-yd)*(zd)
-         w[6] = (1.0-xd)*(yd)*(zd)
-         w[7] = (xd)*(yd)*(zd)
-
-         retval = np.zeros_like(fg_data[0,0,0])
-         for k in [0,1]:
-            for j in [0,1]:
-               for i in [0,1]:
-                  retind=getFsGridIndices([xl+i,yl+j,zl+k])
-                  if (not retind): retval.fill(np.nan) # outside of a non periodic domain
-                  retval += w[4*k+2*j+i]*fg_data[retind]
-
-         return retval
-
-      ret=[]
-      for r in coordinates:
-         ret.append(interpolateSingle(r))
-      return np.asarray(ret)
+      coordinates = np.array(get_data(coordinates), dtype=float)
+      stack = True
+      if coordinates.ndim == 1:
+         stack = False
+         coordinates = np.atleast_2d(coordinates)
+      if coordinates.shape[1] != 3:
+         raise IndexError("Coordinates are required to be three-dimensional (coords.shape[1]==3 or convertible to such))")
+
+      fg_size = np.array(self.get_fsgrid_mesh_size(), dtype=np.int64)
+      extents = self.get_fsgrid_mesh_extent()
+      mins = extents[0:3]
+      maxs = extents[3:6]
+      dxs = self.get_fsgrid_cell_size()
+
+      # Staggered data is interpolated per component, so read raw data and apply the operator afterwards
+      if fg_data is None:
+         if (name,"pass") in self.variable_cache.keys():
+            fg_data = self.variable_cache[(name,"pass")]
+         else:
+            fg_data = self.read_fsgrid_variable(name)
+         fg_offset = (0,0,0)
+         # read_fsgrid_variable squeezes singleton dimensions
+         fg_data = np.reshape(fg_data, tuple(fg_size)+(-1,))
+      else:
+         fg_data = np.reshape(fg_data, np.shape(fg_data)[0:3]+(-1,))
+      sub_size = np.array(fg_data.shape[0:3], dtype=np.int64)
+      fg_offset = np.array(fg_offset, dtype=np.int64)
+      ncomponents = fg_data.shape[3]
+
+      if centering is None:
+         centering = fsgrid_variable_centerings.get(name.lower(), "volume")
+      # Offsets (in cells) of the sample locations of each component, relative to the cell centres
+      shifts = np.zeros((ncomponents,3))
+      if centering == "face" or centering == "edge":
+         if ncomponents != 3:
+            raise ValueError("Centering "+centering+" requires a vector variable, "+name+" has "+str(ncomponents)+" components.")
+         if centering == "face":
+            shifts[np.arange(3),np.arange(3)] = -0.5
+         else:
+            shifts[:,:] = -0.5
+            shifts[np.arange(3),np.arange(3)] = 0
+      elif centering != "volume":
+         raise ValueError("Unknown centering ('" +centering+ "')")
+
+      ncoords = coordinates.shape[0]
+      scaled = (coordinates - mins[np.newaxis,:])/dxs[np.newaxis,:]
+      invalid = np.zeros(ncoords, dtype=bool)
+      for d in range(3):
+         if not periodic[d]:
+            invalid |= (coordinates[:,d] < mins[d]) | (coordinates[:,d] > maxs[d])
+      invalid |= ~np.all(np.isfinite(coordinates), axis=1)
+      scaled[invalid,:] = 0
+
+      def local_indices(indices, d):
+         # Wrap or clamp to the domain, then shift into the (sub)array
+         if periodic[d]:
+            indices = np.mod(indices, fg_size[d])
+         else:
+            indices = np.clip(indices, 0, fg_size[d]-1)
+         indices = indices - fg_offset[d]
+         outside = (indices < 0) | (indices >= sub_size[d])
+         return np.clip(indices, 0, sub_size[d]-1), outside
+
+      values = np.zeros((ncoords, ncomponents))
+      unique_shifts, component_groups = np.unique(shifts, axis=0, return_inverse=True)
+      component_groups = np.ravel(component_groups)
+      for g, shift in enumerate(unique_shifts):
+         comps = np.nonzero(component_groups == g)[0]
+         data = fg_data[:,:,:,comps]
+         u = scaled - 0.5 - shift[np.newaxis,:]
+         if method == "nearest":
+            inds = []
+            for d in range(3):
+               i, out = local_indices(np.floor(u[:,d] + 0.5).astype(np.int64), d)
+               inds.append(i)
+               invalid |= out
+            values[:,comps] = data[inds[0], inds[1], inds[2], :]
+         else:
+            lower = np.floor(u).astype(np.int64)
+            t = u - lower
+            inds = []
+            for d in range(3):
+               i0, out0 = local_indices(lower[:,d], d)
+               i1, out1 = local_indices(lower[:,d]+1, d)
+               inds.append((i0,i1))
+               invalid |= out0 | out1
+            for k in [0,1]:
+               wz = t[:,2] if k else 1-t[:,2]
+               for j in [0,1]:
+                  wy = t[:,1] if j else 1-t[:,1]
+                  for i in [0,1]:
+                     wx = t[:,0] if i else 1-t[:,0]
+                     values[:,comps] += (wx*wy*wz)[:,np.newaxis] * data[inds[0][i], inds[1][j], inds[2][k], :]
+
+      if np.any(invalid):
+         warnings.warn("Requested fsgrid interpolation outside simulation domain or fsgrid subvolume, output contains nans.", UserWarning)
+         values[invalid,:] = np.nan
+
+      if ncomponents == 1:
+         values = values[:,0]
+         if operator == "magnitude":
+            operator = "absolute"
+      values = data_operators[operator](values)
+
+      if stack:
+         return values
+      else:
+         return values[0]
 
    def read_interpolated_ionosphere_variable(self, name, coordinates, operator="pass", method="linear"):
       ''' Read a linearly interpolated ionosphere variable value from the open vlsv file.
+      Coordinates are projected radially onto the ionosphere mesh, so they need not lie exactly at the ionosphere radius.
       Arguments:
       :param name: Name of the (ionosphere) variable
       :param coords: Coordinates (x,y,z) from which to read data 
       :param operator: Datareduction operator. "pass" does no operation on data
-      :param method: Interpolation method. Not implemented; barycentric interp would fall under linear.
+      :param method: Interpolation method, default "linear" (barycentric within the mesh triangles), options: ["nearest", "linear"].
+                     Element-centred variables are piecewise constant in either case.
       :returns: numpy array with the data
 
-      .. seealso:: :func:`read` :func:`read_variable_info`
+      .. seealso:: :func:`read` :func:`read_variable_info` :func:`get_ionosphere_barycentric_coordinates`
       '''
+      if name[0:3] != 'ig_':
+         raise ValueError("Interpolation of ionosphere called on non-ionosphere data; exiting.")
+
+      method = method.lower()
+      if method in interp_method_aliases.keys():
+         method = interp_method_aliases[method]
+      if method not in ["nearest", "linear"]:
+         raise NotImplementedError("interpolation method "+method+" not implemented for read_interpolated_ionosphere_variable")
 
-      # At this stage, this function has not yet been implemented -- logging.info a warning and exit
-      raise NotImplementedError('Interpolation of ionosphere variables has not yet been implemented; exiting.')
+      coordinates = np.array(get_data(coordinates), dtype=float)
+      stack = True
+      if coordinates.ndim == 1:
+         stack = False
+         coordinates = np.atleast_2d(coordinates)
+      if coordinates.shape[1] != 3:
+         raise IndexError("Coordinates are required to be three-dimensional (coords.shape[1]==3 or convertible to such))")
+
+      data = self.read_ionosphere_variable(name, operator=operator)
+      elements, weights = self.get_ionosphere_barycentric_coordinates(coordinates)
+      corners = self.get_ionosphere_element_corners()
+      found = elements >= 0
+
+      if data.shape[0] == corners.shape[0]:
+         # Element-centred data
+         values = data[np.maximum(elements, 0)]
+      else:
+         element_corners = corners[np.maximum(elements, 0)]
+         if method == "nearest":
+            nearest = element_corners[np.arange(len(elements)), np.argmax(weights, axis=1)]
+            values = data[nearest]
+         elif data.ndim == 1:
+            values = np.sum(weights*data[element_corners], axis=1)
+         else:
+            values = np.sum(weights[:,:,np.newaxis]*data[element_corners], axis=1)
+
+      values = np.array(values, dtype=float)
+      if not np.all(found):
+         warnings.warn("Coordinate in ionosphere interpolation could not be projected onto the mesh, output contains nans", UserWarning)
+         values[~found] = np.nan
+
+      if stack:
+         return values
+      else:
+         return values[0]
+
+   def get_ionosphere_barycentric_coordinates(self, coordinates):
+      ''' Find the ionosphere mesh elements that contain the radial projections of the coordinates,
+      and the barycentric coordinates of the projections within the elements.
+
+      The lookup uses a KD-tree of the element centroids on the unit sphere, built on the first call and cached.
+
+      :param coordinates: Coordinates (x,y,z), numpy array (N,3) or (3,)
+      :returns: element indices (N,) [-1 if not found], barycentric weights of the element corners (N,3)
+
+      .. seealso:: :func:`get_ionosphere_element_corners` :func:`read_interpolated_ionosphere_variable`
+      '''
+      from scipy.spatial import cKDTree
+
+      coordinates = np.atleast_2d(np.array(coordinates, dtype=float))
+
+      if self.__ionosphere_index is None:
+         nodes = self.get_ionosphere_node_coords()
+         corners = self.get_ionosphere_element_corners()
+         if len(nodes) == 0 or len(corners) == 0:
+            raise ValueError("No ionosphere mesh in file " + self.file_name)
+         centroids = np.mean(nodes[corners], axis=1)
+         centroids /= np.linalg.norm(centroids, axis=1)[:,np.newaxis]
+         self.__ionosphere_index = (cKDTree(centroids), nodes, corners)
+      tree, nodes, corners = self.__ionosphere_index
+
+      npts = coordinates.shape[0]
+      elements = np.full(npts, -1, dtype=np.int64)
+      weights = np.full((npts, 3), np.nan)
+      radius = np.linalg.norm(coordinates, axis=1)
+      valid = radius > 0
+      directions = np.zeros_like(coordinates)
+      directions[valid] = coordinates[valid] / radius[valid,np.newaxis]
+
+      # Check the k nearest elements; widen the search for the few points not resolved yet
+      todo = np.nonzero(valid)[0]
+      best_elements = np.zeros(npts, dtype=np.int64)
+      best_weights = np.full((npts, 3), np.nan)
+      best_score = np.full(npts, -np.inf)
+      for k in [8, 64]:
+         if len(todo) == 0:
+            break
+         k = min(k, corners.shape[0])
+         dist, candidates = tree.query(directions[todo], k=k)
+         candidates = candidates.reshape(len(todo), k)
+         # Barycentric coordinates of the radial projection: solve [a b c] lambda = d, normalize to sum 1
+         tri = nodes[corners[candidates.ravel()]]          # (len(todo)*k, 3 corners, 3 components)
+         lam = solve3(tri.transpose(0,2,1), np.repeat(directions[todo], k, axis=0))
+         lam_sum = np.sum(lam, axis=1)
+         with np.errstate(divide='ignore', invalid='ignore'):
+            lam = lam / lam_sum[:,np.newaxis]
+         score = np.where(lam_sum > 0, np.min(lam, axis=1), -np.inf)
+         score[~np.isfinite(score)] = -np.inf
+         score = score.reshape(len(todo), k)
+         lam = lam.reshape(len(todo), k, 3)
+
+         pick = np.argmax(score, axis=1)
+         rows = np.arange(len(todo))
+         better = score[rows, pick] > best_score[todo]
+         best_score[todo[better]] = score[rows, pick][better]
+         best_elements[todo[better]] = candidates[rows, pick][better]
+         best_weights[todo[better]] = lam[rows, pick][better]
+
+         inside = best_score[todo] >= -1e-9
+         todo = todo[~inside]
+
+      found = best_score > -np.inf
+      elements[found] = best_elements[found]
+      # Points slightly outside any triangle (e.g. at mesh gaps) are snapped to the best candidate
+      w = np.clip(best_weights[found], 0, None)
+      weights[found] = w / np.sum(w, axis=1)[:,np.newaxis]
+      return elements, weights
 
    # These are the 8 cells that span the upper corner vertex on a regular grid
    def get_vg_regular_interp_neighbors(self, cellids):
@@ -1429,7 +1723,7 @@ class VlsvReader(object):
       if name[0:3] == 'fg_':
          return self.read_interpolated_fsgrid_variable(name, coords, operator, periodic, method)
       if name[0:3] == 'ig_':
-         return self.read_interpolated_ionosphere_variable(name, coords, operator, periodic, method)
+         return self.read_interpolated_ionosphere_variable(name, coords, operator, method)
 
       # case vg
 
@@ -1582,7 +1876,7 @@ class VlsvReader(object):
       if name[0:3] == 'fg_':
          return self.read_interpolated_fsgrid_variable(name, coords, operator, periodic, method)
       if name[0:3] == 'ig_':
-         return self.read_interpolated_ionosphere_variable(name, coords, operator, periodic, method)
+         return self.read_interpolated_ionosphere_variable(name, coords, operator, method)
 
       # Default case: AMR grid
 
@@ -1702,6 +1996,13 @@ class VlsvReader(object):
          else:
             logging.info("Did not find FsGrid decomposition from vlsv file.")
        
+       # A decomposition already found or computed for another file of the same run
+       if self.__fsGridDecomposition is None and self.__shared is not None:
+          shared_decomposition = self.__shared.__fsGridDecomposition
+          if shared_decomposition is not None and self.__shared.read_parameter("numWritingRanks") == numWritingRanks:
+             self.__fsGridDecomposition = shared_decomposition
+             logging.info("Using FsGrid decomposition of " + self.__shared.file_name)
+
        # If decomposition is None even after reading, we need to calculate it:
        if self.__fsGridDecomposition is None:
           logging.info("Calculating fsGrid decomposition from the file")
@@ -1760,10 +2061,9 @@ class VlsvReader(object):
          for dim in singletons:
             fgdata=np.expand_dims(fgdata, dim)
       celldata = np.zeros_like(fgdata)
-      known_centerings = {"fg_b":"face", "fg_e":"edge"}
       if centering is None:
          try:
-            centering = known_centerings[name.lower()]
+            centering = fsgrid_variable_centerings[name.lower()]
          except KeyError:
             logging.info("A variable ("+name+") with unknown centering! Aborting.")
             return False
@@ -1796,6 +2096,9 @@ class VlsvReader(object):
 
        ... seealso:: :func:`read_variable`
        '''
+       if (name,operator) in self.variable_cache.keys():
+          return self.variable_cache[(name,operator)]
+
        # Read the raw array data
        rawData = self.read(mesh='ionosphere', name=name, tag="VARIABLE", operator=operator)
 
@@ -2174,6 +2477,220 @@ class VlsvReader(object):
 
       return self.__vg_indexes_on_fg
 
+   def get_uniform_mesh_map(self, low=None, up=None, reflevel=None):
+      ''' Returns a mapping from the SpatialGrid cells intersecting a box onto a uniform voxel grid at a given refinement level.
+      The map is built on the first call and cached, so that it can be reused for any number of variables, and it can be
+      passed on to readers of other files of the same run (see :func:`read_variable_as_uniform`).
+
+      :param low:       Lower corner of the box [x,y,z] in meters, defaults to the lower corner of the simulation domain
+      :param up:        Upper corner of the box [x,y,z] in meters, defaults to the upper corner of the simulation domain
+      :param reflevel:  Refinement level of the voxels, defaults to the maximum refinement level. Coarser levels aggregate the
+                        underlying cells, finer levels duplicate them.
+      :returns: a dictionary with the keys
+                "shape" (voxel counts), "low", "up" (box snapped outwards to voxel boundaries), "reflevel",
+                "index_range" (voxel index range of the box), "grid" (spatial mesh size and extent),
+                "cellids" (intersecting cells), "fileindices" (their indices in this file),
+                "cell_index", "voxel_index", "weights" (cell-voxel pairs and cell volume fractions of a voxel)
+                and "unique" (True if every voxel is covered by a single cell).
+
+      .. seealso:: :func:`read_variable_as_uniform`
+      '''
+      extent = self.get_spatial_mesh_extent()
+      size = self.get_spatial_mesh_size().astype(np.int64)
+      if reflevel is None:
+         reflevel = self.get_max_refinement_level()
+      reflevel = int(reflevel)
+      if reflevel < 0:
+         raise ValueError("Refinement level must be non-negative, got "+str(reflevel))
+      if low is None:
+         low = extent[0:3]
+      if up is None:
+         up = extent[3:6]
+
+      # Snap the box outwards to the voxel grid
+      nvoxels = size * 2**reflevel
+      dxs = (extent[3:6] - extent[0:3]) / nvoxels
+      lo = np.clip(np.floor((np.array(low, dtype=float) - extent[0:3]) / dxs), 0, nvoxels).astype(np.int64)
+      hi = np.clip(np.ceil((np.array(up, dtype=float) - extent[0:3]) / dxs), 0, nvoxels).astype(np.int64)
+      hi = np.maximum(hi, np.minimum(lo + 1, nvoxels))
+      lo = np.minimum(lo, hi - 1)
+
+      key = (tuple(lo), tuple(hi), reflevel)
+      if key in self.__uniform_mesh_maps:
+         return self.__uniform_mesh_maps[key]
+
+      shape = hi - lo
+      cellids = np.atleast_1d(self.read_variable("CellID")).astype(np.int64)
+      amr_levels = np.atleast_1d(self.get_amr_level(cellids))
+
+      fileindices = []
+      cell_index = []
+      voxel_index = []
+      weights = []
+      nread = 0
+      for level in range(self.get_max_refinement_level()+1):
+         at_level = np.flatnonzero(amr_levels == level)
+         if len(at_level) == 0:
+            continue
+         indices = np.atleast_2d(self.get_cell_indices(cellids[at_level], np.full(len(at_level), level)))
+         if level <= reflevel:
+            # Every cell covers a block of voxels
+            width = 2**(reflevel - level)
+            vlow = indices * width
+            vhigh = vlow + width
+         else:
+            # Several cells fall into a voxel
+            vlow = indices // 2**(level - reflevel)
+            vhigh = vlow + 1
+         inside = np.all((vhigh > lo) & (vlow < hi), axis=1)
+         at_level = at_level[inside]
+         vlow = vlow[inside]
+         if len(at_level) == 0:
+            continue
+         fileindices.append(at_level)
+         if level <= reflevel:
+            # Block broadcasting of each cell onto its voxels, separably along each axis
+            axes = [vlow[:, d, np.newaxis] + np.arange(width)[np.newaxis, :] for d in range(3)]
+            keep = [(axes[d] >= lo[d]) & (axes[d] < hi[d]) for d in range(3)]
+            axes = [axes[d] - lo[d] for d in range(3)]
+            voxels = (axes[0][:, :, np.newaxis, np.newaxis] * shape[1] + axes[1][:, np.newaxis, :, np.newaxis]) * shape[2] + axes[2][:, np.newaxis, np.newaxis, :]
+            owners = np.broadcast_to(np.arange(nread, nread+len(at_level))[:, np.newaxis, np.newaxis, np.newaxis], voxels.shape)
+            keep = keep[0][:, :, np.newaxis, np.newaxis] & keep[1][:, np.newaxis, :, np.newaxis] & keep[2][:, np.newaxis, np.newaxis, :]
+            voxel_index.append(voxels[keep])
+            owners = owners[keep]
+            weights.append(np.ones(len(owners)))
+         else:
+            voxels = vlow - lo
+            voxel_index.append((voxels[:, 0] * shape[1] + voxels[:, 1]) * shape[2] + voxels[:, 2])
+            owners = np.arange(nread, nread+len(at_level))
+            weights.append(np.full(len(owners), 0.125**(level - reflevel)))
+         cell_index.append(owners)
+         nread += len(at_level)
+
+      if nread == 0:
+         fileindices = np.zeros(0, dtype=np.int64)
+         cell_index = np.zeros(0, dtype=np.int64)
+         voxel_index = np.zeros(0, dtype=np.int64)
+         weights = np.zeros(0)
+      else:
+         fileindices = np.concatenate(fileindices)
+         cell_index = np.concatenate(cell_index)
+         voxel_index = np.concatenate(voxel_index)
+         weights = np.concatenate(weights)
+
+      mesh_map = {"shape": tuple(shape),
+                  "low": extent[0:3] + lo * dxs,
+                  "up": extent[0:3] + hi * dxs,
+                  "reflevel": reflevel,
+                  "index_range": (lo, hi),
+                  "grid": (size, extent),
+                  "cellids": cellids[fileindices],
+                  "fileindices": fileindices,
+                  "cell_index": cell_index,
+                  "voxel_index": voxel_index,
+                  "weights": weights,
+                  "unique": bool(np.all(weights == 1))}
+      self.__uniform_mesh_maps[key] = mesh_map
+      return mesh_map
+
+   def __adopt_uniform_mesh_map(self, mesh_map):
+      ''' Returns a copy of a uniform mesh map built by another reader, with the file indices of this file,
+      or None if the SpatialGrid of this file differs from the mapped one within the box.
+      '''
+      if not (np.array_equal(mesh_map["grid"][0], self.get_spatial_mesh_size()) and np.allclose(mesh_map["grid"][1], self.get_spatial_mesh_extent())):
+         return None
+      self.__read_fileindex_for_cellid()
+      # The mapped cells tile the box, so the grids are identical in the box if all of them exist in this file
+      if not np.all(dict_keys_exist(self.__fileindex_for_cellid, mesh_map["cellids"])):
+         return None
+      adopted = dict(mesh_map)
+      adopted["fileindices"] = np.array([self.__fileindex_for_cellid[cellid] for cellid in mesh_map["cellids"]], dtype=np.int64)
+      lo, hi = mesh_map["index_range"]
+      self.__uniform_mesh_maps[(tuple(lo), tuple(hi), mesh_map["reflevel"])] = adopted
+      return adopted
+
+   def read_variable_as_uniform(self, name, low=None, up=None, reflevel=None, operator="pass", aggregation="mean", mesh_map=None):
+      ''' Reads a SpatialGrid variable in a box and resamples it onto a uniform grid at the given refinement level.
+      Only the cells intersecting the box are read. Cells coarser than the voxels are duplicated onto all of their voxels,
+      cells finer than the voxels are aggregated.
+
+      :param name:         Name of the variable
+      :param low:          Lower corner of the box [x,y,z] in meters, defaults to the lower corner of the simulation domain
+      :param up:           Upper corner of the box [x,y,z] in meters, defaults to the upper corner of the simulation domain
+      :param reflevel:     Refinement level of the voxels, defaults to the maximum refinement level
+      :param operator:     Datareduction operator. "pass" does no operation on data
+      :param aggregation:  How cells finer than the voxels are combined, "mean" (volume-weighted), "min" or "max"
+      :param mesh_map:     A map returned by :func:`get_uniform_mesh_map`, possibly of another file of the same run.
+                           Overrides low, up and reflevel. If the grid of this file differs from the mapped one, a new map is built.
+      :returns: numpy array of shape [nx, ny, nz] + variable shape, indexed as [x, y, z]. The box extents are given by
+                :func:`get_uniform_mesh_map`.
+
+      .. code-block:: python
+
+          # Example usage:
+          rho = vlsvReader.read_variable_as_uniform("vg_rho", low=[-3e7,-3e7,-1e7], up=[3e7,3e7,1e7], reflevel=1)
+          mesh_map = vlsvReader.get_uniform_mesh_map(low=[-3e7,-3e7,-1e7], up=[3e7,3e7,1e7], reflevel=1)
+          b = nextReader.read_variable_as_uniform("vg_b_vol", mesh_map=mesh_map)
+
+      .. seealso:: :func:`get_uniform_mesh_map` :func:`read_variable`
+      '''
+      if not aggregation in ("mean", "min", "max"):
+         raise ValueError("Unknown aggregation "+str(aggregation)+", use mean, min or max")
+
+      if mesh_map is None:
+         mesh_map = self.get_uniform_mesh_map(low, up, reflevel)
+      else:
+         lo, hi = mesh_map["index_range"]
+         key = (tuple(lo), tuple(hi), mesh_map["reflevel"])
+         if key in self.__uniform_mesh_maps:
+            mesh_map = self.__uniform_mesh_maps[key]
+         else:
+            adopted = self.__adopt_uniform_mesh_map(mesh_map)
+            if adopted is None:
+               logging.info("SpatialGrid differs from the given mesh map, building a new one")
+               adopted = self.get_uniform_mesh_map(mesh_map["low"], mesh_map["up"], mesh_map["reflevel"])
+            mesh_map = adopted
+
+      shape = mesh_map["shape"]
+      nvoxels = int(np.prod(shape))
+      fileindices = mesh_map["fileindices"]
+      if len(fileindices) == 0:
+         logging.info("No cells found in the box")
+         return np.full(shape, np.nan)
+
+      # Reading many scattered cells one by one is slower than reading the whole variable
+      if len(fileindices) > 5000:
+         data = np.atleast_1d(self.read_variable(name, operator=operator))[fileindices]
+      else:
+         data = np.array(self.read_variable(name, cellids=mesh_map["cellids"].tolist(), operator=operator))
+         if len(fileindices) == 1:
+            data = data[np.newaxis]
+      valueshape = data.shape[1:]
+      data = data.reshape(len(fileindices), -1)
+
+      output = np.full((nvoxels, data.shape[1]), np.nan, dtype=np.result_type(data.dtype, np.float32))
+      cell_index = mesh_map["cell_index"]
+      voxel_index = mesh_map["voxel_index"]
+      if mesh_map["unique"]:
+         output[voxel_index] = data[cell_index]
+      else:
+         if not "reduce_order" in mesh_map:
+            order = np.argsort(voxel_index, kind="stable")
+            sorted_voxels = voxel_index[order]
+            starts = np.flatnonzero(np.concatenate(([True], sorted_voxels[1:] != sorted_voxels[:-1])))
+            mesh_map["reduce_order"] = (order, starts, sorted_voxels[starts])
+         order, starts, voxels = mesh_map["reduce_order"]
+         values = data[cell_index[order]]
+         if aggregation == "mean":
+            weights = mesh_map["weights"][order]
+            output[voxels] = np.add.reduceat(values * weights[:, np.newaxis], starts, axis=0) / np.add.reduceat(weights, starts)[:, np.newaxis]
+         elif aggregation == "min":
+            output[voxels] = np.minimum.reduceat(values, starts, axis=0)
+         else:
+            output[voxels] = np.maximum.reduceat(values, starts, axis=0)
+
+      return output.reshape(tuple(shape) + valueshape)
+
    def get_cell_fsgrid(self, cellid):
       '''Returns a slice tuple of fsgrid indices that are contained in the SpatialGrid
       cell.
@@ -2282,6 +2799,23 @@ class VlsvReader(object):
       else:
          return cellids[0]
 
+   def __get_vdf_cell_tree(self, pop):
+      ''' Returns a KD-tree of the coordinates of the cells that contain VDFs for the given population, and the corresponding cell ids.
+      The tree is built on the first call and cached per population.
+
+      .. seealso:: :func:`get_cellid_with_vdf` :func:`get_cellids_with_vdf_nearest` :func:`get_cellids_with_vdf_within`
+      '''
+      if not pop in self.__cells_with_blocks_tree:
+         from scipy.spatial import cKDTree
+         if not pop in self.__cells_with_blocks:
+            self.__set_cell_offset_and_blocks_nodict(pop)
+         cid_w_vdf = np.array(self.__cells_with_blocks[pop], dtype=np.int64)
+         if len(cid_w_vdf) == 0:
+            raise ValueError("No velocity distributions found for population " + pop)
+         coords_w_vdf = np.atleast_2d(self.get_cell_coordinates(cid_w_vdf))
+         self.__cells_with_blocks_tree[pop] = (cKDTree(coords_w_vdf), cid_w_vdf)
+      return self.__cells_with_blocks_tree[pop]
+
    def get_cellid_with_vdf(self, coords, pop = 'proton'):
       ''' Returns the cell ids nearest to test points, that contain VDFs
 
@@ -2291,6 +2825,7 @@ class VlsvReader(object):
       Example: cellid = vlsvReader.get_cellid_with_vdf(np.array([1e8, 0, 0]))
       :returns: the cell ids
 
+      .. seealso:: :func:`get_cellids_with_vdf_nearest` :func:`get_cellids_with_vdf_within`
       '''
       stack = True
       coords_in = np.array(coords)
@@ -2300,41 +2835,20 @@ class VlsvReader(object):
 
       if not pop in self.__cells_with_blocks:
          self.__set_cell_offset_and_blocks_nodict(pop)
-      cid_w_vdf = self.__cells_with_blocks[pop]
-      coords_w_vdf = self.get_cell_coordinates(cid_w_vdf)
-      N_in = coords_in.shape[0]; N_w_vdf = len(cid_w_vdf)
 
-      if N_w_vdf==0:
+      if len(self.__cells_with_blocks[pop])==0:
          logging.info("Error: No velocity distributions found!")
          sys.exit()
 
       # Boolean array flag_empty_in indicates if queried points (coords_in) don't already lie within vdf-containing cells, 
-      output = self.get_cellid(coords_in)
-      flag_empty_in = np.array( [cid not in self.__order_for_cellid_blocks[pop] for cid in output] )
-      N_empty_in = sum(flag_empty_in)
+      output = np.atleast_1d(self.get_cellid(coords_in))
+      flag_empty_in = ~dict_keys_exist(self.__order_for_cellid_blocks[pop], output)
 
-      if N_empty_in == 0:   # every element of coords_in already within a vdf-containing cell
-         if stack:
-            return output
-         else:
-            return output[0]
-      
-      # Direct search: calculate distances for each pair points (test <--> vdf cells)
-      # Only calculate nearest distance if there is no VDF already in the cell (using flag_empty_in) 
-      '''
-      try:
-         # Vectorized approach: 
-         dist2 = np.nansum((coords_in[flag_empty_in, None, :] - coords_w_vdf[None, :, :])**2, axis = -1)   # distance^2, shape [N_empty_in, N_w_vdf]
-         output[flag_empty_in] = cid_w_vdf[np.argmin(dist2, axis = 1)]
-      except MemoryError:
-      '''
-      # Loop approach:
-      logging.info('Not enough memory to broadcast arrays! Using a loop instead...')
-      ind_emptycell = np.arange(len(flag_empty_in))[flag_empty_in]
-      for ind in ind_emptycell:
-         this_coord = coords_in[ind, :]
-         dist2 = np.nansum((coords_w_vdf - this_coord)**2, axis = -1)
-         output[ind] = cid_w_vdf[np.argmin(dist2)]
+      # Only search for the nearest VDF cell if there is no VDF already in the cell (using flag_empty_in)
+      if np.any(flag_empty_in):
+         tree, cid_w_vdf = self.__get_vdf_cell_tree(pop)
+         dist, ind = tree.query(coords_in[flag_empty_in, :])
+         output[flag_empty_in] = cid_w_vdf[ind]
 
       # return cells that minimize the distance to the test points
       if stack:
@@ -2342,6 +2856,63 @@ class VlsvReader(object):
       else:
          return output[0]
 
+   def get_cellids_with_vdf_nearest(self, coords, k = 1, pop = 'proton', distance_upper_bound = np.inf):
+      ''' Returns the k cell ids nearest to the test points that contain VDFs, ordered by distance to the cell centres.
+      Useful e.g. for averaging VDFs around a virtual spacecraft position.
+
+      :param coords:    Test coordinates [meters], array with shape [N, 3] or [3]
+      :param k:         Number of nearest VDF cells to return
+      :param pop:       Population name
+      :param distance_upper_bound: Only return cells within this distance [meters]; missing neighbours are given as cell id 0 and distance inf
+      :returns: cell ids and distances [meters], arrays with shape [N, k] (or [k] for a single test point)
+
+      Example: cellids, distances = vlsvReader.get_cellids_with_vdf_nearest(np.array([1e8, 0, 0]), k=8)
+
+      .. seealso:: :func:`get_cellid_with_vdf` :func:`get_cellids_with_vdf_within`
+      '''
+      stack = True
+      coords_in = np.array(coords, dtype=float)
+      if len(coords_in.shape) == 1:
+         coords_in = np.atleast_2d(coords_in)
+         stack = False
+
+      tree, cid_w_vdf = self.__get_vdf_cell_tree(pop)
+      dist, ind = tree.query(coords_in, k=[i+1 for i in range(k)], distance_upper_bound=distance_upper_bound)
+      found = ind < len(cid_w_vdf)
+      cellids = np.zeros(ind.shape, dtype=np.int64)
+      cellids[found] = cid_w_vdf[ind[found]]
+
+      if stack:
+         return cellids, dist
+      else:
+         return cellids[0], dist[0]
+
+   def get_cellids_with_vdf_within(self, coords, radius, pop = 'proton'):
+      ''' Returns the cell ids whose centres lie within the given radius of the test points and that contain VDFs.
+
+      :param coords:    Test coordinates [meters], array with shape [N, 3] or [3]
+      :param radius:    Search radius [meters]
+      :param pop:       Population name
+      :returns: a list of N arrays of cell ids, sorted by cell id (or a single array for a single test point)
+
+      Example: cellids = vlsvReader.get_cellids_with_vdf_within(np.array([1e8, 0, 0]), 3e6)
+
+      .. seealso:: :func:`get_cellid_with_vdf` :func:`get_cellids_with_vdf_nearest`
+      '''
+      stack = True
+      coords_in = np.array(coords, dtype=float)
+      if len(coords_in.shape) == 1:
+         coords_in = np.atleast_2d(coords_in)
+         stack = False
+
+      tree, cid_w_vdf = self.__get_vdf_cell_tree(pop)
+      output = [np.sort(cid_w_vdf[np.array(inds, dtype=np.int64)]) for inds in tree.query_ball_point(coords_in, radius)]
+
+      if stack:
+         return output
+      else:
+         return output[0]
+
    def get_vertex_indices(self, coordinates):
       ''' Get dual grid vertex indices for all coordinates.
       
@@ -2863,39 +3434,61 @@ class VlsvReader(object):
       vcellid += int(cell_index[2] * WID2)
       return vcellid
 
-   def get_velocity_cell_coordinates(self, vcellids, pop="proton"):
+   def get_velocity_lookup_tables(self, pop="proton", dtype=np.float64):
+      ''' Returns the cached velocity coordinate lookup tables of a population.
+      The velocity mesh of a population is fixed, so the tables are built on the first call and reused by all coordinate queries.
+
+      :param pop:    Population name
+      :param dtype:  Floating point type of the tables, np.float32 halves the memory of the coordinates of large VDFs
+      :returns: tuple (block_corners, cell_offsets), where block_corners is a list of three arrays holding the lower corner
+                coordinates of the blocks along vx, vy and vz, and cell_offsets [WID^3, 3] holds the offsets of the velocity
+                cell centres from the lower corner of their block.
+
+      .. seealso:: :func:`get_velocity_cell_coordinates` :func:`construct_velocity_cell_coordinates`
+      '''
+      key = (pop, np.dtype(dtype))
+      if not key in self.__velocity_lookup_tables:
+         WID = self.get_WID()
+         mesh = self.__meshes[pop]
+         blocks = [int(mesh.__vxblocks), int(mesh.__vyblocks), int(mesh.__vzblocks)]
+         vmin = [mesh.__vxmin, mesh.__vymin, mesh.__vzmin]
+         dv = np.array([mesh.__dvx, mesh.__dvy, mesh.__dvz])
+         block_corners = [(np.arange(blocks[i]).astype(float) * dv[i] * WID + vmin[i]).astype(dtype) for i in range(3)]
+         local = np.arange(WID**3)
+         cell_indices = np.stack((local % WID, (local // WID) % WID, local // (WID*WID)), axis=-1)
+         cell_offsets = ((cell_indices.astype(float) + 0.5) * dv).astype(dtype)
+         self.__velocity_lookup_tables[key] = (block_corners, cell_offsets)
+      return self.__velocity_lookup_tables[key]
+
+   def get_velocity_block_centers(self, blocks, pop="proton", dtype=np.float64):
+      ''' Returns the centre coordinates of the given velocity blocks
+
+      :param blocks:  Velocity block ids
+      :param pop:     Population name
+      :param dtype:   Floating point type of the coordinates
+      :returns: a numpy array [N, 3] with the block centre coordinates
+
+      .. seealso:: :func:`get_velocity_block_coordinates` :func:`get_velocity_lookup_tables`
+      '''
+      WID = self.get_WID()
+      dv = self.get_velocity_mesh_dv(pop)
+      return (self.get_velocity_block_coordinates(blocks, pop, dtype=np.float64) + 0.5 * WID * dv).astype(dtype)
+
+   def get_velocity_cell_coordinates(self, vcellids, pop="proton", dtype=np.float64):
       ''' Returns a given velocity cell's coordinates as a numpy array
 
       Arguments:
       :param vcellids:       The velocity cell's ID
+      :param dtype:          Floating point type of the coordinates, np.float32 halves the memory for large VDFs
       :returns: a numpy array with the coordinates
 
-      .. seealso:: :func:`get_cell_coordinates` :func:`get_velocity_block_coordinates`
+      .. seealso:: :func:`get_cell_coordinates` :func:`get_velocity_block_coordinates` :func:`get_velocity_lookup_tables`
       '''
-      vcellids = np.atleast_1d(vcellids)
-      WID=self.get_WID()
-      WID2=WID*WID
-      WID3=WID2*WID
-      # Get block ids:
-      blocks = vcellids.astype(int) // WID3
-      # Get block coordinates:
-      blockIndicesX = np.remainder(blocks.astype(int), (int)(self.__meshes[pop].__vxblocks))
-      blockIndicesY = np.remainder(blocks.astype(int)//(int)(self.__meshes[pop].__vxblocks), (int)(self.__meshes[pop].__vyblocks))
-      blockIndicesZ = blocks.astype(int)//(int)(self.__meshes[pop].__vxblocks*self.__meshes[pop].__vyblocks)
-      blockCoordinatesX = blockIndicesX.astype(float) * self.__meshes[pop].__dvx * WID + self.__meshes[pop].__vxmin
-      blockCoordinatesY = blockIndicesY.astype(float) * self.__meshes[pop].__dvy * WID + self.__meshes[pop].__vymin
-      blockCoordinatesZ = blockIndicesZ.astype(float) * self.__meshes[pop].__dvz * WID + self.__meshes[pop].__vzmin
-      # Get cell indices:
-      cellids = np.remainder(vcellids.astype(int), (int)(WID3))
-      cellIndicesX = np.remainder(cellids.astype(int), (int)(WID))
-      cellIndicesY = np.remainder((cellids.astype(int)//(int)(WID)).astype(int), (int)(WID))
-      cellIndicesZ = cellids.astype(int)//(int)(WID2)
-      # Get cell coordinates:
-      cellCoordinates = np.array([blockCoordinatesX.astype(float) + (cellIndicesX.astype(float) + 0.5) * self.__meshes[pop].__dvx,
-                                  blockCoordinatesY.astype(float) + (cellIndicesY.astype(float) + 0.5) * self.__meshes[pop].__dvy,
-                                  blockCoordinatesZ.astype(float) + (cellIndicesZ.astype(float) + 0.5) * self.__meshes[pop].__dvz])
-
-      return cellCoordinates.transpose()
+      vcellids = np.atleast_1d(vcellids).astype(np.int64)
+      WID3 = self.get_WID()**3
+      _, cell_offsets = self.get_velocity_lookup_tables(pop, dtype)
+      blocks, cells = np.divmod(vcellids, WID3)
+      return self.get_velocity_block_coordinates(blocks, pop, dtype=dtype) + cell_offsets[cells]
 
    def get_velocity_block_indices( self, blocks, pop="proton"):
       ''' Returns the block indices of the given blocks in a numpy array
@@ -2924,25 +3517,23 @@ class VlsvReader(object):
       GIDs = bIZ + bIY*self.__meshes[pop].__vzblocks + bIX*self.__meshes[pop].__vzblocks*self.__meshes[pop].__vyblocks
       return GIDs
 
-   def get_velocity_block_coordinates( self, blocks, pop="proton"):
+   def get_velocity_block_coordinates( self, blocks, pop="proton", dtype=np.float64):
       ''' Returns the block coordinates of the given blocks in a numpy array
 
           :param blocks:         list of block ids
-          :returns: a numpy array containing the block coordinates e.g. np.array([np.array([2,1,3]), np.array([5,6,6]), ..])
+          :param dtype:          Floating point type of the coordinates
+          :returns: a numpy array containing the coordinates of the lower corners of the blocks e.g. np.array([np.array([2,1,3]), np.array([5,6,6]), ..])
 
-          .. seealso:: :func:`get_velocity_cell_coordinates`
+          .. seealso:: :func:`get_velocity_cell_coordinates` :func:`get_velocity_block_centers`
       '''
-      WID=self.get_WID()
-      blockIndicesX = np.remainder(blocks.astype(int), (int)(self.__meshes[pop].__vxblocks))
-      blockIndicesY = np.remainder(blocks.astype(int)//(int)(self.__meshes[pop].__vxblocks), (int)(self.__meshes[pop].__vyblocks))
-      blockIndicesZ = blocks.astype(int)//(int)(self.__meshes[pop].__vxblocks*self.__meshes[pop].__vyblocks)
-      blockCoordinatesX = blockIndicesX.astype(float) * self.__meshes[pop].__dvx * WID + self.__meshes[pop].__vxmin
-      blockCoordinatesY = blockIndicesY.astype(float) * self.__meshes[pop].__dvy * WID + self.__meshes[pop].__vymin
-      blockCoordinatesZ = blockIndicesZ.astype(float) * self.__meshes[pop].__dvz * WID + self.__meshes[pop].__vzmin
+      blocks = np.atleast_1d(blocks).astype(np.int64)
+      block_corners, _ = self.get_velocity_lookup_tables(pop, dtype)
+      vxblocks = len(block_corners[0])
+      vyblocks = len(block_corners[1])
       # Return the coordinates:
-      return np.array([blockCoordinatesX.astype(float),
-                       blockCoordinatesY.astype(float),
-                       blockCoordinatesZ.astype(float)]).transpose()
+      yz, ix = np.divmod(blocks, vxblocks)
+      iz, iy = np.divmod(yz, vyblocks)
+      return np.stack((block_corners[0][ix], block_corners[1][iy], block_corners[2][iz]), axis=-1)
 
    def get_velocity_blocks( self, blockCoordinates, pop="proton" ):
       ''' Returns the block ids of the given block coordinates in a numpy array form
@@ -2967,16 +3558,19 @@ class VlsvReader(object):
       '''
       WID=self.get_WID()
       WID3=WID*WID*WID
-      return np.ravel(np.outer(np.array(blocks), np.ones(WID3)) + np.arange(WID3))
+      return np.ravel(np.array(blocks, dtype=np.int64)[:, np.newaxis] * WID3 + np.arange(WID3))
 
-   def construct_velocity_cell_coordinates( self, blocks ):
+   def construct_velocity_cell_coordinates( self, blocks, pop="proton", dtype=np.float64 ):
       ''' Returns velocity cell coordinates in given blocks
 
           :param blocks:         list of block ids
-          :returns: a numpy array containing the velocity cell ids e.g. np.array([4,2,56,44,522, ..])
+          :param dtype:          Floating point type of the coordinates
+          :returns: a numpy array [N*WID^3, 3] containing the velocity cell coordinates, ordered as :func:`construct_velocity_cells`
       '''
-      # Construct velocity cell coordinates from velocity cells and return them
-      return self.get_velocity_cell_coordinates( self.construct_velocity_cells(blocks) )
+      # Block corners plus the intra-block offset table
+      _, cell_offsets = self.get_velocity_lookup_tables(pop, dtype)
+      corners = self.get_velocity_block_coordinates(blocks, pop, dtype=dtype)
+      return (corners[:, np.newaxis, :] + cell_offsets[np.newaxis, :, :]).reshape(-1, 3)
 
 
    def construct_velocity_cell_nodes( self, blocks, pop="proton" ):
@@ -3127,45 +3721,18 @@ class VlsvReader(object):
       return self.read(name=name, tag="PARAMETER")
 
 
-   def read_velocity_cells(self, cellid, pop="proton"):
-      ''' Read velocity cells from a spatial cell
-      
-      :param cellid: Cell ID of the cell whose velocity cells the function will read
-      :returns: Map of velocity cell ids (unique for every velocity cell) and corresponding value
-
-      #Example:
-
-      example_cellid = 1111
-
-      velocity_cell_map = vlsvReader.read_velocity_cells(example_cellid)
-      velocity_cell_ids = velocity_cell_map.keys()
-      velocity_cell_values = velocity_cell_map.values()
-
-      random_index = 4 # Just some index
-      random_velocity_cell_id = velocity_cell_ids[random_index]
-
-      print ("Velocity cell value at velocity cell id " + str(random_velocity_cell_id) + ": " + str(velocity_cell_map[random_velocity_cell_id]))
-
-      # Getting the corresponding coordinates might be more useful than having the velocity cell id so:
-      velocity_cell_coordinates = vlsvReader.get_velocity_cell_coordinates(velocity_cell_ids) # Get velocity cell coordinates corresponding to each velocity cell id
-
-      random_velocity_cell_coordinates = velocity_cell_ids[random_index]
-      print("Velocity cell value at velocity cell id " + str(random_velocity_cell_id) + "and coordinates " + str(random_velocity_cell_coordinates) + ": " + str(velocity_cell_map[random_velocity_cell_id]))
-
-      .. seealso:: :func:`read_blocks`
+   def __get_velocity_block_range(self, cellid, pop="proton"):
+      ''' Returns the offset of the first velocity block of a spatial cell in the block arrays, and the number of its blocks.
+      Returns None if the cell does not have a velocity distribution.
       '''
-      
       if self.use_dict_for_blocks: # old deprecated version, uses dict for blocks data
          if not pop in self.__fileindex_for_cellid_blocks:
             self.__set_cell_offset_and_blocks(pop) 
          # Check that cells has vspace
          if not cellid in self.__fileindex_for_cellid_blocks[pop]:
-            warnings.warn("Cell(s) does not have velocity distribution")
-            return {}
-         # Navigate to the correct position:
+            return None
          offset = self.__fileindex_for_cellid_blocks[pop][cellid][0]
          num_of_blocks = self.__fileindex_for_cellid_blocks[pop][cellid][1]
-
       else:  # Uses arrays (much faster to initialize)
          if not pop in self.__cells_with_blocks:
             self.__set_cell_offset_and_blocks_nodict(pop) 
@@ -3173,98 +3740,205 @@ class VlsvReader(object):
          try:
             cells_with_blocks_index = self.__order_for_cellid_blocks[pop][cellid]
          except:
-            warnings.warn("Cell(s) does not have velocity distribution")
-            return {}
-         # Navigate to the correct position:
+            return None
          offset = self.__blocks_per_cell_offsets[pop][cells_with_blocks_index]
          num_of_blocks = self.__blocks_per_cell[pop][cells_with_blocks_index]
+      return int(offset), int(num_of_blocks)
+
+   def __get_velocity_block_tags(self, pop="proton"):
+      ''' Returns the XML tags of the velocity block ids and the velocity block data of a population.
+      '''
+      blockids_child = None
+      blockvariable_child = None
+      for child in self.__xml_root:
+         if child.tag == "BLOCKVARIABLE" and ("name" in child.attrib) and (child.attrib["name"] == pop):
+            blockvariable_child = child
+         # Old avgs files did not have the name set for BLOCKIDS
+         if child.tag == "BLOCKIDS" and ((("name" in child.attrib) and (child.attrib["name"] == pop)) or pop == "avgs"):
+            blockids_child = child
+      if blockids_child is None or blockvariable_child is None:
+         raise ValueError("Velocity blocks of population "+pop+" not found in file "+self.file_name)
+      return blockids_child, blockvariable_child
+
+   def __read_velocity_block_array(self, fptr, child, offset, num_of_blocks):
+      ''' Reads num_of_blocks entries from the block array of the given XML tag, starting at the given block offset.
+
+      :returns: numpy array [num_of_blocks, vectorsize]
+      '''
+      vector_size = ast.literal_eval(child.attrib["vectorsize"])
+      element_size = ast.literal_eval(child.attrib["datasize"])
+      datatype = child.attrib["datatype"]
+      dtypes = {("float",4): np.float32, ("float",8): np.float64, ("uint",4): np.uint32, ("uint",8): np.uint64}
+      if not (datatype, element_size) in dtypes:
+         raise TypeError("Error! Bad data type in blocks! datatype found was "+datatype)
+
+      fptr.seek(int(offset * vector_size * element_size + ast.literal_eval(child.text)))
+      data = np.fromfile(fptr, dtype = dtypes[(datatype, element_size)], count = vector_size*num_of_blocks)
+      return data.reshape(num_of_blocks, vector_size)
+
+   def read_velocity_cells_array(self, cellid, pop="proton", flat=True):
+      ''' Read velocity cells from a spatial cell as numpy arrays
+
+      :param cellid: Cell ID of the cell whose velocity cells the function will read
+      :param pop:    Population name
+      :param flat:   If True, returns the velocity cell ids and values as flat arrays. If False, returns the velocity block ids
+                     and the values of the cells of each block, ordered as in :func:`read_velocity_cells`.
+      :returns: velocity cell ids [N] and values [N], or block ids [nblocks] and values [nblocks, WID^3].
+                Empty arrays if the cell does not have a velocity distribution.
+
+      .. code-block:: python
+
+          # Example usage:
+          vcellids, f = vlsvReader.read_velocity_cells_array(1111)
+          V = vlsvReader.get_velocity_cell_coordinates(vcellids)
+
+      .. seealso:: :func:`read_velocity_cells` :func:`get_velocity_cell_coordinates`
+      '''
+      WID3 = self.get_WID()**3
+      block_range = self.__get_velocity_block_range(cellid, pop)
+      if block_range is None:
+         warnings.warn("Cell(s) does not have velocity distribution")
+         block_ids = np.zeros(0, dtype=np.int64)
+         avgs = np.zeros((0, WID3))
+      else:
+         offset, num_of_blocks = block_range
+         blockids_child, blockvariable_child = self.__get_velocity_block_tags(pop)
+         if self.__fptr.closed:
+            fptr = open(self.file_name,"rb")
+         else:
+            fptr = self.__fptr
+         block_ids = self.__read_velocity_block_array(fptr, blockids_child, offset, num_of_blocks).reshape(num_of_blocks).astype(np.int64)
+         avgs = self.__read_velocity_block_array(fptr, blockvariable_child, offset, num_of_blocks)
+         fptr.close()
+
+      if not flat:
+         return block_ids, avgs
+      vcellids = (block_ids[:, np.newaxis] * WID3 + np.arange(WID3)[np.newaxis, :]).reshape(-1)
+      return vcellids, avgs.reshape(-1)
+
+   def read_velocity_distribution(self, cellid, pop="proton"):
+      ''' Read the velocity distribution of a spatial cell as a block-sparse object
+
+      :param cellid: Cell ID of the cell whose velocity distribution the function will read
+      :param pop:    Population name
+      :returns: a VelocityDistribution holding the velocity blocks of the cell and the velocity mesh of the population
+
+      .. code-block:: python
+
+          # Example usage:
+          vdf = vlsvReader.read_velocity_distribution(1111)
+          f, edges = vdf.dense()
+
+      .. seealso:: :func:`read_velocity_cells_array` :class:`VelocityDistribution`
+      '''
+      block_ids, avgs = self.read_velocity_cells_array(cellid, pop, flat=False)
+      vmin = self.get_velocity_mesh_extent(pop)[0:3]
+      return VelocityDistribution(block_ids, avgs, self.get_velocity_mesh_size(pop), vmin,
+                                  self.get_velocity_mesh_dv(pop), self.get_WID())
+
+   def read_velocity_cells_batch(self, cellids, pop="proton", max_gap=256):
+      ''' Read the velocity blocks of many spatial cells at once.
+      The requested cells are sorted by their position in the file and neighbouring block ranges are merged into large reads,
+      so that scanning the VDFs of whole regions is limited by I/O rather than by per-cell overhead.
+
+      :param cellids:   List of cell IDs
+      :param pop:       Population name
+      :param max_gap:   Block ranges separated by at most this many blocks are read with a single read
+      :returns: block ids [N], block values [N, WID^3] and per-cell offsets [len(cellids)+1], so that the blocks of
+                cellids[i] are block_ids[offsets[i]:offsets[i+1]]. Cells without a velocity distribution have no blocks.
+
+      .. code-block:: python
+
+          # Example usage:
+          block_ids, avgs, offsets = vlsvReader.read_velocity_cells_batch(cellids)
+          WID3 = vlsvReader.get_WID()**3
+          for i,cellid in enumerate(cellids):
+             vcellids = (block_ids[offsets[i]:offsets[i+1],np.newaxis]*WID3 + np.arange(WID3)).ravel()
+             f = avgs[offsets[i]:offsets[i+1]].ravel()
+
+      .. seealso:: :func:`read_velocity_cells_array`
+      '''
+      cellids = np.atleast_1d(cellids)
+      WID3 = self.get_WID()**3
+
+      block_starts = np.zeros(len(cellids), dtype=np.int64)
+      block_counts = np.zeros(len(cellids), dtype=np.int64)
+      for i,cellid in enumerate(cellids):
+         block_range = self.__get_velocity_block_range(cellid, pop)
+         if block_range is not None:
+            block_starts[i], block_counts[i] = block_range
+      if np.any(block_counts == 0):
+         warnings.warn("Cell(s) does not have velocity distribution")
+
+      offsets = np.zeros(len(cellids)+1, dtype=np.int64)
+      offsets[1:] = np.cumsum(block_counts)
+      block_ids = np.zeros(offsets[-1], dtype=np.int64)
+      if offsets[-1] == 0:
+         return block_ids, np.zeros((0, WID3)), offsets
+      blockids_child, blockvariable_child = self.__get_velocity_block_tags(pop)
+      if ast.literal_eval(blockvariable_child.attrib["datasize"]) == 4:
+         avgs = np.zeros((offsets[-1], WID3), dtype=np.float32)
+      else:
+         avgs = np.zeros((offsets[-1], WID3), dtype=np.float64)
+
+      # Merge the ranges in file order into runs
+      order = np.argsort(block_starts, kind="stable")
+      order = order[block_counts[order] > 0]
+      starts = block_starts[order]
+      ends = starts + block_counts[order]
+      run_ends = np.maximum.accumulate(ends)
+      new_run = np.ones(len(order), dtype=bool)
+      new_run[1:] = starts[1:] > run_ends[:-1] + max_gap
+      run_first = np.flatnonzero(new_run)
+      run_last = np.append(run_first[1:], len(order))
 
       if self.__fptr.closed:
          fptr = open(self.file_name,"rb")
       else:
          fptr = self.__fptr
+      for first, last in zip(run_first, run_last):
+         run_start = starts[first]
+         run_length = run_ends[last-1] - run_start
+         run_ids = self.__read_velocity_block_array(fptr, blockids_child, run_start, run_length).reshape(run_length)
+         run_avgs = self.__read_velocity_block_array(fptr, blockvariable_child, run_start, run_length)
+         for j in range(first, last):
+            i = order[j]
+            block_ids[offsets[i]:offsets[i+1]] = run_ids[starts[j]-run_start:ends[j]-run_start]
+            avgs[offsets[i]:offsets[i+1]] = run_avgs[starts[j]-run_start:ends[j]-run_start]
+      fptr.close()
 
-      # Read in avgs and velocity cell ids:
-      for child in self.__xml_root:
-         # Read in avgs
-         if "name" in child.attrib and (child.attrib["name"] == pop) and (child.tag == "BLOCKVARIABLE"):
-            vector_size = ast.literal_eval(child.attrib["vectorsize"])
-            #array_size = ast.literal_eval(child.attrib["arraysize"])
-            element_size = ast.literal_eval(child.attrib["datasize"])
-            datatype = child.attrib["datatype"]
+      return block_ids, avgs, offsets
 
-            # Navigate to the correct position
-            offset_avgs = int(offset * vector_size * element_size + ast.literal_eval(child.text))
-            fptr.seek(offset_avgs)
-
-            if datatype == "float" and element_size == 4:
-               data_avgs = np.fromfile(fptr, dtype = np.float32, count = vector_size*num_of_blocks) 
-            if datatype == "float" and element_size == 8:
-               data_avgs = np.fromfile(fptr, dtype = np.float64, count = vector_size*num_of_blocks) 
-            data_avgs = data_avgs.reshape(num_of_blocks, vector_size)
-         # Read in block coordinates:
-         if ("name" in child.attrib) and (child.attrib["name"] == pop) and (child.tag == "BLOCKIDS"):
-            vector_size = ast.literal_eval(child.attrib["vectorsize"])
-            #array_size = ast.literal_eval(child.attrib["arraysize"])
-            element_size = ast.literal_eval(child.attrib["datasize"])
-            datatype = child.attrib["datatype"]
+   def read_velocity_cells(self, cellid, pop="proton"):
+      ''' Read velocity cells from a spatial cell
+      
+      :param cellid: Cell ID of the cell whose velocity cells the function will read
+      :returns: Map of velocity cell ids (unique for every velocity cell) and corresponding value
 
-            offset_block_ids = int(offset * vector_size * element_size + ast.literal_eval(child.text))
-            fptr.seek(offset_block_ids)
+      #Example:
 
-            if datatype == "uint" and element_size == 4:
-               data_block_ids = np.fromfile(fptr, dtype = np.uint32, count = vector_size*num_of_blocks)
-            elif datatype == "uint" and element_size == 8:
-               data_block_ids = np.fromfile(fptr, dtype = np.uint64, count = vector_size*num_of_blocks)
-            else:
-               raise TypeError("Error! Bad data type in blocks! datatype found was "+datatype)
+      example_cellid = 1111
 
-         if (pop=="avgs") and (child.tag == "BLOCKIDS"): # Old avgs files did not have the name set for BLOCKIDS
-            vector_size = ast.literal_eval(child.attrib["vectorsize"])
-            #array_size = ast.literal_eval(child.attrib["arraysize"])
-            element_size = ast.literal_eval(child.attrib["datasize"])
-            datatype = child.attrib["datatype"]
+      velocity_cell_map = vlsvReader.read_velocity_cells(example_cellid)
+      velocity_cell_ids = velocity_cell_map.keys()
+      velocity_cell_values = velocity_cell_map.values()
 
-            offset_block_ids = int(offset * vector_size * element_size + ast.literal_eval(child.text))
-            fptr.seek(offset_block_ids)
+      random_index = 4 # Just some index
+      random_velocity_cell_id = velocity_cell_ids[random_index]
 
-            if datatype == "uint" and element_size == 4:
-               data_block_ids = np.fromfile(fptr, dtype = np.uint32, count = vector_size*num_of_blocks)
-            elif datatype == "uint" and element_size == 8:
-               data_block_ids = np.fromfile(fptr, dtype = np.uint64, count = vector_size*num_of_blocks)
-            else:
-               raise TypeError("Error! Bad data type in blocks! datatype found was "+datatype)
+      print ("Velocity cell value at velocity cell id " + str(random_velocity_cell_id) + ": " + str(velocity_cell_map[random_velocity_cell_id]))
 
-            data_block_ids = data_block_ids.reshape(num_of_blocks, vector_size)
+      # Getting the corresponding coordinates might be more useful than having the velocity cell id so:
+      velocity_cell_coordinates = vlsvReader.get_velocity_cell_coordinates(velocity_cell_ids) # Get velocity cell coordinates corresponding to each velocity cell id
 
-      fptr.close()
+      random_velocity_cell_coordinates = velocity_cell_ids[random_index]
+      print("Velocity cell value at velocity cell id " + str(random_velocity_cell_id) + "and coordinates " + str(random_velocity_cell_coordinates) + ": " + str(velocity_cell_map[random_velocity_cell_id]))
 
-      # Check to make sure the sizes match (just some extra debugging)
-      if len(data_avgs) != len(data_block_ids):
-         raise ValueError("BAD DATA SIZES")
+      .. seealso:: :func:`read_velocity_cells_array` :func:`read_blocks`
+      '''
+      vcellids, avgs = self.read_velocity_cells_array(cellid, pop)
       # Make a dictionary (hash map) out of velocity cell ids and avgs:
-      velocity_cells = {}
-      array_size = len(data_avgs)
-
-      # Construct velocity cells:
-      WID=self.get_WID()
-      WID2=WID*WID
-      WID3=WID2*WID
-      velocity_cell_ids = []
-      for kv in range(WID):
-         for jv in range(WID):
-            for iv in range(WID):
-               velocity_cell_ids.append(kv*WID2 + jv*WID + iv)
-
-      for i in range(array_size):
-         velocity_block_id = data_block_ids[i]
-         avgIndex = 0
-         avgs = data_avgs[i]
-
-         for j in velocity_cell_ids + WID3*velocity_block_id:
-            velocity_cells[(int)(j)] = avgs[avgIndex]
-            avgIndex = avgIndex + 1
-      return velocity_cells
+      return dict(zip(vcellids.tolist(), avgs))
 
    def get_spatial_mesh_size(self):
       ''' Read spatial mesh size
@@ -3559,6 +4233,7 @@ class VlsvReader(object):
       self.__blocks_per_cell = {}
       self.__blocks_per_cell_offsets = {}
       self.__order_for_cellid_blocks = {}
+      self.__cells_with_blocks_tree = {}
 
    def optimize_clear_fileindex_for_cellid(self):
       ''' Clears a private variable containing cell ids and their locations
@@ -0,0 +1,130 @@
+#
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+#
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+''' Runs: the series of files written by one simulation, opened with readers that share their metadata.
+
+   Files of one run have the same spatial and velocity meshes, and without changes in the refinement also the same
+   cell ordering and cells with velocity distributions. The readers of a VlsvRun take the meshes, populations,
+   fsgrid decomposition and cell index dictionaries from the reader of the first file whenever the corresponding
+   data (compared by the footer entries and SHA-1 digests of the arrays) is identical, instead of rebuilding them
+   for every file.
+
+   .. code-block:: python
+
+      # Example:
+      import pytools as pt
+      run = pt.vlsvfile.VlsvRun("/path/to/run/", pattern="bulk.*.vlsv")
+      for f in run:
+         print(f.read_parameter("time"), f.read_variable("vg_rho", cellids=[1111,1112]))
+
+'''
+
+import glob
+import logging
+import os
+from collections import OrderedDict
+from vlsvreader import VlsvReader
+
+class VlsvRun(object):
+   ''' Class for a series of vlsv files of one run
+   '''
+
+   def __init__(self, files, pattern="bulk.*.vlsv", max_open=None, fsGridDecomposition=None):
+      ''' Finds the files of a run
+
+      :param files:        Directory of the run, a glob pattern or a list of file names
+      :param pattern:      Pattern of the file names when files is a directory
+      :param max_open:     Maximum number of readers kept besides the one of the first file, None keeps all of them
+      :param fsGridDecomposition: Either None or a len-3 list of ints, passed to the readers
+      '''
+      if isinstance(files, str):
+         if os.path.isdir(files):
+            files = glob.glob(os.path.join(files, pattern))
+         else:
+            files = glob.glob(files)
+      self.file_names = sorted(os.path.abspath(f) for f in files)
+      if len(self.file_names) == 0:
+         raise ValueError("No vlsv files found in run " + str(files))
+      self.__max_open = max_open
+      self.__fsGridDecomposition = fsGridDecomposition
+      self.__readers = OrderedDict()
+      self.__reference = None
+
+   def __len__(self):
+      return len(self.file_names)
+
+   def __getitem__(self, index):
+      return self.reader(index)
+
+   def __iter__(self):
+      for index in range(len(self)):
+         yield self.reader(index)
+
+   def get_reference_reader(self):
+      ''' Returns the reader of the first file, whose metadata the other readers share
+      '''
+      if self.__reference is None:
+         self.__reference = VlsvReader(self.file_names[0], fsGridDecomposition=self.__fsGridDecomposition)
+      return self.__reference
+
+   def reader(self, index):
+      ''' Returns the reader of a file of the run
+
+      :param index:        Index of the file in the sorted file names, or its file name
+      :returns: VlsvReader sharing the metadata of the first file
+
+      .. seealso:: :func:`VlsvReader.shared_metadata`
+      '''
+      if isinstance(index, str):
+         index = self.file_names.index(os.path.abspath(index))
+      index = range(len(self))[index]
+      if index == 0:
+         return self.get_reference_reader()
+      if index in self.__readers:
+         self.__readers.move_to_end(index)
+         return self.__readers[index]
+
+      f = VlsvReader(self.file_names[index], fsGridDecomposition=self.__fsGridDecomposition, shared=self.get_reference_reader())
+      if not f.shared_metadata()["mesh"]:
+         logging.info("File " + self.file_names[index] + " has a different mesh than " + self.file_names[0])
+      self.__readers[index] = f
+      if self.__max_open is not None:
+         while len(self.__readers) > self.__max_open:
+            self.__readers.popitem(last=False)
+      return f
+
+   def get_times(self, processes=1):
+      ''' Returns the simulation time of every file of the run, read from the file footers without opening readers
+
+      :param processes:    Number of worker processes reading the files
+      :returns: list of the times, NaN for files without a time parameter
+
+      .. seealso:: :func:`read_parameters`
+      '''
+      from vlsvfooter import read_parameters
+      return list(read_parameters(self.file_names, ["time"], processes=processes)["time"])
+
+   def close(self):
+      ''' Drops all readers (and with them the shared metadata)
+      '''
+      self.__readers = OrderedDict()
+      self.__reference = None
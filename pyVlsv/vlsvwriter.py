@@ -235,26 +235,44 @@ class VlsvWriter(object):
          self.write_variable_info(varinfo, 'SpatialGrid', 1)
       return
 
-   def write_velocity_space( self, vlsvReader, cellid, blocks_and_values ):
+   def write_velocity_space( self, vlsvReader, cellid, blocks_and_values, pop=None ):
       ''' Writes given velocity space into vlsv file
 
           :param vlsvReader:        Some open vlsv reader file with velocity space in the given cell id
-          :param cellid:            Given cellid
-          :param blocks_and_values: Blocks and values in list format e.g. [[block1,block2,..], [block1_values, block2_values,..]] where block1_values are velocity block values (list length 64)
+          :param cellid:            Given cellid, or a list of cell ids
+          :param blocks_and_values: Blocks and values in list format e.g. [[block1,block2,..], [block1_values, block2_values,..]] where block1_values are velocity block values (list length 64).
+                                    For a list of cell ids, a list with one such pair per cell.
+          :param pop:               Population name. By default the arrays are written without a population name, as in old avgs files.
+
+          .. code-block:: python
+
+             # Example usage:
+             writer = pt.vlsvfile.VlsvWriter(vlsvReader, "vdfs.vlsv", copy_meshes=["SpatialGrid", "proton"])
+             cellids = [1111, 1112]
+             writer.write_velocity_space(vlsvReader, cellids, [vlsvReader.read_velocity_cells_array(c, flat=False) for c in cellids], pop="proton")
+             writer.close()
       '''
+      if np.ndim(cellid) == 0:
+         cellid = [cellid]
+         blocks_and_values = [blocks_and_values]
+      WID3 = vlsvReader.get_WID()**3
 
       # Get cells_with_blocks, blocks_per_cell etc
-      cells_with_blocks = np.array([cellid])
-      number_of_blocks  = len(blocks_and_values)
-      blocks_per_cell    = np.array([number_of_blocks])
+      cells_with_blocks = np.array(cellid, dtype=np.uint64)
+      blocks_per_cell = np.array([len(blocks) for blocks, values in blocks_and_values], dtype=np.uint32)
+      blocks = np.concatenate([np.asarray(blocks, dtype=np.uint32).reshape(-1) for blocks, values in blocks_and_values])
+      values = np.concatenate([np.asarray(values).reshape(-1, WID3) for blocks, values in blocks_and_values])
+
+      # Old avgs files have no population name except on the block variable
+      name = '' if pop is None else pop
 
       # Write them out
-      self.__write( data=cells_with_blocks, name='', mesh="SpatialGrid", tag="CELLSWITHBLOCKS" )
-      self.__write( data=blocks_per_cell, name='', mesh="SpatialGrid", tag="BLOCKSPERCELL" )
+      self.__write( data=cells_with_blocks, name=name, mesh="SpatialGrid", tag="CELLSWITHBLOCKS" )
+      self.__write( data=blocks_per_cell, name=name, mesh="SpatialGrid", tag="BLOCKSPERCELL" )
 
       # Write blockids and values
-      self.__write( data=blocks_and_values[0], name='', mesh="SpatialGrid", tag="BLOCKIDS" )
-      self.__write( data=blocks_and_values[1], name='avgs', mesh="SpatialGrid", tag="BLOCKVARIABLE" )
+      self.__write( data=blocks, name=name, mesh="SpatialGrid", tag="BLOCKIDS" )
+      self.__write( data=values, name=('avgs' if pop is None else pop), mesh="SpatialGrid", tag="BLOCKVARIABLE" )
 
 
    def write(self, data, name, tag, mesh, extra_attribs={}):
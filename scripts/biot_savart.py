@@ -261,17 +261,16 @@ def fac_map(f, vg_x, vg_y, vg_z, dx, f_J_sidecar = None, r_C = 5 * 6.371e6, mag_
     # evaluate FACs in 'inner' FAC region:  R_IONO < r < r_C
     if f_J_sidecar is None:
         # map: initial point -> downmap to ionosphere via dipole formula (ionospheric runs, e.g. FHA)
-        node_coords_iono = f.get_ionosphere_node_coords()  # [n_nodes, 3]
-        ig_fac = f.read_variable('ig_fac')      # [n_nodes], facs evaluated on ionosphere grid (assumed r=R_IONO)
         vg_b_vol_magnitude = np.sqrt(vg_b_vol[:,0]**2 + vg_b_vol[:,1]**2 + vg_b_vol[:,2]**2 )
 
         lat0 = np.arccos( np.sqrt(R_IONO / L) ) # latitude at r=R_IONO
         theta0 = (np.pi / 2) - lat0
         b0 = b_dip_magnitude(theta0, R_IONO, mag_mom = 8e22)
         x0, y0, z0 = spherical_to_cartesian(R_IONO, theta0[inner], vg_phi[inner])
-        for i in range(x0.size):
-            ind_min = nearest_node_index(f, x0[i], y0[i], z0[i], node_coords_iono = node_coords_iono)
-            vg_J_eval[inner[i], :] = (vg_b_vol[inner[i],:] / b0[inner[i]]) * ig_fac[ind_min]  # J \propto B. Mapping UP from the FACs evaluated at the ground 
+        # facs evaluated on ionosphere grid (assumed r=R_IONO), interpolated within the ionosphere mesh triangles
+        ig_fac = f.read_interpolated_ionosphere_variable('ig_fac', np.array([x0, y0, z0]).T.reshape([x0.size, 3]))
+        ig_fac[~np.isfinite(ig_fac)] = 0.   # field lines not reaching R_IONO
+        vg_J_eval[inner, :] = (vg_b_vol[inner,:] / b0[inner, np.newaxis]) * ig_fac[:, np.newaxis]  # J \propto B. Mapping UP from the FACs evaluated at the ground 
     else: # (use sidecar containing current density "vg_J" in non-ionospheric runs, e.g. EGL)
         # map: initial point -> some point in the simulation domain near the inner boundary (~5 R_E) according to dipole formula
         logging.info('NOTE: Downmapping FACs along constant L-shell via dipole formula!')
@@ -94,29 +94,12 @@ def E_horizontal(dB_dt, pos, time, sigma = 1e-3, method = 'liu'):
                 'liu': use integration method described in Liu et al., (2009) doi:10.1029/2008SW000439, 2009
                        this method is exact for piecewise linear B (i.e., piecewise constant dB/dt)
                 'RH-riemann': use right-handed Riemann sum.
+
+        See pt.calculations.geoelectric_field for many stations at once and layered ground conductivity models.
     '''
-    mu_0 = 1.25663706e-6    # permeability of free space
-    E_north = np.zeros(time.size)
-    E_east = np.zeros(time.size)
-    dB_dt_r, dB_dt_theta, dB_dt_phi = cartesian_to_spherical_vector(dB_dt[0,:], dB_dt[1,:], dB_dt[2,:], pos[0], pos[1], pos[2])
-    dB_dt_north = -dB_dt_theta; dB_dt_east = dB_dt_phi
-    t0 = time[1] - time[0]
-    for i in range(0, time.size):
-        t = time[i]   # monotonically increasing from t[0]
-        tp = time[1:i+1]
-        dt = tp - time[0:i]
-        if method == 'liu':  # implement Liu et al (2009), eq. 5
-            t_1 = t - tp
-            t_2 = t - time[0:i]   # elementwise, t_2 > t_1
-            dB_north = dB_dt_north[0:i] * dt[0:i]
-            dB_east = dB_dt_east[0:i] * dt[0:i]
-            E_north[i] = np.sum(-(2. / np.sqrt(np.pi * mu_0 * sigma * dt[0:i])) * dB_east * (np.sqrt(t_2) - np.sqrt(t_1) ) )
-            E_east[i] = np.sum((2. / np.sqrt(np.pi * mu_0 * sigma * dt[0:i])) * dB_north * (np.sqrt(t_2) - np.sqrt(t_1) ) )
-        elif method == 'RH-riemann':
-            if i != 0:
-                E_north[i] = -(1. / np.sqrt(np.pi * mu_0 * sigma)) * np.sum(dt * dB_dt_east[1:i+1] / np.sqrt(t-tp + t0))
-                E_east[i] = (1. / np.sqrt(np.pi * mu_0 * sigma)) * np.sum(dt * dB_dt_north[1:i+1] / np.sqrt(t-tp + t0))  # note the sign
-    return E_north, E_east
+    dB_dt_north, dB_dt_east = pt.calculations.ground_horizontal_components(dB_dt[np.newaxis,:,:], np.asarray(pos)[np.newaxis,:])
+    E_north, E_east = pt.calculations.geoelectric_field(dB_dt_north, dB_dt_east, time, sigma = sigma, method = method)
+    return E_north[0], E_east[0]
 
 if __name__ == '__main__':    
     '''
@@ -178,10 +161,8 @@ if __name__ == '__main__':
         try:
             ind = np.where(arr[0,0,:] != 0)[0]
             logging.info("Time interpolation: {} points removed".format(arr.shape[2] - ind.size))
-            interp_arr = arr[:,:, ind]  # only keep the non-zero times to conduct the interpolation
-            for i in range(arr.shape[0]): # positions
-                for j in range(3): # vector components
-                    arr[i, j, :] = np.interp(time, time[ind], interp_arr[i, j, :], left=None, right=None, period=None)
+            # only keep the non-zero times to conduct the interpolation
+            arr[:,:,:] = pt.calculations.interpolate_in_time(time, arr, time, valid = arr[0,0,:] != 0)
         except:
             logging.info("error with interpolation. zeroing out array...")
     
@@ -197,10 +178,8 @@ if __name__ == '__main__':
             ig_dB_dt_outer_arr[:,:,i-nmin] = ig_B_outer_arr[:,:,i-nmin] - ig_B_outer_arr[:,:,i-nmin-1]
 
     # Integrate dB/dt to find induced geoelectric field, by Cagniard's formula. See E_horizontal()
-    for i_pos in range(ig_dB_dt_arr.shape[0]):
-        E_north, E_east = E_horizontal(ig_dB_dt_arr[i_pos,:,:], pos[i_pos,:], time, sigma = 1e-3, method = 'liu')
-        E_north_arr[i_pos,:] = E_north
-        E_east_arr[i_pos,:] = E_east
+    dB_dt_north_arr, dB_dt_east_arr = pt.calculations.ground_horizontal_components(ig_dB_dt_arr, pos)
+    E_north_arr, E_east_arr = pt.calculations.geoelectric_field(dB_dt_north_arr, dB_dt_east_arr, time, sigma = 1e-3, method = 'liu')
     
     # write geoelectric field to .vlsv
     save_dir = './GIC_{}/'.format(run)   # user defined path
@@ -249,16 +249,11 @@ def make_streamlines():
 
     ##############
 
-    #Read the data from vlsv-file
-    V = f.read_variable("vg_v")
+    #Read the data from vlsv-file onto a uniform grid
+    Vdpoints = f.read_variable_as_uniform("vg_v", reflevel=reflevel)
 
     #from m to Re
-    V = np.array([[to_Re(i) for i in j ]for j in V])
-    #logging.info(V)
-
-    V = V[indexids]
-
-    Vdpoints = ids3d.idmesh3d2(cellids, V, reflevel, xsize, ysize, zsize, 3)
+    Vdpoints = to_Re(Vdpoints)
 
 
     Vxs = Vdpoints[:,:,:,0]
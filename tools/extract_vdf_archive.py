@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# 
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+# 
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# 
+
+# Extracts the VDFs of selected cells from a series of vlsv files into a compact archive,
+# readable with pt.vlsvfile.VdfArchive
+# USAGE: python extract_vdf_archive.py -o vdfs.npz -cellids 1111 1112 -i bulk.*.vlsv
+
+import pytools as pt
+import numpy as np
+import argparse
+import logging
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', nargs='*', help="a list of vlsv files")
+parser.add_argument('-o', help="name of the archive file", default="vdfs.npz")
+parser.add_argument('-cellids', nargs='*', type=int, help="a list of cell ids")
+parser.add_argument('-c', help="a file with coordinates, the nearest cells with VDFs in the first file are archived")
+parser.add_argument('-re', action='store_true', help="Coordinates in RE, in meters by default")
+parser.add_argument('-pop', help="population name, default proton", default="proton")
+parser.add_argument('-float64', action='store_true', help="keep the VDF values in double precision")
+parser.add_argument('-nocompress', action='store_true', help="do not compress the archive")
+args = parser.parse_args()
+
+if args.i is None or len(args.i) == 0:
+    logging.info("No vlsv files given")
+    quit()
+
+cellids = args.cellids
+if args.c is not None:
+    coords = np.atleast_2d(np.loadtxt(args.c))
+    if args.re:
+        coords = coords * 6371000
+    cellids = pt.vlsvfile.VlsvReader(args.i[0]).get_cellid_with_vdf(coords, pop=args.pop)
+if cellids is None:
+    logging.info("No cell ids or coordinates given")
+    quit()
+
+n = pt.vlsvfile.extract_vdf_archive(args.i, np.unique(cellids), args.o, pop=args.pop,
+                                    dtype=None if args.float64 else np.float32, compress=not args.nocompress)
+logging.info("Archived " + str(n) + " time steps into " + args.o)
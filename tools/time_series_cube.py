@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# 
+# This file is part of Analysator.
+# Copyright 2013-2016 Finnish Meteorological Institute
+# Copyright 2017-2024 University of Helsinki
+# 
+# For details of usage, see the COPYING file and read the "Rules of the Road"
+# at http://www.physics.helsinki.fi/vlasiator/
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# 
+
+
+# Creates a time-series cube of selected variables from a series of vlsv files, or appends the new files to an
+# existing one, readable with pt.calculations.TimeSeriesCube
+# USAGE: python time_series_cube.py -o cube/ -var vg_rho vg_b_vol -i bulk.*.vlsv
+#        python time_series_cube.py -o cube/ -i bulk.*.vlsv     (appends files written since the last call)
+
+import pytools as pt
+import numpy as np
+import argparse
+import logging
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', nargs='*', help="a list of vlsv files")
+parser.add_argument('-o', help="directory of the cube", default="cube")
+parser.add_argument('-var', nargs='*', help="a list of variables, required for a new cube")
+parser.add_argument('-op', nargs='*', help="a list of operators, one per variable, default pass")
+parser.add_argument('-cellids', nargs='*', type=int, help="a list of cell ids, default all cells of the first file")
+parser.add_argument('-chunk', type=int, help="number of cells per chunk file, default 4096", default=4096)
+parser.add_argument('-float64', action='store_true', help="store the values in double precision")
+parser.add_argument('-n', type=int, help="number of worker processes, default 1", default=1)
+args = parser.parse_args()
+
+if args.i is None or len(args.i) == 0:
+    logging.info("No vlsv files given")
+    quit()
+
+cube = pt.calculations.time_series_cube(args.o, sorted(args.i), variables=args.var, cellids=args.cellids, operators=args.op,
+                                        chunk_cells=args.chunk, dtype=np.float64 if args.float64 else np.float32,
+                                        processes=args.n)
+logging.info("The cube has " + str(len(cube)) + " time steps of " + str(len(cube.get_cellids())) + " cells")
@@ -22,47 +22,103 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 # 
 
+# Extracts variables at a set of points (virtual spacecraft) from a series of vlsv files.
+# The points are resolved to cells once per mesh (files of a run with the same mesh and cell ids share the result), the
+# variables are read for all points in one batched call per file, and the results are streamed to the output
+# one file at a time, so the memory use is bounded by a single file's worth of point data.
+# USAGE: python vlsvintpol.py -var vg_rho vg_b_vol.magnitude -c points.txt -re -n 8 -i bulk.*.vlsv > out.txt
+#        python vlsvintpol.py -var vg_rho vg_v -c points.txt -linear -o out.npz -i bulk.*.vlsv
+
 import pytools as pt
 import numpy as np
 import sys
+import os
 import argparse
 import logging
-
+import zipfile
+
+
+# Per-process reader of the first file handled by the process, whose cell index the later readers share, and the
+# nearest cell ids of the points for its mesh
+_reference = None
+_reference_cellids = None
+
+def point_cellids(f, coords):
+    ''' Returns the cell ids of the points, reusing those of the reference reader when both the mesh and the cell ids
+        of the files agree
+    '''
+    global _reference, _reference_cellids
+    shared = f.shared_metadata()
+    if _reference is not None and shared["mesh"] and shared["cellids"]:
+        return _reference_cellids
+    cellids = f.get_cellid(coords)
+    if _reference is None:
+        _reference = f
+        _reference_cellids = cellids
+    return cellids
 
 def extract_file(filename):
-    out = []
+    ''' Reads the variables at all points from one file
+
+    :returns: (file name, time, cell ids [npoints], values [npoints, ncolumns], number of columns per variable),
+              or (file name, None, ...) if the file can not be read
+    '''
     try:
-        cellids=[]
-        values=[]
-        f=pt.vlsvfile.VlsvReader(filename)
+        f = pt.vlsvfile.VlsvReader(filename, shared=_reference)
+        f.get_cellid_locations()
         f.optimize_open_file()
-        t=f.read_parameter("time")
-        if t == None:
-            t=f.read_parameter("t")
-        if t == None:	    
+        t = f.read_parameter("time")
+        if t is None:
+            t = f.read_parameter("t")
+        if t is None:
             logging.info("Unknown time format in file " + filename)
 
-        
-        for coord in coords:
-            if(args.re):
-                cellids.append(f.get_cellid(coord * 6371000))
-            else:
-                cellids.append(f.get_cellid(coord))
-
-        for i,var in enumerate(variables):
-            values.append(f.read_variable(variables[i],operator=operators[i],cellids=cellids))
-        
-        for i,id in enumerate(cellids):
-            out_line = str(t) + " " +  ' '.join(map(str, coords[i])) + " " + str(id)
-            for j,varval in enumerate(values):
-                out_line = out_line +  " " + str(varval[i])
-            out.append([filename, out_line])
+        cellids = point_cellids(f, coords)
+        columns = []
+        if args.linear:
+            for start in range(0, len(coords), args.chunk):
+                chunk = coords[start:start+args.chunk]
+                columns.append([np.reshape(f.read_interpolated_variable(var, chunk, operator=op), (len(chunk), -1))
+                                for var, op in zip(variables, operators)])
+            ncomponents = [c.shape[1] for c in columns[0]]
+            values = np.concatenate([np.concatenate(c, axis=1) for c in columns], axis=0)
+        else:
+            # One batched read of the distinct cells per variable
+            unique_ids, inverse = np.unique(cellids, return_inverse=True)
+            valid = unique_ids != 0
+            probe = None
+            if not np.any(valid):
+                # No point inside the domain, one cell of the file gives the number of components
+                probe = [next(iter(f.get_cellid_locations()))]
+            for var, op in zip(variables, operators):
+                if probe is None:
+                    data = np.reshape(f.read_variable(var, operator=op, cellids=unique_ids[valid]), (np.count_nonzero(valid), -1))
+                else:
+                    data = np.reshape(f.read_variable(var, operator=op, cellids=probe), (1, -1))[:0]
+                column = np.full((len(unique_ids), data.shape[1]), np.nan)
+                column[valid] = data
+                columns.append(column[inverse])
+            values = np.concatenate(columns, axis=1)
+            ncomponents = [c.shape[1] for c in columns]
         f.optimize_close_file()
-    except:
-        out.append([filename, "#Could not read " + filename])
-        pass
-    
-    return out
+    except Exception as e:
+        logging.info("Could not read " + filename + ": " + str(e))
+        return filename, None, None, None, None
+
+    return filename, (np.nan if t is None else float(t)), cellids, values, ncomponents
+
+def column_names(ncomponents):
+    names = []
+    for var, n in zip(varnames, ncomponents):
+        if n > 1:
+            names += [var + "[" + str(c) + "]" for c in range(n)]
+        else:
+            names.append(var)
+    return names
+
+def write_array(zfile, name, array):
+    with zfile.open(name + '.npy', 'w', force_zip64=True) as fh:
+        np.lib.format.write_array(fh, np.asanyarray(array), allow_pickle=False)
 
 
 parser = argparse.ArgumentParser()
@@ -71,6 +127,9 @@ parser.add_argument('-i', nargs='*', help="a list of vlsv files")
 parser.add_argument('-c', help="A file with coordinates (can also be give from stdin)")
 parser.add_argument('-re', action='store_true', help="Coordinates in RE, in meters by default")
 parser.add_argument('-n', help="Number of processes to use, default 1")
+parser.add_argument('-linear', action='store_true', help="Trilinear interpolation instead of the nearest cell")
+parser.add_argument('-o', help="Output file, .npz or .csv, default text to stdout")
+parser.add_argument('-chunk', type=int, default=100000, help="Number of points interpolated at once, default 100000")
 args = parser.parse_args()
 
 
@@ -93,31 +152,72 @@ for i,var in enumerate(varnames):
 
 #read in coordinates
 if args.c is None:
-    coords = np.loadtxt(sys.stdin, dtype=np.float)
+    input_coords = np.loadtxt(sys.stdin, dtype=float)
 else:
-    coords = np.loadtxt(args.c, dtype=np.float)
+    input_coords = np.loadtxt(args.c, dtype=float)
 
 #if just single point make it into array with 1 row
-coords = np.atleast_2d(coords)
-
-if(args.re):
-    print("#t X_RE Y_RE Z_RE CELLID " + " ".join(varnames))
-else:
-    print("#t X Y Z CELLID " + " ".join(varnames))
+input_coords = np.atleast_2d(input_coords)
+coords = input_coords * 6371000 if args.re else input_coords
 
 if args.n is None:
     numproc = 1
 else:
     numproc = int(args.n)
 
+if args.re:
+    coordinate_header = "X_RE Y_RE Z_RE"
+else:
+    coordinate_header = "X Y Z"
 
-## Parallel processing
-from multiprocessing import Pool
-if __name__ == '__main__':
-   pool = Pool(numproc)
-   return_array = pool.map(extract_file, args.i)
 
+if __name__ == '__main__':
+    file_names = sorted(args.i)
+    if numproc > 1:
+        from multiprocessing import Pool
+        pool = Pool(numproc)
+        results = pool.imap(extract_file, file_names)
+    else:
+        results = map(extract_file, file_names)
 
-for i in sorted(return_array):
-    for j in i:
-        print(j[1])
+    binary = args.o is not None and os.path.splitext(args.o)[1] == ".npz"
+    if binary:
+        out = zipfile.ZipFile(args.o, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    elif args.o is not None:
+        out = open(args.o, 'w')
+    else:
+        out = sys.stdout
+    delimiter = "," if args.o is not None and not binary else " "
+
+    times = []
+    read_files = []
+    names = None
+    for filename, t, cellids, values, ncomponents in results:
+        if t is None:
+            if not binary:
+                out.write("#Could not read " + filename + "\n")
+            continue
+        if names is None:
+            names = column_names(ncomponents)
+            if not binary:
+                out.write("#" + delimiter.join(["t"] + coordinate_header.split() + ["CELLID"] + names) + "\n")
+        if binary:
+            write_array(out, "step%06d_cellids" % len(times), cellids)
+            write_array(out, "step%06d_values" % len(times), values)
+        else:
+            table = np.column_stack((np.full(len(cellids), t), input_coords, cellids, values))
+            np.savetxt(out, table, delimiter=delimiter, fmt=["%.10g"]*4 + ["%d"] + ["%.10g"]*values.shape[1])
+        times.append(t)
+        read_files.append(filename)
+
+    if binary:
+        write_array(out, "times", np.array(times))
+        write_array(out, "files", np.array(read_files, dtype=str))
+        write_array(out, "coords", input_coords)
+        write_array(out, "columns", np.array([] if names is None else names, dtype=str))
+        out.close()
+    elif args.o is not None:
+        out.close()
+    if numproc > 1:
+        pool.close()
+        pool.join()